@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks the stages of the index calculation on synthetic scenes and tracks them across commits"""
+
+
+from concurrent.futures import ProcessPoolExecutor
+from rasterio.transform import from_origin
+import modules.indices as indices
+import modules.indices_l8 as indices_l8
+import modules.indices_s2 as indices_s2
+import modules.metrics as metrics
+import modules.reading as reading
+import modules.stats as stats
+import modules.writing as writing
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import fiona
+import numpy as np
+import rasterio
+
+
+# Every case (satellite, size of the scene, with or without clip) runs in its own process on a synthetic scene tree
+# (./data/raster/ and ./data/shapes/ in a temporary folder), so its peak RSS is not mixed up with the other cases.
+# Per index the stages are timed (best of -n runs):
+# - read: reading the bands of the index (clip: only the window of the shapefile)
+# - clip: the window of the shapefile and masking the pixels outside of it (only clipped cases)
+# - compute: the compiled formula on the bands
+# - write: exporting the index as GeoTIFF
+# - stats: statistics of the index (one pass)
+# - stream: reading, calculating and writing block by block (like -stream true)
+# next to the throughput in megapixels of the index per second and the peak memory of the arrays (tracemalloc, in
+# one more run, as tracing the allocations slows the timed runs down).
+# Landsat scenes are benchmarked with tiled, compressed bands and with uncompressed strips (layout "stripped"),
+# which are memory-mapped instead of decoded.
+# Next to the cases the startup is measured: the seconds importing the modules of main.py (-X importtime, best of
+# -n runs, without the start of the interpreter), recorded as a case of its own ("startup").
+# Each run appends one line per case to ./data/benchmarks/history.jsonl with the commit of the repository, and is
+# compared to the last run of another commit: stages which got slower, peak RSS and import time which grew more than
+# the tolerance are reported.
+
+HISTORY = "./data/benchmarks/history.jsonl"
+
+# bands of the synthetic scenes per resolution, like in Sentinel-2 L2A products and Landsat Collection 2 products
+S2_BANDS = {
+    "10": ["B02", "B03", "B04", "B08"],
+    "20": ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B8A", "B11", "B12", "SCL"],
+    "60": ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B8A", "B09", "B11", "B12", "SCL"],
+}
+L8_BANDS = ["SR_B1", "SR_B2", "SR_B3", "SR_B4", "SR_B5", "SR_B6", "SR_B7", "QA_PIXEL"]
+ORIGIN = (399960, 5600040)
+
+
+def make_s2_scene(root, size, rng):
+    """Write a Sentinel-2 SAFE folder with JPEG2000 bands, size is the width of the 10 m grid in pixels"""
+    scene = root + "/data/raster/S2A_MSIL2A_20220701T102031_N0400_R065_T32UMV_20220701T150000.SAFE"
+    granule = scene + "/GRANULE/L2A_T32UMV_A036000_20220701T102031/IMG_DATA"
+    for resolution, bands in S2_BANDS.items():
+        os.makedirs("{}/R{}m".format(granule, resolution), exist_ok=True)
+        width = size * 10 // int(resolution)
+        for band in bands:
+            if band == "SCL":
+                # mostly vegetation (4), some clouds (9)
+                array = rng.choice(np.array([4, 4, 4, 9], "uint8"), (width, width))
+            else:
+                array = rng.integers(1, 10000, (width, width)).astype("uint16")
+            out = "{}/R{}m/T32UMV_20220701T102031_{}_{}m.jp2".format(granule, resolution, band, resolution)
+            write_band(out, array, "JP2OpenJPEG", int(resolution))
+    return scene
+
+
+def make_l8_scene(root, size, rng, stripped=False):
+    """
+    Write a Landsat 8 folder with tiled, compressed GeoTIFF bands (or uncompressed strips), size is the width of
+    the 10 m grid in pixels
+    """
+    name = (
+        "LC08_L2SP_195026_20220705_20220708_02_T1"
+        if not stripped
+        else "LC08_L2SP_195026_20220721_20220726_02_T1"
+    )
+    scene = root + "/data/raster/" + name
+    os.makedirs(scene, exist_ok=True)
+    width = size // 3
+    for band in L8_BANDS:
+        if band == "QA_PIXEL":
+            # mostly clear (bit 6), some clouds (bit 3)
+            array = rng.choice(np.array([64, 64, 64, 8], "uint16"), (width, width))
+        else:
+            array = rng.integers(7000, 20000, (width, width)).astype("uint16")
+        write_band("{}/{}_{}.TIF".format(scene, name, band), array, "GTiff", 30, stripped)
+    return scene
+
+
+def write_band(out, array, driver, resolution, stripped=False):
+    """Write the array of a synthetic band in UTM 32N with the given resolution (GeoTIFF: tiled or stripped)"""
+    if stripped:
+        options = {}
+    elif driver == "GTiff":
+        options = {"tiled": True, "compress": "deflate", "blockxsize": 256, "blockysize": 256}
+    else:
+        options = {"blockxsize": 256, "blockysize": 256}
+    with rasterio.open(
+        out,
+        "w",
+        driver=driver,
+        width=array.shape[1],
+        height=array.shape[0],
+        count=1,
+        dtype=array.dtype,
+        crs="EPSG:32632",
+        transform=from_origin(*ORIGIN, resolution, resolution),
+        **options,
+    ) as dest:
+        dest.write(array, 1)
+
+
+def make_shape(root, size):
+    """Write a shapefile with a polygon on the center quarter of the scenes"""
+    os.makedirs(root + "/data/shapes", exist_ok=True)
+    extent = size * 10
+    left, top = ORIGIN[0] + extent / 4, ORIGIN[1] - extent / 4
+    right, bottom = left + extent / 2, top - extent / 2
+    schema = {"geometry": "Polygon", "properties": {"id": "int"}}
+    with fiona.open(root + "/data/shapes/bench.shp", "w", "ESRI Shapefile", schema, crs="EPSG:32632") as shape:
+        polygon = [(left, top), (right, top), (right, bottom), (left, bottom), (left, top)]
+        shape.write({"geometry": {"type": "Polygon", "coordinates": [polygon]}, "properties": {"id": 1}})
+    return "bench.shp"
+
+
+def timed(function, repeat):
+    """
+    Run a function repeat times, returns the best time (seconds), the peak of its allocations (MB) and its result.
+    The peak is measured in one more run, as tracemalloc slows the timed runs down
+    """
+    best = np.inf
+    for _ in range(repeat):
+        starttime = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - starttime)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak / 2**20, result
+
+
+def split_stage(function, repeat, name):
+    """
+    Run a function like timed(), but split off the time of a stage of modules.metrics (like "clip") within it
+    output: returns the timed() of the function without the stage and of the stage
+    """
+    best, best_stage = np.inf, np.inf
+    for _ in range(repeat):
+        metrics.reset()
+        starttime = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - starttime
+        within = metrics.collect().get(name, {}).get("seconds", 0.0)
+        best, best_stage = min(best, seconds - within), min(best_stage, within)
+    metrics.reset()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    # the stages measure their own peak while tracemalloc is tracing
+    peak_stage = metrics.collect().get(name, {}).get("peak_mb") or 0.0
+    metrics.reset()
+    return (best, peak, result), (best_stage, peak_stage, result)
+
+
+def run_case(case):
+    """
+    Measure the stages of every index of a case (dict with root, satellite, scene, clip, index_names, resolution,
+    dtype and repeat), runs in its own process
+    output: returns per index and stage the seconds, megapixels per second and peak MB, next to the peak RSS (MB)
+    """
+    os.chdir(case["root"])
+    repeat = case["repeat"]
+    scene, clip = case["scene"], case["clip"]
+    measured = {}
+    # the messages of the reading and writing functions are not of interest here
+    with contextlib.redirect_stdout(io.StringIO()):
+        for index_name in case["index_names"]:
+            if case["satellite"] == "s2":
+                resolution = case["resolution"] or indices.INDICES[index_name]["resolutions"][0]
+                band_paths, formulas = indices.index_formulas(
+                    [index_name], "s2", "", lambda band: indices_s2.band_path(scene, band, resolution)
+                )
+                grid = indices_s2.band_path(scene, "B02", resolution)
+            else:
+                band_paths, formulas = indices.index_formulas(
+                    [index_name], "l8", "", lambda band: indices_l8.band_path(scene, band)
+                )
+                grid = None
+            formula, positions = formulas[0]
+            read_options = {"dtype": case["dtype"], "output": case["dtype"], "grid": grid}
+            profile = reading.raster_profile(grid or band_paths[0], clip, case["dtype"])
+            out_raster = "./results/{}.tif".format(index_name)
+
+            def write(result):
+                dest = writing.open_raster(out_raster, profile)
+                dest.write(writing.to_output(result, profile["dtype"]), indexes=1)
+                writing.close_raster(dest, out_raster, profile)
+
+            times = {}
+            if clip:
+                times["read"], times["clip"] = split_stage(
+                    lambda: reading.read_rasters(band_paths, clip, read_options), repeat, "clip"
+                )
+            else:
+                times["read"] = timed(lambda: reading.read_rasters(band_paths, clip, read_options), repeat)
+            bands = [times["read"][2][i] for i in positions]
+            times["compute"] = timed(lambda: formula(*bands), repeat)
+            result = times["compute"][2]
+            times["write"] = timed(lambda: write(result), repeat)
+            times["stats"] = timed(lambda: stats.of_array(index_name, result), repeat)
+            times["stream"] = timed(
+                lambda: reading.calc_indices(band_paths, clip, formulas, [out_raster], read_options), repeat
+            )
+            measured[index_name] = {
+                stage: {
+                    "seconds": round(seconds, 4),
+                    "mpix_s": round(result.size / 1e6 / seconds, 2),
+                    "peak_mb": round(peak, 1),
+                }
+                for stage, (seconds, peak, _) in times.items()
+            }
+    return {"indices": measured, "rss_mb": round(metrics.peak_rss(), 1)}
+
+
+def import_seconds(repeat):
+    """Best time (seconds) of repeat fresh interpreters importing the modules of main.py (-X importtime)"""
+    best = np.inf
+    for _ in range(repeat):
+        run = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import main, modules.api"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        # lines are "import time: self [us] | cumulative | name", top-level imports have no indented name
+        seconds = 0.0
+        for line in run.stderr.splitlines()[1:]:
+            _, cumulative, name = line.split("|")
+            if not name.startswith("  "):
+                seconds += int(cumulative) / 1e6
+        best = min(best, seconds)
+    return best
+
+
+def git_commit():
+    """Short hash of the checked out commit of the repository, "unknown" outside of a git repository"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def case_key(record):
+    """Key of a case to find it in earlier runs"""
+    if record.get("startup"):
+        return ("startup",)
+    return (
+        record["satellite"],
+        record.get("layout", ""),
+        record["size"],
+        record["clip"],
+        record["dtype"],
+        record["resolution"],
+    )
+
+
+def regressions(history, records, tolerance):
+    """
+    Compare the records of this run to the last run of another commit with the same cases
+    output: returns the stages which are slower, the peak RSS and the import time which grew more than the
+    tolerance allows (list of strings)
+    """
+    slower = []
+    for record in records:
+        earlier = [
+            old for old in history if case_key(old) == case_key(record) and old["commit"] != record["commit"]
+        ]
+        if not earlier:
+            continue
+        last = earlier[-1]
+        if record.get("startup"):
+            if record["import_s"] > last["import_s"] * (1 + tolerance):
+                slower.append(
+                    "startup import: {} -> {} s (commit {})".format(
+                        last["import_s"], record["import_s"], last["commit"]
+                    )
+                )
+            continue
+        case = "{} {}{} px {}".format(
+            record["satellite"],
+            record.get("layout", "") + " " if record.get("layout") else "",
+            record["size"],
+            "clipped" if record["clip"] else "whole scene",
+        )
+        if last.get("rss_mb") and record["rss_mb"] > last["rss_mb"] * (1 + tolerance):
+            slower.append(
+                "{} peak RSS: {} -> {} MB (commit {})".format(
+                    case, last["rss_mb"], record["rss_mb"], last["commit"]
+                )
+            )
+        for index_name, stages in record["indices"].items():
+            for stage, values in stages.items():
+                before = last["indices"].get(index_name, {}).get(stage)
+                if before and values["mpix_s"] < before["mpix_s"] * (1 - tolerance):
+                    slower.append(
+                        "{} {} {}: {} -> {} Mpix/s (commit {})".format(
+                            case,
+                            index_name,
+                            stage,
+                            before["mpix_s"],
+                            values["mpix_s"],
+                            last["commit"],
+                        )
+                    )
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the stages (read, clip, compute, write, stats, stream) of the index calculation on synthetic scenes"
+    )
+    parser.add_argument(
+        "-sat", dest="satellites", default="s2,l8", help="Satellites to benchmark (s2, l8), default s2,l8"
+    )
+    parser.add_argument(
+        "-s", dest="sizes", default="1098,2196", help="Widths of the 10 m grid of the scenes, default 1098,2196"
+    )
+    parser.add_argument(
+        "-i", dest="index_names", default="ndvi,ndmi,reip", help="Indices to benchmark, default ndvi,ndmi,reip"
+    )
+    parser.add_argument(
+        "-r", dest="resolution", default="", help="Resolution (Sentinel-2), default of every index"
+    )
+    parser.add_argument("-dtype", dest="dtype", default="float32", help="float64 or float32, default float32")
+    parser.add_argument(
+        "-n", dest="repeat", type=int, default=3, help="Runs per stage (best counts), default 3"
+    )
+    parser.add_argument(
+        "-tol", dest="tolerance", type=float, default=0.2, help="Tolerated slowdown (0.2 is 20%%), default 0.2"
+    )
+    parser.add_argument("-keep", dest="keep", default="false", help="Keep the synthetic scenes? Default false")
+    args = parser.parse_args()
+
+    history_file = os.path.abspath(HISTORY)
+    commit = git_commit()
+    rng = np.random.default_rng(0)
+    seconds = round(import_seconds(args.repeat), 3)
+    print("Importing the modules of main.py took {} s.".format(seconds))
+    records = [
+        {
+            "commit": commit,
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "cpus": os.cpu_count(),
+            "startup": True,
+            "import_s": seconds,
+        }
+    ]
+    for size in [int(size) for size in args.sizes.split(",")]:
+        root = tempfile.mkdtemp(prefix="index-calculator-bench-")
+        os.makedirs(root + "/results")
+        print("Generating synthetic scenes with {} x {} pixels (10 m) in {}...".format(size, size, root))
+        # per satellite the scenes with every layout of their files
+        scenes = {
+            "s2": {"": make_s2_scene(root, size, rng)},
+            "l8": {"tiled": make_l8_scene(root, size, rng), "stripped": make_l8_scene(root, size, rng, True)},
+        }
+        shape = make_shape(root, size)
+        for satellite in args.satellites.lower().split(","):
+            index_names = [
+                index_name
+                for index_name in args.index_names.lower().split(",")
+                if satellite in indices.INDICES[index_name]["bands"]
+            ]
+            for layout, clip in [(layout, clip) for layout in scenes[satellite] for clip in ["", shape]]:
+                case = {
+                    "root": root,
+                    "satellite": satellite,
+                    "scene": scenes[satellite][layout],
+                    "clip": clip,
+                    "index_names": index_names,
+                    "resolution": args.resolution if satellite == "s2" else "",
+                    "dtype": args.dtype,
+                    "repeat": args.repeat,
+                }
+                print(
+                    "...{} {}{} {}...".format(
+                        satellite,
+                        layout + " " if layout else "",
+                        "clipped" if clip else "whole scene",
+                        ", ".join(index_names),
+                    )
+                )
+                # a fresh process per case, so its peak RSS is its own
+                with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    measured = executor.submit(run_case, case).result()
+                record = {
+                    "commit": commit,
+                    "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "cpus": os.cpu_count(),
+                    "satellite": satellite,
+                    "layout": layout,
+                    "size": size,
+                    "clip": clip != "",
+                    "dtype": args.dtype,
+                    "resolution": case["resolution"],
+                    **measured,
+                }
+                records.append(record)
+                for index_name, stages in measured["indices"].items():
+                    print(
+                        "   {:6} ".format(index_name)
+                        + "  ".join(
+                            "{} {:8.2f} Mpix/s {:7.1f} MB".format(stage, values["mpix_s"], values["peak_mb"])
+                            for stage, values in stages.items()
+                        )
+                    )
+                print("   peak RSS {} MB".format(measured["rss_mb"]))
+        if args.keep.lower() not in ["y", "yes", "true"]:
+            shutil.rmtree(root)
+
+    history = []
+    if os.path.exists(history_file):
+        with open(history_file) as json_file:
+            history = [json.loads(line) for line in json_file if line.strip()]
+    slower = regressions(history, records, args.tolerance)
+    os.makedirs(os.path.dirname(history_file), exist_ok=True)
+    with open(history_file, "a") as json_file:
+        for record in records:
+            json_file.write(json.dumps(record) + "\n")
+    print("Results added to {}.".format(HISTORY))
+    if slower:
+        print(
+            "ERROR: {} stages got slower or used more memory or time than the tolerance:\n  {}".format(
+                len(slower), "\n  ".join(slower)
+            )
+        )
+        sys.exit(1)
+    print("...finished, no stage got slower and neither peak RSS nor import time grew.")
@@ -4,20 +4,25 @@
 
 
 import os
+import shutil
 
 
-retain = ["raster", "shapes", ".gitkeep", "ndmi_test.png"]
+retain = ["raster", "shapes", "benchmarks", ".gitkeep", "ndmi_test.png"]
 
 print("Cleaning up...")
 
-# deletes temp data
+# deletes temp data and the cache of decoded bands
 for item in os.listdir("./data/"):
-    if item not in retain:
+    if item == "cache":
+        shutil.rmtree("./data/cache/")
+    elif item not in retain:
         os.remove("./data/" + item)
 
-# empties results folder
+# empties results folder (Zarr arrays are folders)
 for item in os.listdir("./results/"):
-    if item not in retain:
+    if os.path.isdir("./results/" + item):
+        shutil.rmtree("./results/" + item)
+    elif item not in retain:
         os.remove("./results/" + item)
 
 print("...finished.")
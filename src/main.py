@@ -4,37 +4,109 @@
 
 
 from modules.chk_args import _check_input_arguments
-from modules.utils import index_calculator_l8, index_calculator_s2, plot_result, cleanup_temp
-from modules.writing import write_txt, write_raster, write_statistics
+from modules.utils import (
+    index_calculator_l8,
+    index_calculator_s2,
+    scene_batch_calculator,
+    time_series_calculator,
+    plot_result,
+    zonal_statistics,
+)
+from modules.writing import write_array, write_raster, write_statistics
+import modules.metrics as metrics
+import atexit
+import sys
 import time
 
 
 if __name__ == "__main__":
-    (
-        index_name,
-        clip_shape,
-        satellite,
-        resolution,
-        optional_val,
-        want_raster_saved,
-        want_plot,
-        want_plot_saved,
-        want_txt_saved,
-        want_statistics,
-    ) = _check_input_arguments()
+    args = _check_input_arguments()
+
+    # the metrics of the stages are saved and the profile printed whenever the program exits
+    metrics.start(args.profiler)
+    atexit.register(metrics.finish, args.metrics_format, args.profiler)
 
     starttime1 = time.time()
 
     raster_path = "./data/raster/"
+    # int16 results are calculated as float32 and scaled when they are written
+    read_options = {
+        "threads": args.threads,
+        "compute_threads": args.compute_threads,
+        "cache": args.cache_size,
+        "dtype": "float64" if args.dtype == "float64" else "float32",
+        "output": args.dtype,
+        "compress": args.compress,
+        "statistics": args.want_statistics == "true",
+        "resampling": args.resampling,
+        "clouds": args.want_clouds == "true",
+    }
+
+    if args.want_scenes == "true":
+        # every scene is calculated in its own process and streamed to ./results/{scene}_{index}.tif
+        print(
+            "Calculating {} for all scenes...".format(
+                ", ".join(index_name.upper() for index_name in args.index_names)
+            )
+        )
+        written = scene_batch_calculator(
+            args.satellite,
+            args.index_names,
+            args.resolution,
+            raster_path,
+            args.clip_shape,
+            args.optional_val,
+            args.workers,
+            read_options,
+        )
+        print(
+            f"...finished, {len(written)} files written. \nCalculating took {time.time() - starttime1:.2f} seconds."
+        )
+        sys.exit(0)
 
-    print("Calculating {}...".format(index_name.upper()))
-    if satellite in ["s2", "sentinel2", "sentinel"]:
-        result, calc_resolution = index_calculator_s2(
-            index_name, resolution, raster_path, clip_shape, optional_val
+    if args.want_series == "true":
+        # only scenes which are not in the time series of the indices yet are calculated and appended
+        print(
+            "Updating the time series of {}...".format(
+                ", ".join(index_name.upper() for index_name in args.index_names)
+            )
+        )
+        added = time_series_calculator(
+            args.satellite,
+            args.index_names,
+            args.resolution,
+            raster_path,
+            args.clip_shape,
+            args.optional_val,
+            read_options,
+        )
+        print(
+            f"...finished, {len(added)} scenes added. \nCalculating took {time.time() - starttime1:.2f} seconds."
         )
-    elif satellite in ["l8", "landsat8", "landsat"]:
-        result = index_calculator_l8(index_name, raster_path, clip_shape, optional_val)
-        calc_resolution = 30
+        sys.exit(0)
+
+    # when streaming, the results are written block by block to the tif-files instead of being returned
+    if args.want_stream == "true":
+        out_rasters = ["./results/{}.tif".format(index_name) for index_name in args.index_names]
+    else:
+        out_rasters = None
+
+    print("Calculating {}...".format(", ".join(index_name.upper() for index_name in args.index_names)))
+    if args.satellite in ["s2", "sentinel2", "sentinel"]:
+        results, calc_resolutions, profiles = index_calculator_s2(
+            args.index_names,
+            args.resolution,
+            raster_path,
+            args.clip_shape,
+            args.optional_val,
+            out_rasters,
+            read_options,
+        )
+    elif args.satellite in ["l8", "landsat8", "landsat"]:
+        results, profiles = index_calculator_l8(
+            args.index_names, raster_path, args.clip_shape, args.optional_val, out_rasters, read_options
+        )
+        calc_resolutions = [30] * len(args.index_names)
     else:
         print(
             "ERROR: Your specified satellite dataset cannot be used yet or doesn't exist.\n Please provide a valid request, check the README for a list of possible datasets."
@@ -43,33 +115,52 @@ if __name__ == "__main__":
     stoptime1 = time.time()
 
     # print out the information to user
-    print(
-        f"...finished calculating the {index_name.upper()} with a spatial resolution of {calc_resolution} m. \nCalculating took {stoptime1 - starttime1:.2f} seconds."
-    )
+    for index_name, calc_resolution in zip(args.index_names, calc_resolutions):
+        print(
+            f"...finished calculating the {index_name.upper()} with a spatial resolution of {calc_resolution} m."
+        )
+    print(f"Calculating took {stoptime1 - starttime1:.2f} seconds.")
+
+    if out_rasters is not None:
+        print("Results streamed to {}.".format(", ".join(out_rasters)))
 
-    # plot the result/ndarray
-    plot_result(index_name, result, calc_resolution, want_plot, want_plot_saved)
+    # plot the results/ndarrays
+    for index_name, result, calc_resolution in zip(args.index_names, results, calc_resolutions):
+        plot_result(index_name, result, calc_resolution, args.want_plot, args.want_plot_saved)
 
     starttime2 = time.time()
 
-    if any([want_txt_saved == "true", want_raster_saved == "true", want_statistics == "true"]):
+    if out_rasters is not None and args.want_statistics == "true":
+        print("\nStatistics are generated...")
+
+        # the streamed results are not in memory, their statistics were derived block by block
+        for index_name, result, calc_resolution in zip(args.index_names, results, calc_resolutions):
+            write_statistics(index_name, result, calc_resolution, args.want_statistics)
+
+    elif out_rasters is None and any(
+        [
+            args.want_txt_saved == "true",
+            args.want_raster_saved == "true",
+            args.want_statistics == "true",
+            args.want_zonal == "true",
+        ]
+    ):
         print("\nAdditional outputs are generated...")
 
-        # write txt file with results/ndarray
-        write_txt(index_name, result, want_txt_saved)
+        for index_name, result, calc_resolution, profile in zip(
+            args.index_names, results, calc_resolutions, profiles
+        ):
+            # save the results/ndarray as file (npy, zarr, parquet or txt)
+            write_array(index_name, result, args.want_txt_saved, args.array_format)
 
-        # export as raster tif-file
-        write_raster(index_name, calc_resolution, raster_path, clip_shape, want_raster_saved, result)
+            # export as raster tif-file
+            write_raster(index_name, profile, args.want_raster_saved, result)
 
-        # generate statistics (histogram & descriptives)
-        write_statistics(index_name, result, calc_resolution, want_statistics)
-
-        print("...cleaning up...")
-    else:
-        print("\nCleaning up...")
+            # generate statistics (histogram & descriptives)
+            write_statistics(index_name, result, calc_resolution, args.want_statistics)
 
-    # delete any temporary files, works only if the program finished entirely
-    cleanup_temp()
+            # generate statistics per feature of the shapefile
+            zonal_statistics(index_name, result, profile, args.clip_shape, args.want_zonal)
 
     stoptime2 = time.time()
 
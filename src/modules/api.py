@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Library interface: calculate indices without any interaction (no prompts or exits)"""
+
+
+import modules.indices as indices
+import modules.indices_l8 as indices_l8
+import modules.utils as utils
+import os
+
+
+def satellite_of(scene):
+    """Satellite of a scene from the name of its product folder: s2 (S*) or l8 (L*)"""
+    name = os.path.basename(os.path.normpath(scene))
+    if name.startswith("S"):
+        return "s2"
+    if name.startswith("L"):
+        return "l8"
+    raise ValueError("Unknown product '{}', expected a Sentinel-2 (S*) or Landsat 8/9 (L*) folder".format(name))
+
+
+def compute_index(scene, index, aoi="", resolution="", optional_val="", read_options=None):
+    """
+    Calculate one or several indices for a scene
+    param scene: path to the folder of a Sentinel-2 (S*) or Landsat 8/9 (L*) product
+    param index: name of the index (like "ndvi") or list of names, which share their bands
+    param aoi: shapefile the results are clipped to (name in ./data/shapes/ or path), "" for the whole scene
+    param resolution: spatial resolution for Sentinel-2 ("10", "20", "60"), "" for the default of every index
+    param optional_val: value replacing the optional values of the indices (like L of the SAVI), "" for defaults
+    param read_options: options for reading the bands (see modules.reading.read_rasters())
+    output: returns the index (Numpy array, np.nan outside of the aoi and for pixels without data) and the profile
+    of a GeoTIFF of it,
+    or lists of them if a list of names is given
+    raises ValueError for unknown scenes, indices or resolutions and RuntimeError if the calculation fails
+    """
+    index_names = [index] if isinstance(index, str) else list(index)
+    satellite = satellite_of(scene)
+    for index_name in index_names:
+        if index_name not in indices.INDICES or satellite not in indices.INDICES[index_name]["bands"]:
+            raise ValueError("Index '{}' is not available for {}".format(index_name, satellite))
+    resolution = str(resolution)
+    if satellite == "s2" and resolution not in ["", "10", "20", "60"]:
+        raise ValueError("Resolution '{}' is not available, use 10, 20 or 60".format(resolution))
+
+    try:
+        if satellite == "s2":
+            results, _, profiles = utils.scene_calculator_s2(
+                index_names, resolution, scene, aoi, optional_val, None, read_options
+            )
+        else:
+            results, profile = indices_l8.index_calc(index_names, scene, aoi, optional_val, None, read_options)
+            profiles = [profile] * len(index_names)
+    except Exception as err:
+        raise RuntimeError(
+            "Unable to calculate {} for {}: {}".format(", ".join(index_names), scene, err)
+        ) from err
+
+    if isinstance(index, str):
+        return results[0], profiles[0]
+    return results, profiles
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""On-disk cache of decoded bands (memory-mappable npy-files) with LRU eviction"""
+
+
+import glob
+import hashlib
+import os
+import threading
+import numpy as np
+
+
+CACHE_DIR = "./data/cache/"
+
+
+def cache_file(in_raster):
+    """
+    Path of the cached band of a raster file. The name contains the band and resolution (file name) and a key of
+    path, modification time and size, so a changed raster file is never served from an old cached band
+    """
+    stat = os.stat(in_raster)
+    key = "{}|{}|{}".format(os.path.abspath(in_raster), stat.st_mtime_ns, stat.st_size)
+    name = os.path.splitext(os.path.basename(in_raster))[0]
+    return CACHE_DIR + "{}_{}.npy".format(name, hashlib.sha1(key.encode()).hexdigest()[:16])
+
+
+def load(in_raster):
+    """Return the cached band of a raster file memory-mapped (read-only), or None if it is not cached"""
+    path = cache_file(in_raster)
+    try:
+        band = np.load(path, mmap_mode="r")
+        # the modification time of the cached file marks when it was used last (for the LRU eviction)
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return band
+
+
+def create(in_raster, shape, dtype):
+    """Return a new memory-mapped npy-file for the band of a raster file, which can be filled block by block"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # write to a temporary file first, so other processes never load a half-written band
+    temp = cache_file(in_raster) + ".{}_{}.tmp".format(os.getpid(), threading.get_ident())
+    return np.lib.format.open_memmap(temp, mode="w+", dtype=dtype, shape=shape)
+
+
+def finish(band, max_size):
+    """Add a band created with create() to the cache and evict the least recently used bands above max_size"""
+    band.flush()
+    temp = band.filename
+    del band
+    os.replace(temp, temp[: temp.rindex(".npy") + 4])
+    evict(max_size)
+
+
+def store(in_raster, band, max_size):
+    """Add the decoded band of a raster file to the cache, bands larger than the cache itself are skipped"""
+    if band.nbytes > max_size:
+        return
+    cached = create(in_raster, band.shape, band.dtype)
+    cached[:] = band
+    finish(cached, max_size)
+
+
+def evict(max_size):
+    """Delete the least recently used bands until the cache is not larger than max_size (bytes)"""
+    cached = []
+    for path in glob.glob(CACHE_DIR + "*.npy"):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        cached.append((stat.st_mtime, stat.st_size, path))
+    total = 0
+    for _, size, path in sorted(cached, reverse=True):
+        total += size
+        if total > max_size:
+            try:
+                os.remove(path)
+            except OSError:
+                # already deleted by another process
+                pass
@@ -3,12 +3,20 @@
 """Check arguments given with argparse"""
 
 
+import modules.indices as indices
+import modules.metrics as metrics
+import modules.writing as writing
+import os
 import sys
 import argparse
+from importlib.util import find_spec
 
 
 def _check_input_arguments():
-    """Some error-handling and interaction for the optional input values: clip raster to shapefile, index name, resolution, optional value (e.g. L in SAVI) and whether user wants to save the plot locally"""
+    """
+    Some error-handling and interaction for the optional input values: clip raster to shapefile, index name, resolution, optional value (e.g. L in SAVI) and whether user wants to save the plot locally.
+    Returns the checked values as argparse.Namespace (like index_names, want_plot, dtype)
+    """
     # Initialize argparse and specify the optional arguments
     help_msg = "Calculate indices with Sentinel-2 or Landsat 8 satellite imagery. You can use the following options to adapt the calculation to your needs. Have fun!"
     parser = argparse.ArgumentParser(description=help_msg, prefix_chars="-")
@@ -20,7 +28,7 @@ def _check_input_arguments():
         "-i",
         metavar="Index name",
         dest="index_name",
-        help="String | Choose which index gets calculated. Check the README for a list of possible indices.",
+        help="String | Choose which index gets calculated. Several indices can be calculated at once when separated by commas (like ndvi,ndwi,arvi), their bands are read only once. Check the README for a list of possible indices.",
         required=True,
     )
     optional_args.add_argument(
@@ -41,9 +49,16 @@ def _check_input_arguments():
         "-r",
         metavar="Resolution",
         dest="resolution",
-        help="Integer | When using Sentinel-2 datasets, the indices can be calculated with different resolutions (10, 20, 60 (m)). Default value: highest resolution possible",
+        help="Integer | When using Sentinel-2 datasets, the indices can be calculated with different resolutions (10, 20, 60 (m)). Bands which are not available with this resolution are resampled. Default value: highest resolution with all bands available",
         default="",
     )
+    optional_args.add_argument(
+        "-rs",
+        metavar="Resampling",
+        dest="resampling",
+        help="String | Method to resample bands which are not available with the resolution given with -r (nearest, bilinear, cubic, average). Default value: bilinear",
+        default="bilinear",
+    )
     optional_args.add_argument(
         "-ov",
         metavar="Optional value",
@@ -62,7 +77,7 @@ def _check_input_arguments():
         "-gp",
         metavar="Generate plot",
         dest="want_plot",
-        help="Boolean | Do you want to generate a plot? Use true/false. Default: true",
+        help="Boolean | Do you want to generate a plot? Without a display (like on servers) the plot is not shown, only saved with -sp. Use true/false. Default: true",
         default="true",
     )
     optional_args.add_argument(
@@ -76,9 +91,16 @@ def _check_input_arguments():
         "-txt",
         metavar="Save as txt",
         dest="want_txt_saved",
-        help="Boolean | Do you want to save the results/ndarray as txt-file locally to ./results/? Use true/false. Default: false",
+        help="Boolean | Do you want to save the results/ndarray as file locally to ./results/ (format chosen with -fmt)? Use true/false. Default: false",
         default="false",
     )
+    optional_args.add_argument(
+        "-fmt",
+        metavar="Format",
+        dest="array_format",
+        help="String | Format of the results/ndarray saved with -txt: npy (binary, memory-mappable), zarr (chunked and compressed, needs zarr), parquet (table of row, col and value of the valid pixels, needs pyarrow) or txt (slow for large arrays). Default: npy",
+        default="npy",
+    )
     optional_args.add_argument(
         "-stat",
         metavar="Statistics",
@@ -86,6 +108,97 @@ def _check_input_arguments():
         help="Boolean | Do you want to generate statistics (histogram & descriptive) for the results and save them locally to ./results/? Use true/false. Default: false",
         default="false",
     )
+    optional_args.add_argument(
+        "-stream",
+        metavar="Streaming",
+        dest="want_stream",
+        help="Boolean | Do you want to calculate the index block by block and stream it directly to a tif-file in ./results/? Keeps memory usage low for large scenes, but disables plot and txt (statistics are derived block by block). Use true/false. Default: false",
+        default="false",
+    )
+    optional_args.add_argument(
+        "-scenes",
+        metavar="Scene batch",
+        dest="want_scenes",
+        help="Boolean | Do you want to calculate the indices for every scene of the satellite in ./data/raster/ instead of only one? Each scene is calculated in its own process and streamed to ./results/{scene}_{index}.tif. Use true/false. Default: false",
+        default="false",
+    )
+    optional_args.add_argument(
+        "-series",
+        metavar="Time series",
+        dest="want_series",
+        help="Boolean | Do you want to add the indices of every scene in ./data/raster/ which is new to their time series in ./results/series/{index}_{satellite}_{res}m/ (with _{shapefile} for clips; datacube of all scenes with per-pixel count, mean, max and anomaly of every scene, updated scene by scene, and the median, recomputed from all scenes once per run)? Scenes already in the time series are not calculated again. Use true/false. Default: false",
+        default="false",
+    )
+    optional_args.add_argument(
+        "-w",
+        metavar="Workers",
+        dest="workers",
+        help="Integer | Number of processes calculating scenes at the same time in scene batch mode. Default: number of CPUs",
+        default="",
+    )
+    optional_args.add_argument(
+        "-t",
+        metavar="Threads",
+        dest="threads",
+        help="Integer | Number of bands decoded at the same time. GDAL uses the remaining CPUs to decode each band. Default: 1",
+        default="1",
+    )
+    optional_args.add_argument(
+        "-ct",
+        metavar="Compute threads",
+        dest="compute_threads",
+        help="Integer | Number of threads calculating the indices of a scene at the same time, each on its own chunks of rows (or blocks when streaming). Default: 1",
+        default="1",
+    )
+    optional_args.add_argument(
+        "-cache",
+        metavar="Cache size",
+        dest="cache_size",
+        help="Integer | Size (MB) of the cache in ./data/cache/ keeping decoded bands for the next runs on the same scene. The least recently used bands are deleted first. Uncompressed bands (like of many Landsat scenes) are memory-mapped instead of decoded and not cached, the operating system keeps them in memory. Default: 0 (no cache)",
+        default="0",
+    )
+    optional_args.add_argument(
+        "-dtype",
+        metavar="Data type",
+        dest="dtype",
+        help="String | Data type of the calculation and the exported tif-files: float64, float32 (half the memory and file size) or int16 (only normalized differences like the NDVI, calculated as float32 and stored as integers with the scale 0.0001 tagged). Default: float64",
+        default="float64",
+    )
+    optional_args.add_argument(
+        "-cog",
+        metavar="COG",
+        dest="compress",
+        help="String | Do you want to export the tif-files as Cloud-Optimized GeoTIFFs (tiled, compressed with predictor and overviews)? Use deflate, zstd or lzw for the compression (true is deflate) or false. Default: false",
+        default="false",
+    )
+    optional_args.add_argument(
+        "-zonal",
+        metavar="Zonal statistics",
+        dest="want_zonal",
+        help="Boolean | Do you want to generate statistics (count, mean, std.dev, min, max) for every feature of the shapefile given with -c and save them to ./results/{index}_zonal.csv? Use true/false. Default: false",
+        default="false",
+    )
+    optional_args.add_argument(
+        "-clouds",
+        metavar="Cloud masking",
+        dest="want_clouds",
+        help="Boolean | Do you want to mask clouds, cloud shadows and cirrus with the scene classification (SCL, Sentinel-2) or QA_PIXEL band (Landsat 8)? Masked pixels are np.nan and blocks without any other pixel are not calculated. Use true/false. Default: false",
+        default="false",
+    )
+    optional_args.add_argument(
+        "-metrics",
+        metavar="Metrics",
+        dest="metrics_format",
+        help="String | Do you want to save the duration, bytes, pixels and peak memory of every stage (read, clip, compute, write, stats, plot)? Use json (appended to ./results/metrics.jsonl), prom (Prometheus text file ./results/metrics.prom) or false. Default: false",
+        default="false",
+    )
+    optional_args.add_argument(
+        "-profile",
+        metavar="Profiler",
+        dest="profiler",
+        help="String | Do you want to profile the run? Use cprofile (functions which took the most time, saved to ./results/profile.pstats), tracemalloc (lines which allocated the most memory, adds the peak memory per stage to -metrics) or false. Default: false",
+        default="false",
+    )
     # show help dialog if no arguments are given
     if len(sys.argv) == 1:
         parser.print_help(sys.stderr)
@@ -96,46 +209,177 @@ def _check_input_arguments():
         args = parser.parse_args()
 
     # Assign arguments to variables and do some checks for error-handling
-    index_name = args.index_name.lower()
-    clip_shape = args.clip_shape
-    satellite = args.satellite.lower()
-    resolution = args.resolution
-    optional_val = args.optional_val
-    want_raster_saved = args.want_raster_saved.lower()
-    want_plot = args.want_plot.lower()
-    want_plot_saved = args.want_plot_saved.lower()
-    want_txt_saved = args.want_txt_saved.lower()
-    want_statistics = args.want_statistics.lower()
-
-    if clip_shape != "":
-        while clip_shape[-4] != "." and clip_shape[-3] != ".":
-            clip_shape = input("ERROR: Cannot read shapefile, please input a valid shapefile (like aoi.shp): ")
-
-    while resolution not in ["", "10", "20", "60"]:
+    index_names = _check_index_names(args.index_name, args.satellite.lower())
+    checked = argparse.Namespace(
+        index_names=index_names,
+        clip_shape=args.clip_shape,
+        satellite=args.satellite.lower(),
+        optional_val=abs(float(args.optional_val)) if args.optional_val != "" else "",
+        # the booleans are checked here, so the functions generating the outputs never wait for input
+        want_raster_saved=_check_boolean(
+            args.want_raster_saved, "Do you want to export the results as tif-file?"
+        ),
+        want_plot=_check_boolean(args.want_plot, "Do you want to generate a plot?"),
+        want_plot_saved=_check_boolean(args.want_plot_saved, "Do you want to save the plot as figure?"),
+        want_txt_saved=_check_boolean(
+            args.want_txt_saved, "Do you want to save the results/ndarray as file as well?"
+        ),
+        want_statistics=_check_boolean(args.want_statistics, "Do you want to generate statistics?"),
+        want_stream=_check_boolean(args.want_stream, "Do you want to stream the results to tif-files?"),
+        want_scenes=_check_boolean(args.want_scenes, "Do you want to calculate every scene?"),
+        want_series=_check_boolean(args.want_series, "Do you want to update the time series?"),
+        want_zonal=_check_boolean(
+            args.want_zonal, "Do you want to generate statistics per feature of the shapefile?"
+        ),
+        want_clouds=_check_boolean(args.want_clouds, "Do you want to mask clouds?"),
+        resolution=_check_choice(
+            args.resolution, ["", "10", "20", "60"], "resolution", "10, 20, 60; Sentinel-2 only"
+        ),
+        resampling=_check_choice(args.resampling, ["nearest", "bilinear", "cubic", "average"], "resampling"),
+        workers=_check_integer(args.workers, "number of workers") if args.workers != "" else os.cpu_count(),
+        threads=_check_integer(args.threads, "number of threads"),
+        compute_threads=_check_integer(args.compute_threads, "number of compute threads"),
+        cache_size=_check_integer(args.cache_size, "cache size", 0) * 1024 * 1024,
+        dtype=_check_dtype(args.dtype, index_names),
+        compress=_check_choice(args.compress, ["true", "false", "deflate", "zstd", "lzw"], "compression"),
+        array_format=_check_array_format(args.array_format),
+        metrics_format=_check_choice(
+            args.metrics_format, ["false"] + list(metrics.METRICS_FORMATS), "metrics format"
+        ),
+        profiler=_check_choice(args.profiler, ["false"] + metrics.PROFILERS, "profiler"),
+    )
+    checked.compress = {"true": "deflate", "false": ""}.get(checked.compress, checked.compress)
+
+    if checked.clip_shape != "":
+        while checked.clip_shape[-4] != "." and checked.clip_shape[-3] != ".":
+            checked.clip_shape = input(
+                "ERROR: Cannot read shapefile, please input a valid shapefile (like aoi.shp): "
+            )
+
+    if checked.satellite in ["l8", "landsat8", "landsat"]:
+        checked.resolution = 30
+
+    _check_combinations(checked)
+    return checked
+
+
+def _check_index_names(value, satellite):
+    """
+    Splits the comma-separated index names (each only once) and checks that all of them are declared in
+    modules.indices for the satellite, otherwise exits with the usual error message
+    """
+    index_names = []
+    for index_name in value.lower().split(","):
+        if index_name.strip() != "" and index_name.strip() not in index_names:
+            index_names.append(index_name.strip())
+    short = {"sentinel2": "s2", "sentinel": "s2", "landsat8": "l8", "landsat": "l8"}.get(satellite, satellite)
+    unknown = [
+        index_name
+        for index_name in index_names
+        if index_name not in indices.INDICES
+        or (short in ["s2", "l8"] and short not in indices.INDICES[index_name]["bands"])
+    ]
+    if unknown:
         print(
-            "ERROR: Your specified resolution cannot be used. Please provide a valid request (10, 20, 60; Sentinel-2 only)."
+            "ERROR: Your specified index cannot be calculated yet or doesn't exist ({}).\n Please provide a valid request, check the README for a list of possible indices.".format(
+                ", ".join(index_name.upper() for index_name in unknown)
+            )
         )
-        resolution = input("Enter the desired spatial resolution: ")
-
-    if satellite in ["l8", "landsat8", "landsat"]:
-        resolution = 30
+        sys.exit(0)
+    return index_names
 
-    if optional_val != "":
-        optional_val = abs(float(args.optional_val))
 
-    if want_plot == "false" and want_plot_saved == "true":
+def _check_combinations(checked):
+    """Changes the options which cannot be used together (see _check_input_arguments())"""
+    if checked.want_plot == "false" and checked.want_plot_saved == "true":
         print("ERROR: Changed -gp to true. You need to generate a plot to be able to save it.")
-        want_plot = "true"
-
-    return (
-        index_name,
-        clip_shape,
-        satellite,
-        resolution,
-        optional_val,
-        want_raster_saved,
-        want_plot,
-        want_plot_saved,
-        want_txt_saved,
-        want_statistics,
-    )
+        checked.want_plot = "true"
+
+    if checked.want_zonal == "true" and checked.clip_shape == "":
+        print("ERROR: Changed -zonal to false. Zonal statistics need a shapefile given with -c.")
+        checked.want_zonal = "false"
+
+    if checked.want_series == "true" and checked.want_scenes == "true":
+        print("ERROR: Changed -scenes to false. The time series is calculated scene by scene.")
+        checked.want_scenes = "false"
+
+    if checked.want_scenes == "true":
+        # scenes are always streamed to their tif-files
+        checked.want_stream = "true"
+
+    if checked.want_stream == "true":
+        # the plot is on by default, so only complain about outputs which were asked for explicitly
+        if "true" in [checked.want_plot_saved, checked.want_txt_saved, checked.want_zonal]:
+            print(
+                "ERROR: Changed -sp, -txt and -zonal to false. Streamed results are only written to a tif-file (and statistics)."
+            )
+        checked.want_plot, checked.want_plot_saved = "false", "false"
+        checked.want_txt_saved, checked.want_zonal = "false", "false"
+
+
+def _check_choice(value, choices, name, hint=None):
+    """Asks for the value until it is one of the choices (like the resampling), returns it in lower case"""
+    value = value.lower()
+    while value not in choices:
+        print(
+            "ERROR: Your specified {} cannot be used. Please provide a valid request ({}).".format(
+                name, hint or ", ".join(choice for choice in choices if choice not in ["", "true", "false"])
+            )
+        )
+        value = input("Enter the desired {}: ".format(name)).lower()
+    return value
+
+
+def _check_integer(value, name, minimum=1):
+    """Asks for the value until it is an integer of at least minimum (like the number of threads), returns it"""
+    while not value.isdigit() or int(value) < minimum:
+        print(
+            "ERROR: Your specified {} cannot be used. Please provide an integer of at least {}.".format(
+                name, minimum
+            )
+        )
+        value = input("Enter the desired {}: ".format(name))
+    return int(value)
+
+
+def _check_dtype(dtype, index_names):
+    """Asks for the data type until it is valid, int16 only for normalized differences (see indices.output_scale())"""
+    dtype = _check_choice(dtype, ["float64", "float32", "int16"], "data type")
+    unscaled = [name for name in index_names if name in indices.INDICES and indices.output_scale(name) is None]
+    while dtype == "int16" and unscaled:
+        print(
+            "ERROR: Only normalized differences can be stored as int16, not {}. Please provide float64 or float32.".format(
+                ", ".join(name.upper() for name in unscaled)
+            )
+        )
+        dtype = _check_choice(
+            input("Enter the desired data type: "), ["float64", "float32", "int16"], "data type"
+        )
+    return dtype
+
+
+def _check_array_format(array_format):
+    """Asks for the format of the saved arrays until it is valid, npy if the package of the format is missing"""
+    array_format = _check_choice(array_format, list(writing.ARRAY_FORMATS), "format")
+    package = writing.ARRAY_FORMATS[array_format]
+    if package is not None and find_spec(package) is None:
+        print(
+            "ERROR: Changed -fmt to npy. Saving as {} needs the package {} (pip install {}).".format(
+                array_format, package, package
+            )
+        )
+        array_format = "npy"
+    return array_format
+
+
+def _check_boolean(value, question):
+    """Asks the question until a valid answer is given (true/false or y/n), returns true or false"""
+    value = value.lower()
+    while value not in ["true", "false"]:
+        if value in ["y", "yes"]:
+            return "true"
+        if value in ["n", "no"]:
+            return "false"
+        print("ERROR: Please provide a valid input.")
+        value = input(question + " Use y/n: ").lower()
+    return value
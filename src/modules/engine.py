@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Engine to evaluate the index formulas as fused NumPy operations with preallocated buffers"""
+
+
+from concurrent.futures import ThreadPoolExecutor
+import ast
+import contextlib
+import operator
+import threading
+import numpy as np
+
+
+# The formulas of the registry are plain arithmetic expressions (like "(nir - red) / (nir + red)").
+# compile_formula() turns them once into a list of NumPy ufunc calls:
+# 1. constants and optional values are folded, so only the operations on bands are left
+# 2. identical subexpressions (like "(red - blue)" in the ARVI) are calculated only once
+# 3. every intermediate result gets a buffer, which is reused as soon as it is no longer needed
+# evaluate() then runs the ufuncs with out= into these buffers instead of allocating a new array per operation.
+# Only valid pixels are calculated (where= of the ufuncs): pixels which are np.nan in any band (outside of the clip,
+# nodata) or not valid in an optional mask (like clouds), and pixels a division by zero would end in. All other
+# pixels of the result are np.nan, so no warnings are raised and no infinite values reach statistics and plots.
+
+# rows of the chunks a scene is split into when it is calculated by several threads (see calculate_chunks())
+CHUNK_ROWS = 128
+
+# threads within reuse_buffers()
+_reuse = threading.local()
+
+_ARRAY_OPS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.divide,
+    ast.Pow: np.power,
+    ast.USub: np.negative,
+    ast.UAdd: np.positive,
+}
+_SCALAR_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Pow: operator.pow,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+
+def compile_formula(formula, band_names, values=None):
+    """
+    Compile a formula into a program of ufunc calls
+    param formula: arithmetic expression of band names, optional values and numbers (string)
+    param band_names: names in the formula which are bands (iterable)
+    param values: scalar values for the remaining names, like the L-value of the SAVI (dict)
+    output: returns the program (dict) with the used bands, the steps and the number of buffers
+    """
+    context = {"formula": formula, "bands": set(band_names), "values": values or {}, "steps": [], "known": {}}
+    steps = context["steps"]
+    root = _visit(ast.parse(formula, mode="eval").body, context)
+    if isinstance(root, float):
+        raise ValueError("Formula '{}' does not use any band".format(formula))
+    if root[0] == "band":
+        # a single band is copied into the output
+        steps.append((np.positive, (root,)))
+
+    program_steps, n_buffers = _assign_buffers(steps)
+    used_bands = sorted(
+        {
+            operand[1]
+            for _, operands in steps
+            for operand in operands
+            if isinstance(operand, tuple) and operand[0] == "band"
+        }
+    )
+    return {"formula": formula, "bands": used_bands, "steps": program_steps, "n_buffers": n_buffers}
+
+
+def _visit(node, context):
+    """
+    Turn a node of the formula into steps (context["steps"], identical subexpressions only once)
+    output: returns a float for constant parts, otherwise a reference like ("band", "nir") or ("step", 3)
+    """
+    formula = context["formula"]
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return float(node.value)
+    if isinstance(node, ast.Name):
+        if node.id in context["bands"]:
+            return ("band", node.id)
+        if node.id in context["values"]:
+            return float(context["values"][node.id])
+        raise ValueError("Unknown name '{}' in formula '{}'".format(node.id, formula))
+    if isinstance(node, ast.BinOp) and type(node.op) in _ARRAY_OPS:
+        operands = (_visit(node.left, context), _visit(node.right, context))
+    elif isinstance(node, ast.UnaryOp) and type(node.op) in _ARRAY_OPS:
+        operands = (_visit(node.operand, context),)
+    else:
+        raise ValueError("Unsupported expression in formula '{}'".format(formula))
+    if all(isinstance(operand, float) for operand in operands):
+        return _SCALAR_OPS[type(node.op)](*operands)
+    key = (type(node.op),) + operands
+    if key not in context["known"]:
+        context["steps"].append((_ARRAY_OPS[type(node.op)], operands))
+        context["known"][key] = ("step", len(context["steps"]) - 1)
+    return context["known"][key]
+
+
+def _assign_buffers(steps):
+    """
+    Assign buffers to the steps: the last step writes into the output, all others into buffers which are reused
+    as soon as their result was used for the last time
+    output: returns the steps with their operands and buffers resolved and the number of buffers
+    """
+    # find the step in which every intermediate result is used for the last time
+    last_use = {}
+    for i, (_, operands) in enumerate(steps):
+        for operand in operands:
+            if isinstance(operand, tuple) and operand[0] == "step":
+                last_use[operand[1]] = i
+
+    slots = {}
+    free = []
+    n_buffers = 0
+    program_steps = []
+    for i, (ufunc, operands) in enumerate(steps):
+        resolved = []
+        for operand in operands:
+            if isinstance(operand, tuple) and operand[0] == "step":
+                resolved.append(("buffer", slots[operand[1]]))
+                if last_use[operand[1]] == i and slots[operand[1]] not in free:
+                    free.append(slots[operand[1]])
+            else:
+                resolved.append(operand)
+        if i == len(steps) - 1:
+            slot = None
+        elif free:
+            slot = free.pop()
+        else:
+            slot = n_buffers
+            n_buffers += 1
+        slots[i] = slot
+        program_steps.append((ufunc, tuple(resolved), slot))
+    return program_steps, n_buffers
+
+
+def evaluate(program, bands, out=None, buffers=None, valid=None, masks=None):
+    """
+    Evaluate a compiled program
+    param bands: arrays of the bands in the order of program["bands"] (list) or by name (dict)
+    param out: array the result is written into, allocated if not given
+    param buffers: arrays for the intermediate results (list of program["n_buffers"] arrays), allocated if not given
+    param valid: boolean array of the pixels which may be calculated (like cloud-free), all if not given
+    param masks: two boolean arrays for the mask of the valid pixels, allocated if not given
+    output: returns the result as Numpy array, np.nan where a pixel is not valid
+    """
+    if not isinstance(bands, dict):
+        bands = dict(zip(program["bands"], bands))
+    shape = np.broadcast_shapes(*(band.shape for band in bands.values()))
+    dtype = float_dtype(*bands.values())
+    if out is None:
+        out = np.empty(shape, dtype)
+    if buffers is None:
+        buffers = [np.empty(shape, dtype) for _ in range(program["n_buffers"])]
+    if masks is None:
+        masks = [np.empty(shape, bool), np.empty(shape, bool)]
+    mask, scratch = masks
+
+    # pixels are valid where all bands are finite (and the optional mask is true)
+    mask.fill(True)
+    for band in bands.values():
+        np.isfinite(band, out=scratch)
+        np.logical_and(mask, scratch, out=mask)
+    if valid is not None:
+        np.logical_and(mask, valid, out=mask)
+    # blocks without invalid pixels are calculated by the faster unmasked loops
+    complete = bool(mask.all())
+
+    for ufunc, operands, slot in program["steps"]:
+        args = []
+        for operand in operands:
+            if isinstance(operand, float):
+                args.append(operand)
+            elif operand[0] == "band":
+                args.append(bands[operand[1]])
+            else:
+                args.append(buffers[operand[1]])
+        if ufunc is np.divide and not (isinstance(args[1], float) and args[1] != 0):
+            # pixels divided by zero are not valid
+            np.not_equal(args[1], 0, out=scratch)
+            if not scratch.all():
+                np.logical_and(mask, scratch, out=mask)
+                complete = False
+        ufunc(*args, out=out if slot is None else buffers[slot], where=True if complete else mask)
+    if not complete:
+        np.logical_not(mask, out=scratch)
+        np.copyto(out, np.nan, where=scratch)
+    return out
+
+
+@contextlib.contextmanager
+def reuse_buffers():
+    """Let the kernels called by this thread keep their buffers per block shape (see kernel())"""
+    previous = getattr(_reuse, "buffers", False)
+    _reuse.buffers = True
+    try:
+        yield
+    finally:
+        _reuse.buffers = previous
+
+
+def kernel(program):
+    """
+    Return a function calculating the program from band arrays (in the order of program["bands"]) and an optional
+    mask of valid pixels. Within reuse_buffers() (blocks of a streamed scene or chunks of rows) the buffers for
+    intermediate results and masks are allocated once per block shape and thread and reused afterwards, so the
+    function can be called by several threads at once. Otherwise (whole arrays) the buffers are allocated per
+    call, so they are released as soon as the index is calculated
+    """
+    local = threading.local()
+
+    def calculate(*bands, out=None, valid=None):
+        if not getattr(_reuse, "buffers", False):
+            return evaluate(program, bands, out=out, valid=valid)
+        shape = bands[0].shape
+        dtype = float_dtype(*bands)
+        if not hasattr(local, "workspace"):
+            local.workspace = {}
+        workspace = local.workspace
+        if (shape, dtype) not in workspace:
+            workspace[(shape, dtype)] = (
+                [np.empty(shape, dtype) for _ in range(program["n_buffers"])],
+                [np.empty(shape, bool), np.empty(shape, bool)],
+            )
+        buffers, masks = workspace[(shape, dtype)]
+        return evaluate(program, bands, out=out, buffers=buffers, valid=valid, masks=masks)
+
+    return calculate
+
+
+def calculate_chunks(calculate, bands, valid=None, threads=1, rows=CHUNK_ROWS):
+    """
+    Calculate a function returned by kernel() chunk by chunk of rows on a pool of threads. Every thread reads
+    its rows of the bands and writes into its rows of one shared result, so no array is copied: NumPy releases
+    the GIL in its loops, so the chunks are calculated in parallel
+    param bands: arrays of the bands (list), like for the function
+    param valid: boolean array of the pixels which may be calculated, all if not given
+    param threads: number of threads calculating chunks at the same time
+    param rows: number of rows of every chunk (small enough for its buffers to stay in the caches of the CPU)
+    output: returns the result as Numpy array
+    """
+    shape = np.broadcast_shapes(*(band.shape for band in bands))
+    out = np.empty(shape, float_dtype(*bands))
+
+    def calculate_chunk(row):
+        chunk = slice(row, row + rows)
+        with reuse_buffers():
+            calculate(
+                *[band[chunk] for band in bands],
+                out=out[chunk],
+                valid=None if valid is None else valid[chunk],
+            )
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(calculate_chunk, range(0, shape[0], rows)))
+    return out
+
+
+def float_dtype(*arrays):
+    """Return the floating point type the arrays are calculated with (float64 for integer arrays)"""
+    dtype = np.result_type(*arrays)
+    if not np.issubdtype(dtype, np.floating):
+        dtype = np.dtype("float64")
+    return dtype
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Registry of the available indices (bands, formula, optional values, resolutions, plot range)"""
+
+
+import modules.engine as engine
+import re
+
+# Every index is declared once with:
+# - name: full name of the index
+# - formula: arithmetic expression of the band names and optional values (evaluated by modules.engine)
+# - bands: per satellite ("s2", "l8") the band behind every name in the formula.
+#   For Sentinel-2, B08 is only available with 10 m and is replaced by B8A with 20 and 60 m
+# - optional: optional values with their default (as in literature), can be changed with -ov
+# - resolutions: spatial resolutions of Sentinel-2 with all bands available, the first one is the default.
+#   With other resolutions the coarser bands are resampled
+# - range: range of values of the index
+# - plot: colormap and limits which show the results best
+
+INDICES = {
+    "arvi": {
+        "name": "Atmospherically Resistant Vegetation Index",
+        "formula": "(nir - red - L * (red - blue)) / (nir + red - L * (red - blue))",
+        "bands": {
+            "s2": {"blue": "B02", "red": "B04", "nir": "B08"},
+            "l8": {"blue": "B2", "red": "B4", "nir": "B5"},
+        },
+        "optional": {"L": 2},
+        "resolutions": ["10", "20", "60"],
+        "range": (-1, 1),
+        "plot": {"cmap": "RdYlGn", "clim": (-0.2, 0.8)},
+    },
+    "gci": {
+        "name": "Green Chlorophyll Vegetation Index",
+        "formula": "nir / green - 1",
+        "bands": {
+            "s2": {"green": "B03", "nir": "B08"},
+            "l8": {"green": "B3", "nir": "B5"},
+        },
+        "optional": {},
+        "resolutions": ["10", "20", "60"],
+        "range": (0, 2),
+        "plot": {"cmap": "Greens", "clim": (0, 1.1)},
+    },
+    "gndvi": {
+        "name": "Green Normalized Difference Vegetation Index",
+        "formula": "(nir - green) / (nir + green)",
+        "bands": {
+            "s2": {"green": "B03", "nir": "B09"},
+        },
+        "optional": {},
+        "resolutions": ["60"],
+        "range": (-1, 1),
+        "plot": {"cmap": "RdYlGn", "clim": (-0.15, 0.45)},
+    },
+    "nbr": {
+        "name": "Normalized Burn Ratio",
+        "formula": "(nir - swir2) / (nir + swir2)",
+        "bands": {
+            "s2": {"nir": "B8A", "swir2": "B12"},
+            "l8": {"nir": "B5", "swir2": "B7"},
+        },
+        "optional": {},
+        "resolutions": ["20", "60"],
+        "range": (-1, 1),
+        "plot": {"cmap": "RdYlGn", "clim": (-1, 1)},
+    },
+    "nbr2": {
+        "name": "Normalized Burn Ratio 2",
+        "formula": "(swir1 - swir2) / (swir1 + swir2)",
+        "bands": {
+            "s2": {"swir1": "B11", "swir2": "B12"},
+            "l8": {"swir1": "B6", "swir2": "B7"},
+        },
+        "optional": {},
+        "resolutions": ["20", "60"],
+        "range": (-1, 1),
+        "plot": {"cmap": "RdYlGn", "clim": (-1, 1)},
+    },
+    "ndbi": {
+        "name": "Normalized Difference Build-up Index",
+        "formula": "(swir1 - nir) / (swir1 + nir)",
+        "bands": {
+            "s2": {"nir": "B8A", "swir1": "B11"},
+            "l8": {"nir": "B5", "swir1": "B6"},
+        },
+        "optional": {},
+        "resolutions": ["20", "60"],
+        "range": (-1, 1),
+        "plot": {"cmap": "BrBG", "clim": (-0.1, 0.1)},
+    },
+    "ndmi": {
+        "name": "Normalized Difference Moisture Index",
+        "formula": "(nir - swir1) / (nir + swir1)",
+        "bands": {
+            "s2": {"nir": "B8A", "swir1": "B11"},
+            "l8": {"nir": "B5", "swir1": "B6"},
+        },
+        "optional": {},
+        "resolutions": ["20", "60"],
+        "range": (-1, 1),
+        "plot": {"cmap": "jet_r", "clim": (-0.2, 0.4)},
+    },
+    "ndre": {
+        "name": "Normalized Difference Red-Edge Vegetation Index",
+        "formula": "(nir - rededge) / (nir + rededge)",
+        "bands": {
+            "s2": {"rededge": "B05", "nir": "B8A"},
+        },
+        "optional": {},
+        "resolutions": ["20", "60"],
+        "range": (-1, 1),
+        "plot": {"cmap": "RdYlGn", "clim": (-0.15, 0.45)},
+    },
+    "ndsi": {
+        "name": "Normalized Difference Snow Index",
+        "formula": "(green - swir1) / (green + swir1)",
+        "bands": {
+            "s2": {"green": "B03", "swir1": "B11"},
+            "l8": {"green": "B3", "swir1": "B6"},
+        },
+        "optional": {},
+        "resolutions": ["20", "60"],
+        "range": (-1, 1),
+        "plot": {"cmap": "Blues", "clim": (0.2, 0.42)},
+    },
+    "ndvi": {
+        "name": "Normalized Difference Vegetation Index",
+        "formula": "(nir - red) / (nir + red)",
+        "bands": {
+            "s2": {"red": "B04", "nir": "B08"},
+            "l8": {"red": "B4", "nir": "B5"},
+        },
+        "optional": {},
+        "resolutions": ["10", "20", "60"],
+        "range": (-1, 1),
+        "plot": {"cmap": "RdYlGn", "clim": (-0.15, 0.45)},
+    },
+    "ndwi": {
+        "name": "Normalized Difference Water Index",
+        "formula": "(green - nir) / (green + nir)",
+        "bands": {
+            "s2": {"green": "B03", "nir": "B08"},
+            "l8": {"green": "B3", "nir": "B5"},
+        },
+        "optional": {},
+        "resolutions": ["10", "20", "60"],
+        "range": (-1, 1),
+        "plot": {"cmap": "BrBG", "clim": (-0.1, 0.1)},
+    },
+    "reip": {
+        "name": "Red-Edge Inflection Point",
+        "formula": "700 + 40 * ((red + rededge3) / 2 - rededge1) / (rededge2 - rededge1)",
+        "bands": {
+            "s2": {"red": "B04", "rededge1": "B05", "rededge2": "B06", "rededge3": "B07"},
+        },
+        "optional": {},
+        "resolutions": ["20", "60"],
+        "range": (700, 740),
+        "plot": {"cmap": "Greens", "clim": (700, 740)},
+    },
+    "savi": {
+        "name": "Soil-Adjusted Vegetation Index",
+        "formula": "(nir - red) / (nir + red + L) * (1 + L)",
+        "bands": {
+            "s2": {"red": "B04", "nir": "B08"},
+            "l8": {"red": "B4", "nir": "B5"},
+        },
+        "optional": {"L": 0.5},
+        "resolutions": ["10", "20", "60"],
+        "range": (-1, 1),
+        "plot": {"cmap": "RdYlGn", "clim": (-0.15, 0.45)},
+    },
+    "sipi": {
+        "name": "Structure Intensive Pigment Vegetation Index",
+        "formula": "(nir - blue) / (nir - red)",
+        "bands": {
+            "s2": {"blue": "B02", "red": "B04", "nir": "B08"},
+            "l8": {"blue": "B2", "red": "B4", "nir": "B5"},
+        },
+        "optional": {},
+        "resolutions": ["10", "20", "60"],
+        "range": (0, 2),
+        "plot": {"cmap": "Greens", "clim": (0.7, 1.8)},
+    },
+}
+
+
+def optional_values(index_name, optional_val):
+    """Returns the optional values of an index, the defaults are replaced by the value given with -ov"""
+    values = dict(INDICES[index_name]["optional"])
+    if optional_val != "":
+        for key in values:
+            values[key] = optional_val
+    return values
+
+
+def is_normalized_difference(index_name):
+    """Check if an index is a normalized difference of two bands, like (nir - red) / (nir + red), bound to -1..1"""
+    return re.fullmatch(r"\((\w+) - (\w+)\) / \(\1 \+ \2\)", INDICES[index_name]["formula"]) is not None
+
+
+def output_scale(index_name):
+    """
+    Scale and offset of an index stored as scaled int16: the range -1..1 of normalized differences is mapped to
+    -10000..10000, so they keep four decimals.
+    Other indices (like the GCI or SIPI) are not bound to their range and are not stored as int16 (None)
+    """
+    if not is_normalized_difference(index_name):
+        return None
+    low, high = INDICES[index_name]["range"]
+    return (high - low) / 20000, (high + low) / 2
+
+
+def index_formulas(index_names, satellite, optional_val, find_band):
+    """
+    Compile the formulas of several indices and collect the files of their bands
+    param satellite: key of the bands in the registry ("s2", "l8")
+    param find_band: function returning the path to the file of a band
+    output: returns the paths to all needed files, every file only once (list),
+    and per index the compiled function and the positions of its bands in these paths (list of tuples)
+    """
+    band_paths = []
+    formulas = []
+    for index_name in index_names:
+        bands = INDICES[index_name]["bands"][satellite]
+        program = engine.compile_formula(
+            INDICES[index_name]["formula"], bands, optional_values(index_name, optional_val)
+        )
+        positions = []
+        for name in program["bands"]:
+            path = find_band(bands[name])
+            if path not in band_paths:
+                band_paths.append(path)
+            positions.append(band_paths.index(path))
+        formulas.append((engine.kernel(program), positions))
+    return band_paths, formulas
@@ -3,154 +3,106 @@
 """Functions to calculate the indices for Landsat 8/9 images"""
 
 
+import modules.indices as indices
+import modules.manifest as manifest
 import modules.reading as reading
 import glob
-
-
-# The functions all have the same structure:
-# 1. handle resolution and/or optional_val input
-# 2. look for files with specific bands in their names using glob.glob and *
-# 3. parse the path to the files into read_raster() with clip information
-# 4. calculate index with read rasterfiles and return the index as ndarray next to the final resolution
-
-
-def arvi_calc(raster_path, clip_shape, optional_val):
-    """Calculation of the ARVI"""
-    if optional_val == "":
-        optional_val = 2
-    for item in glob.glob(raster_path + "L*/*_B5.tif"):
-        b5_path = item
-    for item in glob.glob(raster_path + "L*/*_B2.tif"):
-        b2_path = item
-    for item in glob.glob(raster_path + "L*/*_B4.tif"):
-        b4_path = item
-    b2 = reading.read_raster(b2_path, clip_shape)
-    b4 = reading.read_raster(b4_path, clip_shape)
-    b5 = reading.read_raster(b5_path, clip_shape)
-    arvi = (b5 - b4 - optional_val * (b4 - b2)) / (b5 + b4 - optional_val * (b4 - b2))
-    return arvi
-
-
-def gci_calc(raster_path, clip_shape):
-    """Calculation of the GCI"""
-    for item in glob.glob(raster_path + "L*/*_B5.tif"):
-        b5_path = item
-    for item in glob.glob(raster_path + "L*/*_B3.tif"):
-        b3_path = item
-    b3 = reading.read_raster(b3_path, clip_shape)
-    b5 = reading.read_raster(b5_path, clip_shape)
-    gci = b5 / b3 - 1
-    return gci
-
-
-def nbr_calc(raster_path, clip_shape):
-    """Calculation of the NBR"""
-    for item in glob.glob(raster_path + "L*/*_B5.tif"):
-        b5_path = item
-    for item in glob.glob(raster_path + "L*/*_B7.tif"):
-        b7_path = item
-    b5 = reading.read_raster(b5_path, clip_shape)
-    b7 = reading.read_raster(b7_path, clip_shape)
-    nbr = (b5 - b7) / (b5 + b7)
-    return nbr
-
-
-def nbr2_calc(raster_path, clip_shape):
-    """Calculation of the NBR2"""
-    for item in glob.glob(raster_path + "L*/*_B6.tif"):
-        b6_path = item
-    for item in glob.glob(raster_path + "L*/*_B7.tif"):
-        b7_path = item
-    b6 = reading.read_raster(b6_path, clip_shape)
-    b7 = reading.read_raster(b7_path, clip_shape)
-    nbr2 = (b6 - b7) / (b6 + b7)
-    return nbr2
-
-
-def ndbi_calc(raster_path, clip_shape):
-    """Calculation of the NDBI"""
-    for item in glob.glob(raster_path + "L*/*_B5.tif"):
-        b5_path = item
-    for item in glob.glob(raster_path + "L*/*_B6.tif"):
-        b6_path = item
-    b5 = reading.read_raster(b5_path, clip_shape)
-    b6 = reading.read_raster(b6_path, clip_shape)
-    ndbi = (b6 - b5) / (b6 + b5)
-    return ndbi
-
-
-def ndmi_calc(raster_path, clip_shape):
-    """Calculation of the NDMI"""
-    for item in glob.glob(raster_path + "L*/*_B5.tif"):
-        b5_path = item
-    for item in glob.glob(raster_path + "L*/*_B6.tif"):
-        b6_path = item
-    b5 = reading.read_raster(b5_path, clip_shape)
-    b6 = reading.read_raster(b6_path, clip_shape)
-    ndmi = (b5 - b6) / (b5 + b6)
-    return ndmi
-
-
-def ndsi_calc(raster_path, clip_shape):
-    """Calculation of the NDSI"""
-    for item in glob.glob(raster_path + "L*/*_B3.tif"):
-        b3_path = item
-    for item in glob.glob(raster_path + "L*/*_B6.tif"):
-        b6_path = item
-    b3 = reading.read_raster(b3_path, clip_shape)
-    b6 = reading.read_raster(b6_path, clip_shape)
-    ndsi = (b3 - b6) / (b3 + b6)
-    return ndsi
-
-
-def ndvi_calc(raster_path, clip_shape):
-    """Calculation of the NDVI"""
-    for item in glob.glob(raster_path + "L*/*_B5.tif"):
-        b5_path = item
-    for item in glob.glob(raster_path + "L*/*_B4.tif"):
-        b4_path = item
-    b4 = reading.read_raster(b4_path, clip_shape)
-    b5 = reading.read_raster(b5_path, clip_shape)
-    ndvi = (b5 - b4) / (b5 + b4)
-    return ndvi
-
-
-def ndwi_calc(raster_path, clip_shape):
-    """Calculation of the NDWI"""
-    for item in glob.glob(raster_path + "L*/*_B5.tif"):
-        b5_path = item
-    for item in glob.glob(raster_path + "L*/*_B3.tif"):
-        b3_path = item
-    b3 = reading.read_raster(b3_path, clip_shape)
-    b5 = reading.read_raster(b5_path, clip_shape)
-    ndwi = (b3 - b5) / (b3 + b5)
-    return ndwi
-
-
-def savi_calc(raster_path, clip_shape, optional_val):
-    """Calculation of the SAVI"""
-    if optional_val == "":
-        optional_val = 0.5
-    for item in glob.glob(raster_path + "L*/*_B5.tif"):
-        b5_path = item
-    for item in glob.glob(raster_path + "L*/*_B4.tif"):
-        b4_path = item
-    b4 = reading.read_raster(b4_path, clip_shape)
-    b5 = reading.read_raster(b5_path, clip_shape)
-    savi = ((b5 - b4) / (b5 + b4 + optional_val)) * (1 + optional_val)
-    return savi
-
-
-def sipi_calc(raster_path, clip_shape):
-    """Calculation of the SIPI"""
-    for item in glob.glob(raster_path + "L*/*_B5.tif"):
-        b5_path = item
-    for item in glob.glob(raster_path + "L*/*_B2.tif"):
-        b2_path = item
-    for item in glob.glob(raster_path + "L*/*_B4.tif"):
-        b4_path = item
-    b2 = reading.read_raster(b2_path, clip_shape)
-    b4 = reading.read_raster(b4_path, clip_shape)
-    b5 = reading.read_raster(b5_path, clip_shape)
-    sipi = (b5 - b2) / (b5 - b4)
-    return sipi
+import os
+
+
+# bits of the QA_PIXEL band masked with cloud masking: fill (bit 0), dilated cloud (1), cirrus (2), cloud (3)
+# and cloud shadow (4)
+QA_PIXEL_BITS = 0b11111
+
+# groups of the metadata (MTL) with the scale and offset converting the bands to reflectance: surface reflectance
+# of Level-2 products (bands SR_B1 to SR_B7) and top of atmosphere reflectance of Level-1 products (bands B1 to B9)
+MTL_GROUPS = {"LEVEL2_SURFACE_REFLECTANCE_PARAMETERS": "SR_B", "LEVEL1_RADIOMETRIC_RESCALING": "B"}
+
+
+def find_scenes(raster_path):
+    """Look for all Landsat 8/9 products (L*) in the raster folder"""
+    return sorted(item for item in glob.glob(raster_path + "L*") if os.path.isdir(item))
+
+
+def scene_date(scene):
+    """Acquisition date (YYYYMMDD) from the product name, like LC08_L2SP_195026_20220705_..."""
+    return os.path.basename(scene).split("_")[3]
+
+
+def scan(scene):
+    """
+    Look for the files of the bands of a scene ({scene}_{band}.tif, like the band SR_B4 or QA_PIXEL)
+    output: returns the folder with the files and the path to the file of every band (resolution 30 m)
+    """
+    prefix = os.path.basename(os.path.normpath(scene)) + "_"
+    files = {}
+    for name in sorted(os.listdir(scene)):
+        if name.lower().endswith(".tif") and name.startswith(prefix):
+            files[name[len(prefix) : -4]] = scene + "/" + name
+    return [scene], {"30": files}
+
+
+def reflectance(scene):
+    """
+    Scale and offset of the bands from the metadata of a scene ({scene}_MTL.txt), like 0.0000275 and -0.2
+    for the surface reflectance of Collection 2 Level-2 products
+    output: returns per band the scale and offset (dict of lists), empty without metadata
+    """
+    groups = {}
+    group = None
+    mtl_files = glob.glob(os.path.normpath(scene) + "/*_MTL.txt")
+    if not mtl_files:
+        return {}
+    with open(mtl_files[0]) as mtl_file:
+        for line in mtl_file:
+            key, _, value = (part.strip() for part in line.partition("="))
+            if key == "GROUP":
+                group = value
+            elif group in MTL_GROUPS and key.startswith(("REFLECTANCE_MULT_BAND_", "REFLECTANCE_ADD_BAND_")):
+                band = MTL_GROUPS[group] + key.rsplit("_", 1)[1]
+                scale = groups.setdefault(group, {}).setdefault(band, [1.0, 0.0])
+                scale[0 if "_MULT_" in key else 1] = float(value)
+    # the bands of Level-2 products are surface reflectance, so its group is preferred
+    for group in MTL_GROUPS:
+        if group in groups:
+            return groups[group]
+    return {}
+
+
+def load_manifest(scene):
+    """Manifest of a scene (see modules.manifest.load())"""
+    return manifest.load(scene, scan, scene_date(scene), reflectance)
+
+
+def band_path(scene, band):
+    """Look up the file of a band of a scene (like B4 for SR_B4) in the manifest of the scene"""
+    bands = load_manifest(scene)["bands"]["30"]
+    for name, entry in bands.items():
+        if name == band or name.endswith("_" + band):
+            return entry["path"]
+
+
+def cloud_mask(scene):
+    """Cloud mask of a scene: the file of its QA_PIXEL band and the bits which mask a pixel"""
+    path = band_path(scene, "QA_PIXEL")
+    if path is None:
+        raise RuntimeError("Unable to mask clouds, there is no QA_PIXEL band in {}".format(scene))
+    return {"path": path, "bits": QA_PIXEL_BITS}
+
+
+def index_calc(index_names, scene, clip_shape, optional_val, out_rasters=None, read_options=None):
+    """
+    Calculation of indices declared in modules.indices for one scene:
+    the files of the used bands are parsed into calc_indices() which reads each of them only once
+    (whole or, if out_rasters are given, streamed block by block into out_rasters).
+    Returns the indices as list of ndarrays (if streamed their statistics with read_options["statistics"],
+    otherwise None) next to the profile of a GeoTIFF of them
+    """
+    band_paths, formulas = indices.index_formulas(
+        index_names, "l8", optional_val, lambda band: band_path(scene, band)
+    )
+    # the bands are converted to reflectance while they are read
+    read_options = dict(read_options or {}, scales=manifest.band_scales(load_manifest(scene)))
+    if read_options.get("clouds"):
+        read_options["mask"] = cloud_mask(scene)
+    return reading.calc_scene_indices(index_names, band_paths, clip_shape, formulas, out_rasters, read_options)
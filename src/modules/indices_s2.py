@@ -3,220 +3,117 @@
 """Functions to calculate the indices for Sentinel 2 images"""
 
 
+import modules.indices as indices
+import modules.manifest as manifest
 import modules.reading as reading
 import glob
-
-
-# The functions all have the same structure:
-# 1. handle resolution and/or optional_val input
-# 2. look for files with specific bands in their names using glob.glob and *
-# 3. parse the path to the files into read_raster() with clip information
-# 4. calculate index with read rasterfiles and return the index as ndarray next to the final resolution
-
-
-def arvi_calc(resolution, raster_path, clip_shape, optional_val):
-    """Calculation of the ARVI"""
-    if optional_val == "":
-        optional_val = 2
-    if resolution == "10":
-        for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B08*.jp2"):
-            b8_path = item
-    elif resolution != "10":
-        for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B8A*.jp2"):
-            b8_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B02*.jp2"):
-        b2_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B04*.jp2"):
-        b4_path = item
-    b2 = reading.read_raster(b2_path, clip_shape)
-    b4 = reading.read_raster(b4_path, clip_shape)
-    b8 = reading.read_raster(b8_path, clip_shape)
-    arvi = (b8 - b4 - optional_val * (b4 - b2)) / (b8 + b4 - optional_val * (b4 - b2))
-    return arvi, resolution
-
-
-def gci_calc(resolution, raster_path, clip_shape):
-    """Calculation of the GCI"""
-    if resolution == "10":
-        for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B08*.jp2"):
-            b8_path = item
-    elif resolution != "10":
-        for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B8A*.jp2"):
-            b8_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B03*.jp2"):
-        b3_path = item
-    b3 = reading.read_raster(b3_path, clip_shape)
-    b8 = reading.read_raster(b8_path, clip_shape)
-    gci = b8 / b3 - 1
-    return gci, resolution
-
-
-def gndvi_calc(resolution, raster_path, clip_shape):
-    """Calculation of the GNDVI"""
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B03*.jp2"):
-        b3_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B09*.jp2"):
-        b9_path = item
-    b3 = reading.read_raster(b3_path, clip_shape)
-    b9 = reading.read_raster(b9_path, clip_shape)
-    gndvi = (b9 - b3) / (b9 + b3)
-    return gndvi, resolution
-
-
-def nbr_calc(resolution, raster_path, clip_shape):
-    """Calculation of the NBR"""
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B8A*.jp2"):
-        b8a_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B12*.jp2"):
-        b12_path = item
-    b8a = reading.read_raster(b8a_path, clip_shape)
-    b12 = reading.read_raster(b12_path, clip_shape)
-    nbr = (b8a - b12) / (b8a + b12)
-    return nbr, resolution
-
-
-def nbr2_calc(resolution, raster_path, clip_shape):
-    """Calculation of the NBR2"""
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B11*.jp2"):
-        b11_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B12*.jp2"):
-        b12_path = item
-    b11 = reading.read_raster(b11_path, clip_shape)
-    b12 = reading.read_raster(b12_path, clip_shape)
-    nbr2 = (b11 - b12) / (b11 + b12)
-    return nbr2, resolution
-
-
-def ndbi_calc(resolution, raster_path, clip_shape):
-    """Calculation of the NDBI"""
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B8A*.jp2"):
-        b8a_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B11*.jp2"):
-        b11_path = item
-    b8a = reading.read_raster(b8a_path, clip_shape)
-    b11 = reading.read_raster(b11_path, clip_shape)
-    ndbi = (b11 - b8a) / (b11 + b8a)
-    return ndbi, resolution
-
-
-def ndmi_calc(resolution, raster_path, clip_shape):
-    """Calculation of the NDMI"""
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B8A*.jp2"):
-        b8a_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B11*.jp2"):
-        b11_path = item
-    b8a = reading.read_raster(b8a_path, clip_shape)
-    b11 = reading.read_raster(b11_path, clip_shape)
-    ndmi = (b8a - b11) / (b8a + b11)
-    return ndmi, resolution
-
-
-def ndre_calc(resolution, raster_path, clip_shape):
-    """Calculation of the NDRE"""
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B8A*.jp2"):
-        b8_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B05*.jp2"):
-        b5_path = item
-    b5 = reading.read_raster(b5_path, clip_shape)
-    b8 = reading.read_raster(b8_path, clip_shape)
-    ndre = (b8 - b5) / (b8 + b5)
-    return ndre, resolution
-
-
-def ndsi_calc(resolution, raster_path, clip_shape):
-    """Calculation of the NDSI"""
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B03*.jp2"):
-        b3_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B11*.jp2"):
-        b11_path = item
-    b3 = reading.read_raster(b3_path, clip_shape)
-    b11 = reading.read_raster(b11_path, clip_shape)
-    ndsi = (b3 - b11) / (b3 + b11)
-    return ndsi, resolution
-
-
-def ndvi_calc(resolution, raster_path, clip_shape):
-    """Calculation of the NDVI"""
-    if resolution == "10":
-        for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B08*.jp2"):
-            b8_path = item
-    elif resolution != "10":
-        for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B8A*.jp2"):
-            b8_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B04*.jp2"):
-        b4_path = item
-    b4 = reading.read_raster(b4_path, clip_shape)
-    b8 = reading.read_raster(b8_path, clip_shape)
-    ndvi = (b8 - b4) / (b8 + b4)
-    return ndvi, resolution
-
-
-def ndwi_calc(resolution, raster_path, clip_shape):
-    """Calculation of the NDWI"""
-    if resolution == "10":
-        for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B08*.jp2"):
-            b8_path = item
-    elif resolution != "10":
-        for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B8A*.jp2"):
-            b8_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B03*.jp2"):
-        b3_path = item
-    b3 = reading.read_raster(b3_path, clip_shape)
-    b8 = reading.read_raster(b8_path, clip_shape)
-    ndwi = (b3 - b8) / (b3 + b8)
-    return ndwi, resolution
-
-
-def reip_calc(resolution, raster_path, clip_shape):
-    """Calculation of the REIP"""
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B04*.jp2"):
-        b4_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B05*.jp2"):
-        b5_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B06*.jp2"):
-        b6_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B07*.jp2"):
-        b7_path = item
-    b4 = reading.read_raster(b4_path, clip_shape)
-    b5 = reading.read_raster(b5_path, clip_shape)
-    b6 = reading.read_raster(b6_path, clip_shape)
-    b7 = reading.read_raster(b7_path, clip_shape)
-    reip = 700 + 40 * ((b4 + b7) / 2 - b5) / (b6 - b5)
-    return reip, resolution
-
-
-def savi_calc(resolution, raster_path, clip_shape, optional_val):
-    """Calculation of the SAVI"""
-    if optional_val == "":
-        optional_val = 0.5
-    if resolution == "10":
-        for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B08*.jp2"):
-            b8_path = item
-    elif resolution != "10":
-        for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B8A*.jp2"):
-            b8_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B04*.jp2"):
-        b4_path = item
-    b4 = reading.read_raster(b4_path, clip_shape)
-    b8 = reading.read_raster(b8_path, clip_shape)
-    savi = ((b8 - b4) / (b8 + b4 + optional_val)) * (1 + optional_val)
-    return savi, resolution
-
-
-def sipi_calc(resolution, raster_path, clip_shape):
-    """Calculation of the SIPI"""
-    if resolution == "10":
-        for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B08*.jp2"):
-            b8_path = item
-    elif resolution != "10":
-        for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B8A*.jp2"):
-            b8_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B02*.jp2"):
-        b2_path = item
-    for item in glob.glob(raster_path + "S*/GRANULE/*/IMG_DATA/R" + resolution + "m/*_B04*.jp2"):
-        b4_path = item
-    b2 = reading.read_raster(b2_path, clip_shape)
-    b4 = reading.read_raster(b4_path, clip_shape)
-    b8 = reading.read_raster(b8_path, clip_shape)
-    sipi = (b8 - b2) / (b8 - b4)
-    return sipi, resolution
+import os
+from xml.etree import ElementTree
+
+
+# classes of the scene classification (SCL) kept with cloud masking: dark area pixels (2), vegetation (4),
+# not vegetated (5), water (6), unclassified (7) and snow/ice (11). No data (0), saturated or defective pixels (1),
+# cloud shadows (3), clouds with medium (8) and high probability (9) and thin cirrus (10) are masked
+SCL_CLASSES = [2, 4, 5, 6, 7, 11]
+
+# bands of the spectral information in the metadata, in the order of their ids
+S2_BANDS = ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B10", "B11", "B12"]
+
+
+def find_scenes(raster_path):
+    """Look for all Sentinel 2 products (S*) in the raster folder"""
+    return sorted(item for item in glob.glob(raster_path + "S*") if os.path.isdir(item))
+
+
+def scene_date(scene):
+    """Acquisition date (YYYYMMDD) from the product name, like S2A_MSIL2A_20220701T102031_..."""
+    return os.path.basename(scene).split("_")[2][:8]
+
+
+def scan(scene):
+    """
+    Look for the files of the bands of a scene (GRANULE/*/IMG_DATA/R{res}m/*_{band}_{res}m.jp2)
+    output: returns the folders with the files and per resolution the path to the file of every band
+    """
+    folders = [scene] + sorted(glob.glob(scene + "/GRANULE/*/IMG_DATA/R*m"))
+    files = {}
+    for folder in folders[1:]:
+        resolution = os.path.basename(folder)[1:-1]
+        for name in sorted(os.listdir(folder)):
+            if name.endswith(".jp2"):
+                files.setdefault(resolution, {})[name.split("_")[-2]] = folder + "/" + name
+    return folders, files
+
+
+def reflectance(scene):
+    """
+    Scale and offset of the bands from the metadata of a scene (MTD_MSIL2A.xml): reflectance is
+    (value + BOA_ADD_OFFSET) / BOA_QUANTIFICATION_VALUE, the offset (-1000) was added with processing baseline 04.00
+    output: returns per band the scale and offset (dict of lists), empty without metadata
+    """
+    try:
+        root = ElementTree.parse(os.path.normpath(scene) + "/MTD_MSIL2A.xml").getroot()
+    except (OSError, ElementTree.ParseError):
+        return {}
+    quantification = root.find(".//BOA_QUANTIFICATION_VALUE")
+    if quantification is None:
+        return {}
+    quantification = float(quantification.text)
+    offsets = {int(item.get("band_id")): float(item.text) for item in root.iter("BOA_ADD_OFFSET")}
+    return {band: [1 / quantification, offsets.get(i, 0.0) / quantification] for i, band in enumerate(S2_BANDS)}
+
+
+def load_manifest(scene):
+    """Manifest of a scene (see modules.manifest.load())"""
+    return manifest.load(scene, scan, scene_date(scene), reflectance)
+
+
+def band_path(scene, band, resolution):
+    """
+    Look up the file of a band of a scene with the given resolution in the manifest of the scene.
+    If the band is not available with this resolution, the file with the next coarser resolution is used
+    (and resampled while reading)
+    """
+    # B08 is only available with 10 m, the narrow NIR band B8A is used with 20 and 60 m
+    if band == "B08" and resolution != "10":
+        band = "B8A"
+    bands = load_manifest(scene)["bands"]
+    resolutions = ["10", "20", "60"]
+    for res in resolutions[resolutions.index(resolution) :]:
+        if band in bands.get(res, {}):
+            return bands[res][band]["path"]
+
+
+def cloud_mask(scene, resolution):
+    """
+    Cloud mask of a scene: the file of its scene classification (SCL, only available with 20 m and 60 m,
+    so with 10 m it is resampled) and the classes kept
+    """
+    path = band_path(scene, "SCL", resolution)
+    if path is None:
+        raise RuntimeError("Unable to mask clouds, there is no scene classification (SCL) in {}".format(scene))
+    return {"path": path, "classes": SCL_CLASSES}
+
+
+def index_calc(index_names, resolution, scene, clip_shape, optional_val, out_rasters=None, read_options=None):
+    """
+    Calculation of indices declared in modules.indices with the same resolution for one scene:
+    the files of the used bands are parsed into calc_indices() which reads each of them only once
+    (whole or, if out_rasters are given, streamed block by block into out_rasters).
+    Returns the indices as list of ndarrays (if streamed their statistics with read_options["statistics"],
+    otherwise None) next to the profile of a GeoTIFF of them
+    """
+    band_paths, formulas = indices.index_formulas(
+        index_names, "s2", optional_val, lambda band: band_path(scene, band, resolution)
+    )
+    # bands from coarser resolutions are resampled to the grid of the resolution (B02 is available with all)
+    grid = band_path(scene, "B02", resolution)
+    # the bands are converted to reflectance while they are read
+    read_options = dict(read_options or {}, grid=grid, scales=manifest.band_scales(load_manifest(scene)))
+    # the grid is known from the manifest, its file is not opened to align the bands
+    reading.add_grids(manifest.band_grids(load_manifest(scene)))
+    if read_options.get("clouds"):
+        read_options["mask"] = cloud_mask(scene, resolution)
+    return reading.calc_scene_indices(
+        index_names, band_paths, clip_shape, formulas, out_rasters, read_options, grid
+    )
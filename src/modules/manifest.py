@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Manifest of a scene (files of its bands with CRS, transform and size, date), parsed once and kept as JSON"""
+
+
+import hashlib
+import json
+import os
+import rasterio
+
+
+MANIFEST_DIR = "./data/cache/manifests/"
+
+# A scene is parsed only once: the manifest lists per resolution every band with the path to its file, its CRS,
+# transform, size and the scale and offset converting its values to reflectance (from the metadata of the product,
+# if it declares them), next to the date of the scene. It is saved to ./data/cache/manifests/{scene}_{key}.json together
+# with the modification times of the folders which were parsed and the modification time and size of every file in
+# them, like the bands and the metadata (the grid of a band is taken from the manifest instead of the header of its
+# file, see modules.reading.add_grids()). Adding, removing or replacing a file changes the modification time of its
+# folder, a file rewritten in place its own modification time or size: the manifest is parsed again as soon as one
+# of them changed.
+
+# manifests saved by older versions (without all of the fields above) are parsed again
+VERSION = 3
+
+_manifests = {}
+
+
+def manifest_file(scene):
+    """
+    Path of the JSON-file of the manifest of a scene. The name contains the name of the scene and a key of its
+    absolute path, so scenes with the same name in different folders never share a manifest
+    """
+    key = hashlib.sha1(os.path.abspath(scene).encode()).hexdigest()[:16]
+    return MANIFEST_DIR + "{}_{}.json".format(os.path.basename(os.path.normpath(scene)), key)
+
+
+def load(scene, scan, date, reflectance=None):
+    """
+    Return the manifest of a scene, parsed again only if one of its folders changed
+    param scan: function returning the folders of a scene with band files and per resolution the paths
+    to the files of the bands ({resolution: {band: path}})
+    param date: acquisition date of the scene (string)
+    param reflectance: function returning the scale and offset of the bands from the metadata of the scene
+    ({band: [scale, offset]}), if not given the values of the bands are not converted
+    output: returns the manifest (dict) with the date, the folders and per resolution and band
+    the path, CRS, transform, size and scale of the file
+    """
+    manifest = _manifests.get(os.path.abspath(scene))
+    if manifest is None or not is_valid(manifest):
+        try:
+            with open(manifest_file(scene)) as json_file:
+                manifest = json.load(json_file)
+        except (OSError, ValueError):
+            manifest = None
+        if manifest is None or not is_valid(manifest):
+            manifest = build(scene, scan, date, reflectance)
+        _manifests[os.path.abspath(scene)] = manifest
+    return manifest
+
+
+def is_valid(manifest):
+    """Check if none of the folders of a manifest and none of the files in them was changed since it was parsed"""
+    if manifest.get("version") != VERSION:
+        return False
+    try:
+        if any(os.stat(folder).st_mtime_ns != mtime for folder, mtime in manifest["folders"].items()):
+            return False
+        return all(file_state(path) == state for path, state in manifest["files"].items())
+    except OSError:
+        return False
+
+
+def file_state(path):
+    """Modification time (ns) and size of a file, changed whenever it is rewritten"""
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def build(scene, scan, date, reflectance=None):
+    """Parse the folders of a scene into a manifest and save it (see load())"""
+    print("...parsing scene {}...".format(os.path.basename(os.path.normpath(scene))))
+    folders, files = scan(scene)
+    scales = reflectance(scene) if reflectance else {}
+    manifest = {
+        "version": VERSION,
+        "scene": scene,
+        "date": date,
+        "folders": {folder: os.stat(folder).st_mtime_ns for folder in folders},
+        # the bands and the metadata the scales are taken from
+        "files": {
+            entry.path: file_state(entry.path)
+            for folder in folders
+            for entry in os.scandir(folder)
+            if entry.is_file()
+        },
+        "bands": {},
+    }
+    for resolution, bands in files.items():
+        manifest["bands"][resolution] = {}
+        for band, path in sorted(bands.items()):
+            with rasterio.open(path, "r") as dataset:
+                manifest["bands"][resolution][band] = {
+                    "path": path,
+                    "crs": dataset.crs.to_string() if dataset.crs else None,
+                    "transform": list(dataset.transform)[:6],
+                    "width": dataset.width,
+                    "height": dataset.height,
+                    "scale": scales.get(band),
+                }
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    # write to a temporary file first, so other processes never load a half-written manifest
+    temp = manifest_file(scene) + ".{}.tmp".format(os.getpid())
+    with open(temp, "w") as json_file:
+        json.dump(manifest, json_file, indent=2)
+    os.replace(temp, manifest_file(scene))
+    return manifest
+
+
+def band_scales(manifest):
+    """Scale and offset of the bands converted to reflectance, per path to their file (see load())"""
+    return {
+        entry["path"]: tuple(entry["scale"])
+        for bands in manifest["bands"].values()
+        for entry in bands.values()
+        if entry["scale"]
+    }
+
+
+def band_grids(manifest):
+    """Grid (CRS, transform and size) of the bands, per path to their file (see load())"""
+    return {
+        entry["path"]: {
+            "crs": rasterio.crs.CRS.from_string(entry["crs"]) if entry["crs"] else None,
+            "transform": rasterio.Affine(*entry["transform"]),
+            "width": entry["width"],
+            "height": entry["height"],
+        }
+        for bands in manifest["bands"].values()
+        for entry in bands.values()
+    }
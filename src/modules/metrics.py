@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Metrics of the stages of a run (read, clip, compute, write, stats, plot) and optional profiling"""
+
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # only available on Unix, see peak_rss()
+    resource = None
+
+
+METRICS_FORMATS = {"json": "./results/metrics.jsonl", "prom": "./results/metrics.prom"}
+PROFILERS = ["cprofile", "tracemalloc"]
+
+# Every stage (like reading the bands) adds to its totals whenever it runs, so blocks which are streamed one by
+# one sum up to one line per stage:
+# - seconds: duration of the stage, summed over all calls (bands decoded by several threads at once add up)
+# - calls: number of times the stage ran (like once per band or block)
+# - bytes: bytes of the decoded bands (read) or of the written results (write)
+# - pixels: pixels processed by the stage
+# - rss_mb: peak resident memory of the process at the end of the stage
+# - peak_mb: peak of the memory allocated within the stage, only measured with the profiler tracemalloc
+#   (approximate while bands are decoded by several threads at once)
+# Worker processes (scene batch mode) collect their own metrics, which are merged into the ones of the main process.
+
+_stages = {}
+_lock = threading.Lock()
+_run = {"starttime": time.time(), "profiler": None}
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Measure a stage, the bytes and pixels it processed are added to the yielded dict, like
+        with metrics.stage("read") as measured:
+            band = dataset.read(1)
+            measured["bytes"] += band.nbytes
+    """
+    measured = {"bytes": 0, "pixels": 0}
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    starttime = time.perf_counter()
+    try:
+        yield measured
+    finally:
+        seconds = time.perf_counter() - starttime
+        peak = tracemalloc.get_traced_memory()[1] / 2**20 if tracemalloc.is_tracing() else None
+        with _lock:
+            totals = _stages.setdefault(
+                name, {"seconds": 0.0, "calls": 0, "bytes": 0, "pixels": 0, "rss_mb": 0.0, "peak_mb": None}
+            )
+            totals["seconds"] += seconds
+            totals["calls"] += 1
+            totals["bytes"] += int(measured["bytes"])
+            totals["pixels"] += int(measured["pixels"])
+            totals["rss_mb"] = max(totals["rss_mb"], peak_rss())
+            if peak is not None:
+                totals["peak_mb"] = max(totals["peak_mb"] or 0.0, peak)
+
+
+def peak_rss():
+    """
+    Peak resident memory of the process (MB). Without the module resource (Windows) it is taken from psutil if it
+    is installed, otherwise it is not measured (0.0)
+    """
+    if resource is not None:
+        # ru_maxrss is in bytes on macOS and in KB on Linux
+        scale = 2**20 if sys.platform == "darwin" else 2**10
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    try:
+        import psutil
+    except ImportError:
+        return 0.0
+    memory = psutil.Process().memory_info()
+    # the peak working set is only known on Windows, otherwise the current resident memory is taken
+    return getattr(memory, "peak_wset", memory.rss) / 2**20
+
+
+def collect():
+    """Return the totals of all stages measured so far (dict, like for a worker process to return them)"""
+    with _lock:
+        return {name: dict(totals) for name, totals in _stages.items()}
+
+
+def reset():
+    """Forget the stages measured so far (like a worker process before it calculates the next scene)"""
+    with _lock:
+        _stages.clear()
+
+
+def merge(other):
+    """Add the totals of the stages of another process (as returned by collect()) to the ones of this process"""
+    with _lock:
+        for name, values in other.items():
+            totals = _stages.setdefault(name, dict(values, seconds=0.0, calls=0, bytes=0, pixels=0))
+            for key in ["seconds", "calls", "bytes", "pixels"]:
+                totals[key] += values[key]
+            totals["rss_mb"] = max(totals["rss_mb"], values["rss_mb"])
+            if values["peak_mb"] is not None:
+                totals["peak_mb"] = max(totals["peak_mb"] or 0.0, values["peak_mb"])
+
+
+def start(profiler=None):
+    """Start measuring a run, with the profiler cprofile (calls) or tracemalloc (memory) if given"""
+    reset()
+    _run.update({"starttime": time.time(), "profiler": None})
+    if profiler == "cprofile":
+        import cProfile
+
+        _run["profiler"] = cProfile.Profile()
+        _run["profiler"].enable()
+    elif profiler == "tracemalloc":
+        tracemalloc.start()
+
+
+def finish(metrics_format=None, profiler=None):
+    """
+    Stop measuring a run and save its metrics (metrics_format json: appended to ./results/metrics.jsonl,
+    one line per stage; prom: ./results/metrics.prom in the text format of Prometheus).
+    The results of the profiler are printed (cprofile also saved to ./results/profile.pstats)
+    """
+    seconds = time.time() - _run["starttime"]
+    if profiler == "cprofile" and _run["profiler"] is not None:
+        import pstats
+
+        _run["profiler"].disable()
+        _run["profiler"].dump_stats("./results/profile.pstats")
+        print("\nFunctions which took the most time (all saved to ./results/profile.pstats):")
+        pstats.Stats(_run["profiler"], stream=sys.stdout).sort_stats("cumulative").print_stats(20)
+        _run["profiler"] = None
+    elif profiler == "tracemalloc" and tracemalloc.is_tracing():
+        print("\nLines which allocated the most memory:")
+        for statistic in tracemalloc.take_snapshot().statistics("lineno")[:10]:
+            print("  {}".format(statistic))
+        tracemalloc.stop()
+    if metrics_format in METRICS_FORMATS:
+        write(metrics_format, seconds)
+
+
+def write(metrics_format, seconds):
+    """Save the metrics of the stages and the duration of the whole run (see finish())"""
+    stages = dict(collect(), total={"seconds": seconds, "rss_mb": peak_rss()})
+    out_file = METRICS_FORMATS[metrics_format]
+    if metrics_format == "json":
+        run = {
+            "run": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(_run["starttime"])),
+            "argv": sys.argv[1:],
+        }
+        with open(out_file, "a") as json_file:
+            for name, totals in stages.items():
+                json_file.write(json.dumps(dict(run, stage=name, **totals)) + "\n")
+    else:
+        lines = []
+        for key, unit, description in [
+            ("seconds", "seconds", "Duration of the stage"),
+            ("calls", "calls", "Number of times the stage ran"),
+            ("bytes", "bytes", "Bytes read or written by the stage"),
+            ("pixels", "pixels", "Pixels processed by the stage"),
+            ("rss_mb", "rss_megabytes", "Peak resident memory of the process at the end of the stage"),
+            ("peak_mb", "peak_megabytes", "Peak memory allocated within the stage (tracemalloc)"),
+        ]:
+            metric = "index_calculator_stage_" + unit
+            lines += ["# HELP {} {}".format(metric, description), "# TYPE {} gauge".format(metric)]
+            for name, totals in stages.items():
+                if totals.get(key) is not None:
+                    lines.append('{}{{stage="{}"}} {}'.format(metric, name, totals[key]))
+        # written to a temporary file first, so a collector never reads a half-written file
+        with open(out_file + ".tmp", "w") as prom_file:
+            prom_file.write("\n".join(lines) + "\n")
+        os.replace(out_file + ".tmp", out_file)
+    print("Metrics of the stages saved to {}.".format(out_file))
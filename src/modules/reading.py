@@ -3,64 +3,775 @@
 """Functions to read data (raster/vector)"""
 
 
+import modules.cache as cache
+import modules.engine as engine
+import modules.indices as indices
+import modules.metrics as metrics
+import modules.stats as stats
 import modules.writing as writing
-import sys
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
 import fiona
+import numpy as np
 import rasterio
+import rasterio.features
 import rasterio.mask
+import rasterio.warp
+import rasterio.windows
+from rasterio.windows import Window
 
 
-def read_raster(in_raster, clip_shape):
+# geometries of the shapefiles, windows of the clips and label rasters of their features, computed only once
+_shapes = {}
+_clip_windows = {}
+_zone_labels = {}
+# grids (CRS, transform, size) of the raster files bands are aligned to
+_grids = {}
+
+# memory-mapped pixels of uncompressed GeoTIFFs (None for files decoded by GDAL) per path and modification time,
+# every map keeps its file open: the oldest maps are closed beyond MAX_MEMORY_MAPS
+_memory_maps = {}
+MAX_MEMORY_MAPS = 32
+# rows of a memory-mapped band converted to floats at once when it is read whole
+MAP_ROWS = 512
+
+# value of the pixels without data in Sentinel-2 L2A and Landsat Collection 2 products,
+# used for files which do not declare their nodata value
+NODATA = 0
+
+
+def read_rasters(band_paths, clip_shape, read_options=None):
+    """
+    Read several input files as Numpy arrays.
+    With read_options["threads"] > 1 the files are decoded at the same time by a thread pool (GDAL releases
+    the GIL while decoding), the remaining CPUs are left to GDAL to decode the tiles of each file in parallel.
+    With read_options["cache"] (bytes) > 0 decoded bands are cached on disk.
+    read_options["dtype"] is the floating point type the bands are calculated with (default: float64).
+    With read_options["grid"] (path to a raster file) bands with another grid are resampled to its grid
+    with read_options["resampling"] (default: bilinear).
+    read_options["scales"] are the scale and offset converting the values of the files to reflectance (dict of
+    tuples per path, see to_float())
+    """
+    scales = (read_options or {}).get("scales", {})
+    threads = min((read_options or {}).get("threads", 1), len(band_paths))
+    options = {
+        "cache_size": (read_options or {}).get("cache", 0),
+        "dtype": (read_options or {}).get("dtype", "float64"),
+        "grid": (read_options or {}).get("grid"),
+        "resampling": (read_options or {}).get("resampling", "bilinear"),
+    }
+    if threads <= 1:
+        return [
+            read_raster(band_path, clip_shape, scale=scales.get(band_path), **options)
+            for band_path in band_paths
+        ]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(
+            executor.map(
+                lambda band_path: read_raster(
+                    band_path, clip_shape, gdal_threads(threads), scale=scales.get(band_path), **options
+                ),
+                band_paths,
+            )
+        )
+
+
+def gdal_threads(parallel_reads):
+    """Number of threads GDAL may use to decode one file while parallel_reads files are decoded at once"""
+    return max(1, (os.cpu_count() or 1) // parallel_reads)
+
+
+def read_raster(
+    in_raster,
+    clip_shape,
+    num_threads=None,
+    cache_size=0,
+    dtype="float64",
+    grid=None,
+    resampling="bilinear",
+    scale=None,
+):
     """
     Read the input files (Sentinel 2) as Numpy arrays and preprocess them
     param in_dem: path to input file (string)
-    output: returns a Numpy array (Null values are np.nan)
+    param clip_shape: if given, only the window of the shapefile is read and pixels outside of it are np.nan
+    param num_threads: number of threads GDAL uses to decode the file, GDAL's default if not given
+    param cache_size: if > 0, the decoded band is taken from/added to the cache with this size (bytes)
+    param dtype: floating point type of the returned array (float32 halves the memory of float64)
+    param grid: path to a raster file, if its grid differs the band is resampled to it (see open_aligned())
+    param resampling: method of the resampling (like nearest, bilinear, average)
+    param scale: scale and offset converting the values to reflectance (tuple), the values as they are if not given
+    output: returns a Numpy array (Null values and pixels without data are np.nan)
     """
-    # test if a clip is found as argument, if so change the filepath to clipped file
+    try:
+        # open the rasterfile in reading mode
+        dataset = open_aligned(in_raster, grid, resampling)
+    except Exception as err:
+        raise RuntimeError("Unable to open raster file: {}. Please check your input file.".format(err)) from err
+    # resampled bands are not cached, the cache holds the bands of the files as they are
+    if isinstance(dataset, WarpedVRT):
+        print("...resampling raster ./data/.../*{} ({})...".format(in_raster[-27:], resampling))
+        cache_size = 0
+    # memory-mapped files are not cached either, the operating system keeps their pages
+    mapped = memory_map(dataset)
+    if mapped is not None:
+        cache_size = 0
+    # test if a clip is found as argument, if so only the window of the shape is read
+    mask, window = None, None
     if clip_shape != "":
         print("...clipping raster ./data/.../*{}...".format(in_raster[-27:]))
-        in_shape = "./data/shapes/" + clip_shape
-        raster = clip(in_raster, in_shape)
-        print("...reading raster ./data/{}...".format(raster[7:]))
+        with metrics.stage("clip"):
+            mask, _, window = clip_window(dataset, clip_shape)
+    with metrics.stage("read") as measured:
+        cached = cache.load(in_raster) if cache_size else None
+        if cached is not None:
+            print("...reading cached raster ./data/.../*{}...".format(in_raster[-27:]))
+            band = cached[window.toslices()] if window is not None else cached
+        elif mapped is not None:
+            print("...reading memory-mapped raster ./data/.../*{}...".format(in_raster[-27:]))
+            band = mapped[window.toslices()] if window is not None else mapped
+        else:
+            print("...reading raster ./data/.../*{}...".format(in_raster[-27:]))
+            # specify the band which shall be read
+            with rasterio.Env(**({"GDAL_NUM_THREADS": num_threads} if num_threads else {})):
+                band = dataset.read(1, window=window)
+            if window is None and cache_size:
+                cache.store(in_raster, band, cache_size)
+        measured["bytes"] += band.nbytes
+        measured["pixels"] += band.size
+        nodata = nodata_value(dataset)
+        close_aligned(dataset)
+        if mapped is not None:
+            # the floats are a full copy, but the file is converted block of rows by block, so only the pages of
+            # one block are touched at a time and the nodata mask is never of the size of the band
+            out = np.empty(band.shape, dtype)
+            for row in range(0, band.shape[0], MAP_ROWS):
+                to_float(band[row : row + MAP_ROWS], dtype, nodata, scale, out[row : row + MAP_ROWS])
+            band = out
+        else:
+            band = to_float(band, dtype, nodata, scale)
+    if mask is not None:
+        with metrics.stage("clip") as measured:
+            band[mask] = np.nan
+            measured["pixels"] += band.size
+    return band
+
+
+def memory_map(dataset):
+    """
+    Map the pixels of an uncompressed GeoTIFF with strips stored one after another (like many Landsat bands) as
+    read-only Numpy array: reading a window is only a view of the file, which is converted to floats block by block
+    (streamed or, for whole bands, by MAP_ROWS rows into the float array, which is still a copy of the band).
+    The operating system keeps the pages of the file in its cache, shared by all processes reading the same scene,
+    instead of every process holding a private copy decoded by GDAL. A rewritten file is mapped again, its old map
+    is dropped
+    output: returns the memory-mapped array or None if the file has to be decoded by GDAL
+    """
+    if (
+        isinstance(dataset, WarpedVRT)
+        or dataset.driver != "GTiff"
+        or dataset.count != 1
+        or dataset.compression is not None
+    ):
+        return None
+    key = (dataset.name, os.stat(dataset.name).st_mtime_ns)
+    if key not in _memory_maps:
+        # maps of older versions of the file and the oldest maps beyond MAX_MEMORY_MAPS are closed
+        for old in [old for old in _memory_maps if old[0] == dataset.name]:
+            del _memory_maps[old]
+        while len(_memory_maps) >= MAX_MEMORY_MAPS:
+            del _memory_maps[next(iter(_memory_maps))]
+        _memory_maps[key] = None
+        rows, width = dataset.block_shapes[0]
+        itemsize = np.dtype(dataset.dtypes[0]).itemsize
+        try:
+            offsets = [
+                int(dataset.get_tag_item("BLOCK_OFFSET_0_{}".format(strip), "TIFF", bidx=1))
+                for strip in range(-(-dataset.height // rows))
+            ]
+        except (TypeError, ValueError):
+            # strips which were never written have no offset
+            return None
+        # tiled files and strips which are not stored one after another are decoded by GDAL
+        if width == dataset.width and offsets == [
+            offsets[0] + i * rows * width * itemsize for i in range(len(offsets))
+        ]:
+            with open(dataset.name, "rb") as tiff:
+                byteorder = "<" if tiff.read(2) == b"II" else ">"
+            _memory_maps[key] = np.memmap(
+                dataset.name,
+                np.dtype(dataset.dtypes[0]).newbyteorder(byteorder),
+                "r",
+                offset=offsets[0],
+                shape=dataset.shape,
+            )
+    return _memory_maps[key]
+
+
+def nodata_value(dataset):
+    """Value of the pixels without data of a dataset (NODATA if the file does not declare one)"""
+    return NODATA if dataset.nodata is None else dataset.nodata
+
+
+def to_float(band, dtype, nodata, scale=None, out=None):
+    """
+    Convert a decoded band to floats (important!), pixels with the nodata value become np.nan.
+    With a scale and offset (tuple) the values are converted to reflectance in two passes: the scale is applied
+    while casting (no float copy of the band before it) and the offset added in place, so the conversion allocates
+    no further array.
+    If out (array of the shape of the band) is given, the floats are written into it
+    """
+    if out is None:
+        out = np.empty(band.shape, dtype)
+    if scale is None:
+        np.copyto(out, band, casting="unsafe")
     else:
-        # otherwise just take the original path to the rasterfile
-        raster = in_raster
-        print("...reading raster ./data/.../*{}...".format(raster[-27:]))
+        np.multiply(band, scale[0], out=out, dtype=dtype)
+        if scale[1]:
+            np.add(out, scale[1], out=out)
+    if not np.isnan(nodata):
+        out[band == nodata] = np.nan
+    return out
+
+
+def add_grids(grids):
+    """
+    Register the grids (CRS, transform and size, e.g. from the manifest of a scene) of raster files per path,
+    so open_aligned() aligns bands to them without opening their files
+    """
+    # the grids of a manifest which was parsed again replace the old ones
+    _grids.update(grids)
+
+
+def open_aligned(in_raster, grid=None, resampling="bilinear"):
+    """
+    Open a raster file in reading mode. If grid (path to a raster file) is given and has another grid, the file is
+    opened as WarpedVRT with the CRS, transform and size of this grid: only the windows which are read are
+    resampled, on the fly. The grid is taken from its file once (unless registered with add_grids()) and shared by
+    all bands aligned to it
+    """
+    dataset = rasterio.open(in_raster, "r")
+    if grid is None or grid == in_raster:
+        return dataset
+    if grid not in _grids:
+        with rasterio.open(grid, "r") as reference:
+            _grids[grid] = {
+                "crs": reference.crs,
+                "transform": reference.transform,
+                "width": reference.width,
+                "height": reference.height,
+            }
+    target = _grids[grid]
+    if (
+        dataset.crs == target["crs"]
+        and dataset.transform == target["transform"]
+        and dataset.width == target["width"]
+        and dataset.height == target["height"]
+    ):
+        return dataset
+    # pixels without data are left out of the resampling and stay without data
+    nodata = nodata_value(dataset)
+    return WarpedVRT(dataset, resampling=Resampling[resampling], src_nodata=nodata, nodata=nodata, **target)
+
+
+def close_aligned(dataset):
+    """Close a raster file opened with open_aligned()"""
+    dataset.close()
+    if isinstance(dataset, WarpedVRT):
+        dataset.src_dataset.close()
+
+
+def read_shapes(clip_shape, crs=None):
+    """
+    Read the geometries of a shapefile in ./data/shapes/ (or a path to a shapefile), the file is parsed only once
+    param crs: if given, the geometries are reprojected from the CRS of the shapefile to this CRS
+    output: returns the geometries (list of GeoJSON-like dicts)
+    """
+    if clip_shape not in _shapes:
+        try:
+            # open the shapefile in reading mode
+            path = clip_shape if os.path.isfile(clip_shape) else "./data/shapes/" + clip_shape
+            with fiona.open(path, "r") as shapefile:
+                features = list(shapefile)
+                _shapes[clip_shape] = (
+                    [feature["geometry"] for feature in features],
+                    shapefile.crs,
+                    [feature["id"] for feature in features],
+                )
+        except Exception as err:
+            raise RuntimeError(
+                "Unable to read shapefile: {}. Please check your input files.".format(err)
+            ) from err
+    shapes, shapes_crs, _ = _shapes[clip_shape]
+    if crs is None or not shapes_crs or rasterio.crs.CRS.from_user_input(shapes_crs) == crs:
+        return shapes
+    return [rasterio.warp.transform_geom(shapes_crs, crs, shape) for shape in shapes]
+
+
+def shape_ids(clip_shape):
+    """Return the IDs of the features of a shapefile, in the order of read_shapes()"""
+    read_shapes(clip_shape)
+    return _shapes[clip_shape][2]
+
+
+def zone_labels(profile, clip_shape):
+    """
+    Rasterize all features of a shapefile once into a label raster on the grid of a profile (like the clipped
+    results): pixels of the i-th feature get the label i + 1, pixels outside of all features 0.
+    Where features overlap, the later one is used
+    """
+    key = (
+        clip_shape,
+        profile["crs"].to_string() if profile["crs"] else None,
+        tuple(profile["transform"]),
+        (profile["height"], profile["width"]),
+    )
+    if key not in _zone_labels:
+        shapes = read_shapes(clip_shape, profile["crs"])
+        _zone_labels[key] = rasterio.features.rasterize(
+            ((shape, i + 1) for i, shape in enumerate(shapes)),
+            out_shape=(profile["height"], profile["width"]),
+            transform=profile["transform"],
+            fill=0,
+            dtype="int32",
+        )
+    return _zone_labels[key]
+
+
+def clip_window(dataset, clip_shape):
+    """
+    Window of a raster covered by a shapefile, computed once per raster grid (resolution) and reused for every band.
+    The shapes are reprojected to the CRS of the raster, the window is derived from their bounds and the mask is
+    only rasterized within this window, so reading a small AOI costs only the blocks it covers
+    output: returns the mask (True outside of the shapes), the transform and the window of the clipped raster
+    """
+    key = (
+        clip_shape,
+        dataset.crs.to_string() if dataset.crs else None,
+        tuple(dataset.transform),
+        dataset.shape,
+    )
+    if key not in _clip_windows:
+        shapes = read_shapes(clip_shape, dataset.crs)
+        try:
+            _clip_windows[key] = rasterio.mask.raster_geometry_mask(dataset, shapes, crop=True)
+        except Exception as err:
+            raise RuntimeError(
+                "Unable to clip raster with shapefile: {}. Please check your input files.".format(err)
+            ) from err
+    return _clip_windows[key]
+
+
+def raster_profile(in_raster, clip_shape, dtype="float64", compress=""):
+    """
+    Profile of a GeoTIFF with the results calculated from a raster file (and its clip)
+    param dtype: data type of the GeoTIFF (float64, float32 or int16 for scaled integers)
+    param compress: if given, the GeoTIFF is a Cloud-Optimized GeoTIFF with this compression (deflate, zstd, lzw)
+    """
+    with rasterio.open(in_raster, "r") as dataset:
+        if clip_shape != "":
+            _, transform, window = clip_window(dataset, clip_shape)
+            height, width = window.height, window.width
+        else:
+            transform, height, width = dataset.transform, dataset.height, dataset.width
+        profile = {
+            "driver": "GTiff",
+            "height": height,
+            "width": width,
+            "count": 1,
+            "crs": dataset.crs,
+            "transform": transform,
+            "dtype": dtype,
+            "nodata": writing.INT16_NODATA if dtype == "int16" else np.nan,
+        }
+    if compress != "":
+        profile.update({"driver": "COG", "compress": compress})
+    return profile
+
+
+def calc_index(band_paths, clip_shape, formula, out_raster=""):
+    """
+    Calculate an index from the given bands, either on whole arrays or block by block (streaming)
+    param band_paths: paths to the input files in the order the formula expects them (list)
+    param formula: function calculating the index from the band arrays
+    param out_raster: if given, the index is streamed block by block into this GeoTIFF (string)
+    output: returns the index as Numpy array, or None if it was streamed to out_raster
+    """
+    formulas = [(formula, list(range(len(band_paths))))]
+    out_rasters = [out_raster] if out_raster != "" else None
+    return calc_indices(band_paths, clip_shape, formulas, out_rasters)[0]
+
+
+def calc_indices(
+    band_paths, clip_shape, formulas, out_rasters=None, read_options=None, out_scales=None, out_stats=None
+):
+    """
+    Calculate several indices from shared bands, every input file is read only once
+    param band_paths: paths to all input files needed by the formulas (list)
+    param formulas: per index the function and the positions of its bands in band_paths (list of tuples)
+    param out_rasters: if given, per index a GeoTIFF it is streamed into block by block (list)
+    param read_options: options for reading the files, like the number of "threads" decoding them (dict)
+    and the data type ("output") and compression of Cloud-Optimized ("compress") streamed GeoTIFFs
+    param out_scales: per index the scale and offset it is stored with as int16 (list of tuples)
+    param out_stats: per index statistics (modules.stats) the streamed blocks are added to (list of dicts)
+    With read_options["mask"] (see read_mask()) only the pixels kept by the cloud mask are calculated.
+    With read_options["compute_threads"] > 1 the indices are calculated by several threads at once, each on its
+    own chunks of rows (whole arrays) or blocks (streamed)
+    output: returns the indices as list of Numpy arrays (None for streamed indices)
+    """
+    if out_rasters is None:
+        bands = read_rasters(band_paths, clip_shape, read_options)
+        cloud_mask = (read_options or {}).get("mask")
+        valid = read_mask(cloud_mask, clip_shape, (read_options or {}).get("grid")) if cloud_mask else None
+        compute_threads = (read_options or {}).get("compute_threads", 1)
+        results = []
+        with metrics.stage("compute") as measured:
+            for formula, positions in formulas:
+                if compute_threads > 1:
+                    results.append(
+                        engine.calculate_chunks(formula, [bands[i] for i in positions], valid, compute_threads)
+                    )
+                elif valid is None:
+                    results.append(formula(*[bands[i] for i in positions]))
+                else:
+                    results.append(formula(*[bands[i] for i in positions], valid=valid))
+                measured["pixels"] += results[-1].size
+        return results
+    stream_indices(band_paths, clip_shape, formulas, out_rasters, read_options, out_scales, out_stats)
+    return [None] * len(formulas)
+
+
+def calc_scene_indices(index_names, band_paths, clip_shape, formulas, out_rasters, read_options, grid=None):
+    """
+    Calculate the indices of a scene with calc_indices(), stored as int16 with their scales (see
+    modules.indices.output_scale()) and, if streamed with read_options["statistics"], with their statistics
+    param grid: path to the file the profile of the indices is taken from, the first band if not given
+    output: returns the indices as list of Numpy arrays (if streamed their statistics with
+    read_options["statistics"], otherwise None) next to the profile of a GeoTIFF of them
+    """
+    out_scales = [indices.output_scale(index_name) for index_name in index_names]
+    # streamed indices are not returned, but their statistics can be derived block by block
+    if out_rasters is not None and read_options.get("statistics"):
+        out_stats = [stats.new(index_name) for index_name in index_names]
+    else:
+        out_stats = None
+    results = calc_indices(band_paths, clip_shape, formulas, out_rasters, read_options, out_scales, out_stats)
+    profile = raster_profile(
+        grid or band_paths[0],
+        clip_shape,
+        read_options.get("output", "float64"),
+        read_options.get("compress", ""),
+    )
+    return out_stats or results, profile
+
+
+def stream_indices(
+    band_paths, clip_shape, formulas, out_rasters, read_options=None, out_scales=None, out_stats=None
+):
+    """
+    Read the input files window by window along their native blocks, calculate the indices per window
+    and write each block straight into the output GeoTIFFs, so only one block per band is held in memory.
+    If out_stats are given, the statistics of the indices are derived from the blocks in the same pass.
+    With a cloud mask (read_options["mask"]) its window is read first: blocks without any pixel kept by it are
+    neither read nor calculated, but written as np.nan.
+    With read_options["compute_threads"] > 1 several blocks are read and calculated at once, each thread with its
+    own handles of the files (GDAL handles must not be shared by threads), only writing them is one after another
+    """
+    read_options = read_options or {}
+    cloud_mask = read_options.get("mask")
+    # state shared by the helpers streaming the blocks (see _stream_block())
+    stream = {
+        "band_paths": band_paths,
+        "clip_shape": clip_shape,
+        "formulas": formulas,
+        "grid": read_options.get("grid"),
+        "resampling": read_options.get("resampling", "bilinear"),
+        "cloud_mask": cloud_mask,
+        "dtype": read_options.get("dtype", "float64"),
+        "out_dtype": read_options.get("output", "float64"),
+        "out_scales": out_scales or [None] * len(formulas),
+        "out_stats": out_stats or [None] * len(formulas),
+        "scales": [read_options.get("scales", {}).get(band_path) for band_path in band_paths],
+        # blocks are calculated at the same time by compute_threads threads, their results are written one by one
+        "compute_threads": read_options.get("compute_threads", 1),
+        "local": threading.local(),
+        "lock": threading.Lock(),
+        "opened": [],
+    }
+    stream["datasets"], stream["mask_dataset"] = _open_stream(stream)
+    reference = stream["datasets"][0]
+    out_meta = raster_profile(
+        stream["grid"] or band_paths[0], clip_shape, stream["out_dtype"], read_options.get("compress", "")
+    )
+    stream["clip_mask"], stream["clip_area"] = _stream_area(reference, clip_shape, out_meta)
+    print(
+        "...streaming {} block by block to {}...".format(
+            ", ".join(band_path[-27:] for band_path in band_paths), ", ".join(out_rasters)
+        )
+    )
+    stream["dests"] = [
+        writing.open_raster(out_raster, out_meta, out_scale)
+        for out_raster, out_scale in zip(out_rasters, stream["out_scales"])
+    ]
+    cache_size = read_options.get("cache", 0)
+    stream["mapped"], stream["cached"], stream["filling"] = _stream_sources(stream, cache_size)
+    stream["nodata"] = [nodata_value(dataset) for dataset in stream["datasets"]]
+    # the windows of the bands are decoded at the same time by one thread per band
+    stream["threads"] = min(read_options.get("threads", 1), len(band_paths))
+    stream["num_threads"] = gdal_threads(stream["threads"]) if stream["threads"] > 1 else None
+
+    windows = [
+        block.intersection(stream["clip_area"])
+        for block in block_windows(reference)
+        if rasterio.windows.intersect(block, stream["clip_area"])
+    ]
+    stream["executor"] = ThreadPoolExecutor(max_workers=stream["threads"])
+    with stream["executor"]:
+        if stream["compute_threads"] > 1:
+            with ThreadPoolExecutor(max_workers=stream["compute_threads"]) as computing:
+                skipped = sum(computing.map(lambda window: _stream_block(stream, window), windows))
+        else:
+            skipped = sum(_stream_block(stream, window) for window in windows)
+    if cloud_mask:
+        print("...skipped {} blocks without pixels kept by the cloud mask...".format(skipped))
+    opened = [dataset for thread in stream["opened"] for dataset in thread]
+    for dataset in stream["datasets"] + [stream["mask_dataset"]] + opened:
+        if dataset is not None:
+            close_aligned(dataset)
+    for dest, out_raster in zip(stream["dests"], out_rasters):
+        with metrics.stage("write"):
+            writing.close_raster(dest, out_raster, out_meta)
+    for band in stream["filling"]:
+        if band is not None:
+            cache.finish(band, cache_size)
+
+
+def _open_stream(stream):
+    """Open the files of the bands and the cloud mask (or None) of a stream, aligned to its grid"""
     try:
-        # open the rasterfile in reading mode
-        dataset = rasterio.open(raster, "r")
+        datasets = [
+            open_aligned(band_path, stream["grid"], stream["resampling"]) for band_path in stream["band_paths"]
+        ]
+        # classes are never interpolated
+        cloud_mask = stream["cloud_mask"]
+        mask_dataset = open_aligned(cloud_mask["path"], stream["grid"], "nearest") if cloud_mask else None
     except Exception as err:
-        print(
-            "...ERROR: Unable to open raster file: ",
-            str(err),
-            "\nPlease check your input file.",
+        raise RuntimeError("Unable to open raster file: {}. Please check your input file.".format(err)) from err
+    return datasets, mask_dataset
+
+
+def _stream_area(reference, clip_shape, out_meta):
+    """
+    Window of a stream in the input files and the mask of the clip (None without clip) within it.
+    Without clip the output is tiled like the input (out_meta is updated)
+    """
+    # with a clip only the blocks within the window of the shapes are read
+    if clip_shape != "":
+        mask, _, clip_area = clip_window(reference, clip_shape)
+        return mask, clip_area
+    block_height, block_width = reference.block_shapes[0]
+    # use the same tiling as the input so every block is written into exactly one tile
+    if block_width < reference.width and block_height % 16 == 0 and block_width % 16 == 0:
+        out_meta.update({"tiled": True, "blockxsize": block_width, "blockysize": block_height})
+    return None, Window(0, 0, reference.width, reference.height)
+
+
+def _stream_sources(stream, cache_size):
+    """
+    Where the blocks of every band of a stream come from: its memory-mapped pixels (uncompressed files), its
+    band loaded from the cache, or its file, then possibly with a band of the cache it is added to block by block
+    output: returns per band the memory map, the cached band and the cache band being filled (or None, lists)
+    """
+    datasets = stream["datasets"]
+    # uncompressed files are memory-mapped instead of decoded (and not cached)
+    mapped = [memory_map(dataset) for dataset in datasets]
+    # cached bands are read from their npy-files, the others are added to the cache block by block
+    cached = [
+        cache.load(band_path) if cache_size and not isinstance(dataset, WarpedVRT) and band is None else None
+        for band_path, dataset, band in zip(stream["band_paths"], datasets, mapped)
+    ]
+    # skipped blocks would leave holes in bands added to the cache, so they are only added without a cloud mask
+    filling = [
+        cache.create(band_path, dataset.shape, dataset.dtypes[0])
+        if cache_size
+        and stream["cloud_mask"] is None
+        and band is None
+        and mapped[i] is None
+        and stream["clip_shape"] == ""
+        and not isinstance(dataset, WarpedVRT)
+        and dataset.width * dataset.height * np.dtype(dataset.dtypes[0]).itemsize <= cache_size
+        else None
+        for i, (band_path, dataset, band) in enumerate(zip(stream["band_paths"], datasets, cached))
+    ]
+    return mapped, cached, filling
+
+
+def _thread_datasets(stream):
+    """The files of the bands (and the cloud mask, last) of a stream opened by the calling thread"""
+    if stream["compute_threads"] <= 1:
+        return stream["datasets"] + [stream["mask_dataset"]]
+    local = stream["local"]
+    if not hasattr(local, "datasets"):
+        local.datasets = [
+            open_aligned(band_path, stream["grid"], stream["resampling"]) for band_path in stream["band_paths"]
+        ]
+        cloud_mask = stream["cloud_mask"]
+        local.datasets.append(
+            open_aligned(cloud_mask["path"], stream["grid"], "nearest") if cloud_mask else None
         )
-        sys.exit()
-    # specify the band which shall be read and read as float (important!)
-    band = dataset.read(1).astype("float64")
-    dataset.close()
-    return band
+        with stream["lock"]:
+            stream["opened"].append(local.datasets)
+    return local.datasets
+
+
+def _read_block(stream, i, window):
+    """Read the window of the i-th band of a stream (cached, memory-mapped or decoded) as float"""
+    with metrics.stage("read") as measured:
+        if stream["cached"][i] is not None:
+            block = stream["cached"][i][window.toslices()]
+        elif stream["mapped"][i] is not None:
+            block = stream["mapped"][i][window.toslices()]
+        else:
+            block = read_window(_thread_datasets(stream)[i], window, stream["num_threads"])
+            if stream["filling"][i] is not None:
+                stream["filling"][i][window.toslices()] = block
+        measured["bytes"] += block.nbytes
+        measured["pixels"] += block.size
+        return to_float(block, stream["dtype"], stream["nodata"][i], stream["scales"][i])
+
+
+def _block_valid(stream, window, out_window):
+    """Pixels of a window kept by the cloud mask and the clip of a stream (None without cloud mask)"""
+    if stream["mask_dataset"] is None:
+        return None
+    with metrics.stage("read") as measured:
+        classes = read_window(_thread_datasets(stream)[-1], window, stream["num_threads"])
+        measured["bytes"] += classes.nbytes
+        measured["pixels"] += classes.size
+        valid = valid_pixels(stream["cloud_mask"], classes)
+    if stream["clip_mask"] is not None:
+        valid &= ~stream["clip_mask"][out_window.toslices()]
+    return valid
+
+
+def _compute_block(stream, bands, valid):
+    """Calculate the indices of a stream from the bands of a block (only the valid pixels, if given)"""
+    results = []
+    # the buffers of the kernels are allocated for the first block and reused by all others
+    with metrics.stage("compute") as measured, engine.reuse_buffers():
+        for formula, positions in stream["formulas"]:
+            if valid is None:
+                results.append(formula(*[bands[i] for i in positions]))
+            else:
+                results.append(formula(*[bands[i] for i in positions], valid=valid))
+            measured["pixels"] += results[-1].size
+    return results
+
+
+def _write_blocks(stream, results, out_window):
+    """Write the indices of a block into the outputs of a stream and add them to its statistics"""
+    lock = stream["lock"]
+    for result, dest, out_scale, out_stat in zip(
+        results, stream["dests"], stream["out_scales"], stream["out_stats"]
+    ):
+        if out_stat is not None:
+            with metrics.stage("stats") as measured:
+                # the statistics of the block are derived before they are merged, so threads only wait
+                # for each other while merging
+                block_stats = stats.update(stats.new(out_stat["index"], len(out_stat["histogram"])), result)
+                with lock:
+                    stats.merge(out_stat, block_stats)
+                measured["pixels"] += result.size
+        with metrics.stage("write") as measured:
+            block = writing.to_output(result, stream["out_dtype"], out_scale)
+            with lock:
+                dest.write(block, 1, window=out_window)
+            measured["bytes"] += block.nbytes
+            measured["pixels"] += block.size
+
+
+def _stream_block(stream, window):
+    """
+    Read, calculate and write the indices of a window of a stream
+    output: returns True if the window was skipped (no pixel kept by the cloud mask)
+    """
+    clip_area = stream["clip_area"]
+    # position of the window in the output
+    out_window = Window(
+        window.col_off - clip_area.col_off, window.row_off - clip_area.row_off, window.width, window.height
+    )
+    valid = _block_valid(stream, window, out_window)
+    if valid is not None and not valid.any():
+        results = [np.full(valid.shape, np.nan, stream["dtype"])] * len(stream["formulas"])
+        _write_blocks(stream, results, out_window)
+        return True
+    indexes = range(len(stream["band_paths"]))
+    if stream["threads"] > 1:
+        bands = list(stream["executor"].map(lambda i: _read_block(stream, i, window), indexes))
+    else:
+        bands = [_read_block(stream, i, window) for i in indexes]
+    if stream["clip_mask"] is not None:
+        with metrics.stage("clip") as measured:
+            for band in bands:
+                band[stream["clip_mask"][out_window.toslices()]] = np.nan
+                measured["pixels"] += band.size
+    _write_blocks(stream, _compute_block(stream, bands, valid), out_window)
+    return False
+
+
+def read_window(dataset, window, num_threads=None):
+    """Read a window of the first band of an opened dataset"""
+    with rasterio.Env(**({"GDAL_NUM_THREADS": num_threads} if num_threads else {})):
+        return dataset.read(1, window=window)
 
 
-def clip(in_raster, in_shape):
-    """Clip raster file with shape file and generate new raster output file as TIF"""
-    # Since the in_raster variable is a long filepath, we want to cut it to only the filename
-    out_raster = "./data/" + in_raster[-27:-4] + "_clipped.tif"
+def read_mask(cloud_mask, clip_shape, grid=None):
+    """
+    Read the classification band of a cloud mask (only the window of the clip, with nearest resampling if grid
+    differs) and return the pixels it keeps
+    param cloud_mask: path to the file of the band and the classes kept or the bits masking a pixel (dict, like
+    modules.indices_s2.cloud_mask())
+    output: returns a boolean Numpy array, True for the pixels which are kept
+    """
     try:
-        # open the shapefile in reading mode
-        with fiona.open(in_shape, "r") as shapefile:
-            shapes = [feature["geometry"] for feature in shapefile]
-        # open the raster in reading mode to be able to write the info to a new raster file
-        with rasterio.open(in_raster, "r") as src:
-            out_image, out_transform = rasterio.mask.mask(src, shapes, crop=True)
-            # take the metadata of the original rasterfile
-            out_meta = src.meta
-        writing.write_clip(out_raster, out_image, out_transform, out_meta)
+        dataset = open_aligned(cloud_mask["path"], grid, "nearest")
     except Exception as err:
-        print(
-            "...ERROR: unable to clip raster with shapefile: ",
-            str(err),
-            "\nPlease check your input files.",
-        )
-        sys.exit()
-    return out_raster
+        raise RuntimeError("Unable to open raster file: {}. Please check your input file.".format(err)) from err
+    window = None
+    if clip_shape != "":
+        _, _, window = clip_window(dataset, clip_shape)
+    print("...reading cloud mask ./data/.../*{}...".format(cloud_mask["path"][-27:]))
+    with metrics.stage("read") as measured:
+        block = dataset.read(1, window=window)
+        measured["bytes"] += block.nbytes
+        measured["pixels"] += block.size
+    close_aligned(dataset)
+    return valid_pixels(cloud_mask, block)
+
+
+def valid_pixels(cloud_mask, block):
+    """Pixels of a block of a classification band which are kept: of one of the classes or without any of the bits"""
+    if "classes" in cloud_mask:
+        # lookup table of the kept classes, indexed by the class of every pixel
+        kept = np.zeros(max(cloud_mask["classes"] + [int(block.max(initial=0))]) + 1, bool)
+        kept[cloud_mask["classes"]] = True
+        return kept[block]
+    return (block & cloud_mask["bits"]) == 0
+
+
+def block_windows(dataset, min_rows=256):
+    """
+    Yield the native block windows of the first band of a dataset.
+    Thin strips (e.g. one row per strip) are merged to windows of at least min_rows rows
+    """
+    block_height, block_width = dataset.block_shapes[0]
+    if block_width < dataset.width or block_height >= min_rows:
+        for _, window in dataset.block_windows(1):
+            yield window
+        return
+    rows = block_height * -(-min_rows // block_height)
+    for row_off in range(0, dataset.height, rows):
+        yield Window(0, row_off, dataset.width, min(rows, dataset.height - row_off))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time series of an index: datacube of the scenes (time x y x) with running per-pixel aggregates"""
+
+
+import json
+import os
+import warnings
+import numpy as np
+
+
+SERIES_DIR = "./results/series/"
+
+# The datacube of an index is a folder ./results/series/{index}_{satellite}_{resolution}m[_{aoi}]/ (see cube_name(),
+# so scenes of other satellites, resolutions or clips never end up in the same cube) with:
+# - series.json: the scenes in the cube (name, date and file), sorted by date, and the shape of the grid
+# - {date}_{scene}.npy: the index of every scene (one time step, memory-mappable)
+# - aggregates.npz: per pixel number of valid values (count), mean and sum of squared differences from the mean
+#   (m2, Welford's algorithm) and maximum (max, like the maximum NDVI of the season), next to the scenes they
+#   include. So a new scene only updates them instead of reading the whole cube again
+# - anomaly_{date}.npy: difference of a scene from the mean of the scenes added before (baseline) in units of
+#   their std.dev
+# - median.npy: per pixel median composite. Unlike the other aggregates it needs all time steps, so it is
+#   recomputed from the whole cube on demand (save_median(), once per run of the time series)
+# The cube only grows: scenes which are already in it are never calculated again. series.json is written last
+# and the aggregates skip the scenes they already include, so a run which stopped in between never counts
+# a scene twice.
+
+AGGREGATES = ["count", "mean", "m2", "max"]
+
+
+def cube_name(index_name, satellite, resolution, clip_shape=""):
+    """Name of the datacube of an index for a satellite, resolution and clip, like ndvi_s2_10m_aoi"""
+    name = "{}_{}_{}m".format(index_name, satellite, resolution)
+    if clip_shape != "":
+        name += "_" + os.path.splitext(os.path.basename(clip_shape))[0]
+    return name
+
+
+def series_dir(name):
+    """Folder of a datacube"""
+    return SERIES_DIR + name + "/"
+
+
+def load(index_name, name=None):
+    """
+    Return the description of the datacube of an index (empty if it does not exist yet)
+    param name: name of the datacube (see cube_name()), the name of the index if not given
+    """
+    name = name or index_name
+    try:
+        with open(series_dir(name) + "series.json") as json_file:
+            return dict(json.load(json_file), name=name)
+    except FileNotFoundError:
+        return {"index": index_name, "name": name, "shape": None, "scenes": []}
+
+
+def missing_scenes(series, scene_names):
+    """Names of the scenes which are not in the datacube yet"""
+    known = {scene["scene"] for scene in series["scenes"]}
+    return [scene_name for scene_name in scene_names if scene_name not in known]
+
+
+def append(series, scene_name, date, result):
+    """
+    Add the index of a scene to the datacube and update the aggregates with it
+    param series: description of the datacube as returned by load(), which is updated and saved
+    param result: index of the scene on the grid of the datacube (Numpy array)
+    """
+    folder = series_dir(series["name"])
+    os.makedirs(folder, exist_ok=True)
+    if series["shape"] is None:
+        series["shape"] = list(result.shape)
+    elif list(result.shape) != series["shape"]:
+        raise ValueError(
+            "scene {} has the shape {} instead of {} of the datacube".format(
+                scene_name, list(result.shape), series["shape"]
+            )
+        )
+    file_name = "{}_{}.npy".format(date, scene_name)
+    np.save(folder + file_name, result)
+
+    aggregates, included = load_aggregates(folder, result.shape)
+    # the aggregates were saved, but not series.json, if the last run stopped in between
+    if scene_name not in included:
+        count, mean, m2, maximum = (aggregates[name] for name in AGGREGATES)
+        valid = np.isfinite(result)
+        # anomaly against the baseline of the scenes added before, where there are at least two of them
+        with np.errstate(divide="ignore", invalid="ignore"):
+            anomaly = (result - mean) / np.sqrt(m2 / count)
+        anomaly[count < 2] = np.nan
+        np.save(folder + "anomaly_{}.npy".format(date), anomaly.astype(result.dtype))
+        # per pixel Welford update, pixels without a valid value keep their aggregates
+        count += valid
+        delta = np.where(valid, result - mean, 0)
+        mean += np.where(valid, delta / np.maximum(count, 1), 0)
+        m2 += np.where(valid, delta * (result - mean), 0)
+        maximum = np.fmax(maximum, np.where(valid, result, np.nan))
+        save_atomic(
+            folder + "aggregates.npz",
+            lambda out: np.savez(
+                out, count=count, mean=mean, m2=m2, max=maximum, scenes=np.array(included + [scene_name])
+            ),
+        )
+
+    series["scenes"].append({"scene": scene_name, "date": date, "file": file_name})
+    series["scenes"].sort(key=lambda scene: (scene["date"], scene["scene"]))
+    description = {key: value for key, value in series.items() if key != "name"}
+    save_atomic(folder + "series.json", lambda out: out.write(json.dumps(description, indent=2).encode()))
+    return series
+
+
+def save_atomic(path, write):
+    """Write a file through a temporary file, so it is either written completely or not at all"""
+    temp = path + ".{}.tmp".format(os.getpid())
+    with open(temp, "wb") as out:
+        write(out)
+    os.replace(temp, path)
+
+
+def load_aggregates(folder, shape):
+    """
+    Running aggregates (count, mean, m2, max) of a datacube, empty ones for a new datacube
+    output: returns the aggregates (dict of Numpy arrays) and the names of the scenes they include (list)
+    """
+    if not os.path.exists(folder + "aggregates.npz"):
+        empty = {"count": np.zeros(shape, "int32"), "mean": np.zeros(shape), "m2": np.zeros(shape)}
+        return dict(empty, max=np.full(shape, np.nan)), []
+    with np.load(folder + "aggregates.npz") as saved:
+        return {name: saved[name] for name in AGGREGATES}, saved["scenes"].tolist()
+
+
+def save_median(series, rows=1024):
+    """
+    Save the per pixel median of all scenes of the datacube (median.npy). It is recomputed from the whole cube:
+    the time steps are memory-mapped and reduced in chunks of rows, so only rows x width x number of scenes values
+    are in memory at once
+    """
+    folder = series_dir(series["name"])
+    cube = [np.load(folder + scene["file"], mmap_mode="r") for scene in series["scenes"]]
+    out = np.empty(series["shape"], cube[0].dtype)
+    with warnings.catch_warnings():
+        # pixels without any valid value are np.nan
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for row in range(0, series["shape"][0], rows):
+            out[row : row + rows] = np.nanmedian(np.stack([step[row : row + rows] for step in cube]), axis=0)
+    np.save(folder + "median.npy", out)
+    return out
+
+
+def load_cube(index_name, name=None):
+    """Return the dates and the datacube (time x y x) of an index, stacked from its memory-mapped time steps"""
+    series = load(index_name, name)
+    folder = series_dir(series["name"])
+    dates = [scene["date"] for scene in series["scenes"]]
+    return dates, np.stack([np.load(folder + scene["file"], mmap_mode="r") for scene in series["scenes"]])
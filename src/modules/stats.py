@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Statistics of the indices calculated in one pass, block by block and mergeable across blocks and scenes"""
+
+
+import modules.indices as indices
+import numpy as np
+
+
+# The statistics of an index are a dict of running values:
+# - count, mean and m2 (sum of squared differences from the mean) as in Welford's algorithm,
+#   two of them are merged with the formula of Chan et al., so blocks and scenes can be added in any order
+# - min and max
+# - a histogram with fixed bins over the range of the index (from the registry) and the number of values
+#   below and above this range, from which the percentiles are interpolated
+# Pixels which are np.nan or infinite (no data, outside of the clip, masked) are not counted, only added to the
+# number of pixels next to the count of the valid ones.
+
+PERCENTILES = [5, 25, 50, 75, 95]
+
+
+def new(index_name, bins=200):
+    """Return empty statistics of an index with a histogram of the given number of bins over its range"""
+    low, high = indices.INDICES[index_name]["range"]
+    return {
+        "index": index_name,
+        "pixels": 0,
+        "count": 0,
+        "mean": 0.0,
+        "m2": 0.0,
+        "min": np.inf,
+        "max": -np.inf,
+        "range": (low, high),
+        "histogram": np.zeros(bins, "int64"),
+        "below": 0,
+        "above": 0,
+    }
+
+
+def update(stats, block):
+    """
+    Add the values of a block (Numpy array) to the statistics: the finite values are selected once, then
+    min, max, mean, the squared deviations and the histogram each take a pass over them
+    """
+    values = block[np.isfinite(block)]
+    stats["pixels"] += block.size
+    if values.size == 0:
+        return stats
+    low, high = stats["range"]
+    bins = len(stats["histogram"])
+    mean = values.mean(dtype="float64")
+    # bin 0 counts the values below the range, bin bins + 1 those above it
+    positions = np.floor((values - low) * (bins / (high - low)))
+    np.clip(positions, -1, bins, out=positions)
+    positions[values == high] = bins - 1
+    counts = np.bincount(positions.astype("int64") + 1, minlength=bins + 2)
+    block_stats = {
+        "pixels": 0,
+        "count": values.size,
+        "mean": float(mean),
+        "m2": float(np.square(values - mean, dtype="float64").sum()),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "histogram": counts[1:-1],
+        "below": int(counts[0]),
+        "above": int(counts[-1]),
+    }
+    return merge(stats, block_stats)
+
+
+def merge(stats, other):
+    """Merge the statistics of other (like another block or scene of the same index) into stats"""
+    stats["pixels"] += other["pixels"]
+    if other["count"] == 0:
+        return stats
+    count = stats["count"] + other["count"]
+    delta = other["mean"] - stats["mean"]
+    stats["m2"] += other["m2"] + delta**2 * stats["count"] * other["count"] / count
+    stats["mean"] += delta * other["count"] / count
+    stats["count"] = count
+    stats["min"] = min(stats["min"], other["min"])
+    stats["max"] = max(stats["max"], other["max"])
+    stats["histogram"] = stats["histogram"] + other["histogram"]
+    stats["below"] += other["below"]
+    stats["above"] += other["above"]
+    return stats
+
+
+def of_array(index_name, result, rows=1024):
+    """Statistics of a whole result, added in chunks of rows so the temporary arrays stay small"""
+    stats = new(index_name)
+    for row in range(0, result.shape[0], rows):
+        update(stats, result[row : row + rows])
+    return stats
+
+
+def percentile(stats, q):
+    """
+    Percentile q (0-100) interpolated within the bins of the histogram, so it is exact up to the width of a bin.
+    The values below and above the range of the histogram are treated as one bin from the min or to the max
+    """
+    if stats["count"] == 0:
+        return np.nan
+    low, high = stats["range"]
+    histogram = stats["histogram"]
+    rank = q / 100 * stats["count"]
+    if rank <= stats["below"]:
+        return float(stats["min"] + rank / stats["below"] * (low - stats["min"]))
+    cumulative = stats["below"] + np.cumsum(histogram)
+    if rank > cumulative[-1]:
+        return float(high + (rank - cumulative[-1]) / stats["above"] * (stats["max"] - high))
+    i = int(np.searchsorted(cumulative, rank))
+    before = cumulative[i] - histogram[i]
+    width = (high - low) / len(histogram)
+    value = low + (i + (rank - before) / histogram[i]) * width
+    return float(min(max(value, stats["min"]), stats["max"]))
+
+
+def zonal(labels, result, n_zones):
+    """
+    Statistics of a result per zone of a label raster (0 is no zone, 1 to n_zones are the zones),
+    every statistic is derived for all zones at once with bincount or reduced per zone with np.minimum.at and
+    np.maximum.at (no sort of the values)
+    output: returns per statistic (count, mean, std, min, max) an array with the value of every zone
+    """
+    valid = (labels > 0) & np.isfinite(result)
+    zones = labels[valid]
+    values = result[valid].astype("float64")
+    count = np.bincount(zones, minlength=n_zones + 1)[1:]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.bincount(zones, weights=values, minlength=n_zones + 1)[1:] / count
+        m2 = np.bincount(zones, weights=np.square(values - mean[zones - 1]), minlength=n_zones + 1)[1:]
+        std = np.sqrt(m2 / count)
+    # min and max are reduced in place into one value per zone (np.nan stays for empty zones)
+    minimum = np.full(n_zones, np.inf)
+    maximum = np.full(n_zones, -np.inf)
+    np.minimum.at(minimum, zones - 1, values)
+    np.maximum.at(maximum, zones - 1, values)
+    minimum[count == 0] = np.nan
+    maximum[count == 0] = np.nan
+    return {"count": count, "mean": mean, "std": std, "min": minimum, "max": maximum}
+
+
+def summary(stats):
+    """
+    Statistics as plain dict (like for a JSON-file): number of pixels, count of the valid ones, min, max, mean,
+    std.dev, percentiles and histogram
+    """
+    empty = stats["count"] == 0
+    return {
+        "index": stats["index"],
+        "pixels": int(stats["pixels"]),
+        "count": int(stats["count"]),
+        "min": None if empty else stats["min"],
+        "max": None if empty else stats["max"],
+        "mean": None if empty else stats["mean"],
+        "std": None if empty else float(np.sqrt(stats["m2"] / stats["count"])),
+        "percentiles": {"p{}".format(q): None if empty else percentile(stats, q) for q in PERCENTILES},
+        "histogram": {
+            "range": list(stats["range"]),
+            "counts": stats["histogram"].tolist(),
+            "below": int(stats["below"]),
+            "above": int(stats["above"]),
+        },
+    }
@@ -3,188 +3,330 @@
 """Utilities (choose: index function, resolution, plot range; function to plot)"""
 
 
+import modules.indices as indices
 import modules.indices_s2 as indices_s2
 import modules.indices_l8 as indices_l8
+import modules.metrics as metrics
+import modules.reading as reading
+import modules.series as series
+import modules.stats as stats
 import modules.writing as writing
 import os
 import sys
-import matplotlib.pyplot as plt
-import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
-def index_calculator_s2(index_name, resolution, raster_path, clip_shape, optional_val):
-    """Calculates the desired index for Sentintel 2 data and returns a ndarray"""
+def index_calculator_s2(
+    index_names, resolution, raster_path, clip_shape, optional_val, out_rasters=None, read_options=None
+):
+    """
+    Calculates the desired indices for Sentintel 2 data and returns them as ndarrays (None if streamed to
+    out_rasters) next to their resolutions and GeoTIFF profiles.
+    Indices with the same resolution share their bands, which are read once
+    """
     try:
-        calc_resolution = resolution_handler(index_name, resolution)
-        # ignore error messages during calculation
-        np.seterr(divide="ignore", invalid="ignore")
-        if index_name == "arvi":
-            result, calc_resolution = indices_s2.arvi_calc(
-                calc_resolution, raster_path, clip_shape, optional_val
-            )
-        elif index_name == "gci":
-            result, calc_resolution = indices_s2.gci_calc(calc_resolution, raster_path, clip_shape)
-        elif index_name == "gndvi":
-            result, calc_resolution = indices_s2.gndvi_calc(calc_resolution, raster_path, clip_shape)
-        elif index_name == "nbr":
-            result, calc_resolution = indices_s2.nbr_calc(calc_resolution, raster_path, clip_shape)
-        elif index_name == "nbr2":
-            result, calc_resolution = indices_s2.nbr2_calc(calc_resolution, raster_path, clip_shape)
-        elif index_name == "ndbi":
-            result, calc_resolution = indices_s2.ndbi_calc(calc_resolution, raster_path, clip_shape)
-        elif index_name == "ndmi":
-            result, calc_resolution = indices_s2.ndmi_calc(calc_resolution, raster_path, clip_shape)
-        elif index_name == "ndre":
-            result, calc_resolution = indices_s2.ndre_calc(calc_resolution, raster_path, clip_shape)
-        elif index_name == "ndsi":
-            result, calc_resolution = indices_s2.ndsi_calc(calc_resolution, raster_path, clip_shape)
-        elif index_name == "ndvi":
-            result, calc_resolution = indices_s2.ndvi_calc(calc_resolution, raster_path, clip_shape)
-        elif index_name == "ndwi":
-            result, calc_resolution = indices_s2.ndwi_calc(calc_resolution, raster_path, clip_shape)
-        elif index_name == "reip":
-            result, calc_resolution = indices_s2.reip_calc(calc_resolution, raster_path, clip_shape)
-        elif index_name == "savi":
-            result, calc_resolution = indices_s2.savi_calc(
-                calc_resolution, raster_path, clip_shape, optional_val
-            )
-        elif index_name == "sipi":
-            result, calc_resolution = indices_s2.sipi_calc(calc_resolution, raster_path, clip_shape)
+        # without scene batch mode the last scene found is used
+        scene = indices_s2.find_scenes(raster_path)[-1]
+        results, calc_resolutions, profiles = scene_calculator_s2(
+            index_names, resolution, scene, clip_shape, optional_val, out_rasters, read_options
+        )
+    except RuntimeError as err:
+        # the reading functions raise their errors, the program ends with them
+        print("...ERROR: {}".format(err))
+        sys.exit()
     except Exception:
         print(
             "ERROR: Your specified index cannot be calculated yet or doesn't exist.\n Please provide a valid request, check the README for a list of possible indices."
         )
         sys.exit(0)
-    return result, calc_resolution
+    return results, calc_resolutions, profiles
 
 
-def index_calculator_l8(index_name, raster_path, clip_shape, optional_val):
-    """Calculates the desired index for Landsat 8 data and returns a ndarray"""
+def index_calculator_l8(
+    index_names, raster_path, clip_shape, optional_val, out_rasters=None, read_options=None
+):
+    """
+    Calculates the desired indices for Landsat 8 data and returns them as ndarrays (None if streamed to
+    out_rasters) next to their GeoTIFF profiles. The indices share their bands, which are read once
+    """
     try:
-        # ignore error messages during calculation
-        np.seterr(divide="ignore", invalid="ignore")
-        if index_name == "arvi":
-            result = indices_l8.arvi_calc(raster_path, clip_shape, optional_val)
-        elif index_name == "gci":
-            result = indices_l8.gci_calc(raster_path, clip_shape)
-        elif index_name == "nbr":
-            result = indices_l8.nbr_calc(raster_path, clip_shape)
-        elif index_name == "nbr2":
-            result = indices_l8.nbr2_calc(raster_path, clip_shape)
-        elif index_name == "ndbi":
-            result = indices_l8.ndbi_calc(raster_path, clip_shape)
-        elif index_name == "ndmi":
-            result = indices_l8.ndmi_calc(raster_path, clip_shape)
-        elif index_name == "ndsi":
-            result = indices_l8.ndsi_calc(raster_path, clip_shape)
-        elif index_name == "ndvi":
-            result = indices_l8.ndvi_calc(raster_path, clip_shape)
-        elif index_name == "ndwi":
-            result = indices_l8.ndwi_calc(raster_path, clip_shape)
-        elif index_name == "savi":
-            result = indices_l8.savi_calc(raster_path, clip_shape, optional_val)
-        elif index_name == "sipi":
-            result = indices_l8.sipi_calc(raster_path, clip_shape)
+        # without scene batch mode the last scene found is used
+        scene = indices_l8.find_scenes(raster_path)[-1]
+        results, profile = indices_l8.index_calc(
+            index_names, scene, clip_shape, optional_val, out_rasters, read_options
+        )
+    except RuntimeError as err:
+        # the reading functions raise their errors, the program ends with them
+        print("...ERROR: {}".format(err))
+        sys.exit()
     except Exception:
         print(
             "ERROR: Your specified index cannot be calculated yet or doesn't exist.\n Please provide a valid request, check the README for a list of possible indices."
         )
         sys.exit(0)
-    return result
+    return results, [profile] * len(index_names)
+
+
+def scene_calculator_s2(
+    index_names, resolution, scene, clip_shape, optional_val, out_rasters=None, read_options=None
+):
+    """Calculates the indices for one Sentinel 2 scene, grouped by their resolution"""
+    results = [None] * len(index_names)
+    profiles = [None] * len(index_names)
+    calc_resolutions = [resolution_handler(index_name, resolution) for index_name in index_names]
+    for calc_resolution in sorted(set(calc_resolutions)):
+        positions = [i for i, res in enumerate(calc_resolutions) if res == calc_resolution]
+        group_results, profile = indices_s2.index_calc(
+            [index_names[i] for i in positions],
+            calc_resolution,
+            scene,
+            clip_shape,
+            optional_val,
+            [out_rasters[i] for i in positions] if out_rasters is not None else None,
+            read_options,
+        )
+        for i, result in zip(positions, group_results):
+            results[i] = result
+            profiles[i] = profile
+    return results, calc_resolutions, profiles
+
+
+def scene_batch_calculator(
+    satellite, index_names, resolution, raster_path, clip_shape, optional_val, workers, read_options=None
+):
+    """
+    Calculates the desired indices for every scene in raster_path, each scene in its own process.
+    The results are streamed to ./results/{scene}_{index}.tif, returns the paths to the written files.
+    With read_options["statistics"] the statistics of every scene and of all scenes together are saved as well
+    """
+    if satellite in ["s2", "sentinel2", "sentinel"]:
+        scenes = indices_s2.find_scenes(raster_path)
+    elif satellite in ["l8", "landsat8", "landsat"]:
+        scenes = indices_l8.find_scenes(raster_path)
+    else:
+        print(
+            "ERROR: Your specified satellite dataset cannot be used yet or doesn't exist.\n Please provide a valid request, check the README for a list of possible datasets."
+        )
+        return []
+    print("...found {} scenes, calculating with {} processes...".format(len(scenes), workers))
+    written = []
+    want_statistics = "true" if (read_options or {}).get("statistics") else "false"
+    if satellite in ["s2", "sentinel2", "sentinel"]:
+        calc_resolutions = [resolution_handler(index_name, resolution) for index_name in index_names]
+    else:
+        calc_resolutions = [30] * len(index_names)
+    # statistics of all scenes, merged from the statistics of every scene
+    totals = [stats.new(index_name) for index_name in index_names]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for scene in scenes:
+            scene_name = os.path.basename(scene).split(".")[0]
+            out_rasters = ["./results/{}_{}.tif".format(scene_name, index_name) for index_name in index_names]
+            future = executor.submit(
+                _calculate_scene,
+                satellite,
+                index_names,
+                resolution,
+                scene,
+                clip_shape,
+                optional_val,
+                out_rasters,
+                read_options,
+            )
+            futures[future] = (scene_name, out_rasters)
+        for future in as_completed(futures):
+            scene_name, out_rasters = futures[future]
+            try:
+                results, scene_metrics = future.result()
+                metrics.merge(scene_metrics)
+                print("...finished scene {}...".format(scene_name))
+                written.extend(out_rasters)
+                for index_name, result, calc_resolution, total in zip(
+                    index_names, results, calc_resolutions, totals
+                ):
+                    writing.write_statistics(
+                        index_name, result, calc_resolution, want_statistics, scene_name + "_"
+                    )
+                    if result is not None:
+                        stats.merge(total, result)
+            except Exception as err:
+                # one broken scene does not stop the others
+                print("...ERROR: unable to calculate scene {}: {}".format(scene_name, err))
+    for index_name, calc_resolution, total in zip(index_names, calc_resolutions, totals):
+        writing.write_statistics(index_name, total, calc_resolution, want_statistics)
+    return written
+
+
+def time_series_calculator(
+    satellite, index_names, resolution, raster_path, clip_shape, optional_val, read_options=None
+):
+    """
+    Adds the desired indices of every scene in raster_path which is not in their datacube yet
+    (./results/series/{index}/, see modules.series) in the order of the acquisition dates.
+    Returns the names of the added scenes
+    """
+    if satellite in ["s2", "sentinel2", "sentinel"]:
+        module = indices_s2
+    elif satellite in ["l8", "landsat8", "landsat"]:
+        module = indices_l8
+    else:
+        print(
+            "ERROR: Your specified satellite dataset cannot be used yet or doesn't exist.\n Please provide a valid request, check the README for a list of possible datasets."
+        )
+        return []
+    # every satellite, resolution and clip has its own datacube
+    satellite = "s2" if module is indices_s2 else "l8"
+    cubes = [
+        series.load(
+            index_name,
+            series.cube_name(
+                index_name,
+                satellite,
+                (resolution or indices.INDICES[index_name]["resolutions"][0]) if satellite == "s2" else 30,
+                clip_shape,
+            ),
+        )
+        for index_name in index_names
+    ]
+    scenes = sorted(module.find_scenes(raster_path), key=module.scene_date)
+    names = {scene: os.path.basename(scene).split(".")[0] for scene in scenes}
+    new_scenes = [
+        scene for scene in scenes if any(series.missing_scenes(cube, [names[scene]]) for cube in cubes)
+    ]
+    print("...found {} scenes, {} of them are new...".format(len(scenes), len(new_scenes)))
+    added = []
+    for scene in new_scenes:
+        # only the indices which do not have the scene yet are calculated
+        missing = [i for i, cube in enumerate(cubes) if series.missing_scenes(cube, [names[scene]])]
+        try:
+            if module is indices_s2:
+                results, _, _ = scene_calculator_s2(
+                    [index_names[i] for i in missing],
+                    resolution,
+                    scene,
+                    clip_shape,
+                    optional_val,
+                    None,
+                    read_options,
+                )
+            else:
+                results, _ = indices_l8.index_calc(
+                    [index_names[i] for i in missing], scene, clip_shape, optional_val, None, read_options
+                )
+            for i, result in zip(missing, results):
+                with metrics.stage("write") as measured:
+                    series.append(cubes[i], names[scene], module.scene_date(scene), result)
+                    measured["bytes"] += result.nbytes
+                    measured["pixels"] += result.size
+        except Exception as err:
+            # one broken scene does not stop the others
+            print("...ERROR: unable to add scene {}: {}".format(names[scene], err))
+            continue
+        print("...added scene {} ({})...".format(names[scene], module.scene_date(scene)))
+        added.append(names[scene])
+    # the median needs all time steps, so it is only recomputed once after all new scenes were added
+    for cube in cubes:
+        if added and cube["scenes"]:
+            with metrics.stage("stats"):
+                series.save_median(cube)
+    return added
+
+
+def _calculate_scene(
+    satellite, index_names, resolution, scene, clip_shape, optional_val, out_rasters, read_options
+):
+    """
+    Calculates the indices for one scene (runs in a worker process of scene_batch_calculator),
+    returns their statistics if read_options["statistics"], otherwise None per index,
+    next to the metrics of the stages of the scene
+    """
+    # the worker only returns the metrics of this scene, not the ones it inherited or collected before
+    metrics.reset()
+    if satellite in ["s2", "sentinel2", "sentinel"]:
+        results, _, _ = scene_calculator_s2(
+            index_names, resolution, scene, clip_shape, optional_val, out_rasters, read_options
+        )
+    else:
+        results, _ = indices_l8.index_calc(
+            index_names, scene, clip_shape, optional_val, out_rasters, read_options
+        )
+    return results, metrics.collect()
+
+
+def zonal_statistics(index_name, result, profile, clip_shape, want_zonal):
+    """
+    Checks if the user wants statistics per feature of the shapefile and derives them: all features are
+    rasterized once into a label raster on the grid of the result, which is reduced per label in one pass
+    """
+    if want_zonal in ["y", "yes", "true"]:
+        print("...deriving zonal statistics...")
+        with metrics.stage("stats") as measured:
+            try:
+                ids = reading.shape_ids(clip_shape)
+                labels = reading.zone_labels(profile, clip_shape)
+            except RuntimeError as err:
+                print("...ERROR: {}".format(err))
+                sys.exit()
+            writing.write_zonal(index_name, stats.zonal(labels, result, len(ids)), ids)
+            measured["pixels"] += result.size
 
 
 def resolution_handler(index_name, resolution):
-    """Only specific indices can be calculated with a spatial resolution of 10 m"""
-    if index_name in ["gndvi"]:
-        if resolution == "":
-            calc_resolution = "60"
-        elif resolution == "10" or resolution == "20":
-            print("{} can only be calculated with a spatial resolution of 60 m.".format(index_name.upper()))
-            calc_resolution = "60"
-    elif index_name in ["nbr", "nbr2", "ndbi", "ndmi", "ndre", "ndsi", "reip"]:
-        if resolution == "":
-            calc_resolution = "20"
-        elif resolution == "10":
-            print("{} cannot be calculated with a spatial resolution of 10 m.".format(index_name.upper()))
-            calc_resolution = "20"
-        else:
-            calc_resolution = resolution
-    elif index_name in ["arvi", "gci", "ndvi", "ndwi", "savi", "sipi"]:
-        if resolution == "":
-            calc_resolution = "10"
-        else:
-            calc_resolution = resolution
-    return calc_resolution
+    """
+    Only specific indices have all their bands with a spatial resolution of 10 m. By default the highest of these
+    resolutions is used, a higher resolution given by the user is calculated with resampled bands
+    """
+    resolutions = indices.INDICES[index_name]["resolutions"]
+    if resolution == "":
+        return resolutions[0]
+    if resolution not in resolutions:
+        print(
+            "{} has not all bands with a spatial resolution of {} m, the coarser bands are resampled.".format(
+                index_name.upper(), resolution
+            )
+        )
+    return resolution
 
 
 def plottype_handler(index_name, result):
     """Choose parameters for the plot depending on the calculated index"""
-    if index_name in ["arvi"]:
-        plt.imshow(result, cmap="RdYlGn")
-        plt.clim(-0.2, 0.8)  # range -1 to 1
-    elif index_name in ["gci"]:
-        plt.imshow(result, cmap="Greens")
-        plt.clim(0, 1.1)  # range 0 to 2
-    elif index_name in ["nbr", "nbr2"]:
-        plt.imshow(result, cmap="RdYlGn")
-        plt.clim(-1, 1)  # range -1 to 1
-    elif index_name in ["ndbi", "ndwi"]:
-        plt.imshow(result, cmap="BrBG")
-        plt.clim(-0.1, 0.1)  # range -1 to 1
-    elif index_name in ["ndmi"]:
-        plt.imshow(result, cmap="jet_r")
-        plt.clim(-0.2, 0.4)  # range -1 to 1
-    elif index_name in ["gndvi", "ndre", "ndvi", "savi"]:
-        plt.imshow(result, cmap="RdYlGn")
-        plt.clim(-0.15, 0.45)  # range -1 to 1
-    elif index_name in ["ndsi"]:
-        plt.imshow(result, cmap="Blues")
-        plt.clim(0.2, 0.42)  # range -1 to 1
-    elif index_name in ["reip"]:
-        plt.imshow(result, cmap="Greens")
-        plt.clim(700, 740)  # range 700 to 740
-    elif index_name in ["sipi"]:
-        plt.imshow(result, cmap="Greens")
-        plt.clim(0.7, 1.8)  # range 0 to 2
+    plt = writing.pyplot(show=True)
+    if index_name in indices.INDICES:
+        plot = indices.INDICES[index_name]["plot"]
+        plt.imshow(result, cmap=plot["cmap"])
+        plt.clim(*plot["clim"])
     else:
         plt.imshow(result)  # viridis is the default cmap
 
 
 def plot_result(index_name, result, calc_resolution, want_plot, want_plot_saved):
     """Depending on the index, this plots the calculated results differently"""
-    while want_plot not in ["true", "false"]:
-        want_plot = input("Do you want to generate a plot? Use y/n: ")
-        if want_plot in ["y", "yes"] or want_plot in ["n", "no"]:
-            break
-        print("ERROR: Please provide a valid input.")
     if want_plot in ["y", "yes", "true"]:
-        plt.figure()
-        plt.title(
-            "Calculated {} for region of interest with spatial resolution of {} m".format(
-                index_name.upper(), calc_resolution
+        with metrics.stage("plot"):
+            plt = writing.pyplot(show=True)
+            plt.figure()
+            plt.title(
+                "Calculated {} for region of interest with spatial resolution of {} m".format(
+                    index_name.upper(), calc_resolution
+                )
             )
-        )
-        plt.xlabel("X-Axis")
-        plt.ylabel("Y-Axis")
-        # use different cmaps and limits depending on the calculated index
-        plottype_handler(index_name, result)
-        # plot a colorbar with the same height as the plot
-        im_ratio = result.shape[0] / result.shape[1]
-        plt.colorbar(fraction=0.04625 * im_ratio)
-        # check if user wants to save the plot
-        writing.save_plot(want_plot_saved, index_name, calc_resolution)
-        plt.tight_layout()
-        print("Awaiting user interaction to continue (close plot window)...")
-        plt.show()
-        print("...thanks!")
+            plt.xlabel("X-Axis")
+            plt.ylabel("Y-Axis")
+            # use different cmaps and limits depending on the calculated index
+            plottype_handler(index_name, result)
+            # plot a colorbar with the same height as the plot
+            im_ratio = result.shape[0] / result.shape[1]
+            plt.colorbar(fraction=0.04625 * im_ratio)
+            # check if user wants to save the plot
+            writing.save_plot(want_plot_saved, index_name, calc_resolution)
+            plt.tight_layout()
+        if plt.get_backend().lower() == "agg":
+            # nothing can be shown without a display, the figure is only saved (if wanted)
+            print("...no display to show the plot on, it is not shown.")
+            plt.close()
+        else:
+            print("Awaiting user interaction to continue (close plot window)...")
+            plt.show()
+            print("...thanks!")
     else:
         pass
-
-
-def cleanup_temp():
-    """Loop through ./data/ and delete files no longer needed"""
-    retain = ["raster", "shapes"]
-
-    for item in os.listdir("./data/"):
-        if item not in retain:
-            os.remove("./data/" + item)
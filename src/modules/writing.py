@@ -3,123 +3,245 @@
 """Functions to write data (raster/txt/plots)"""
 
 
-import glob
-import warnings
+import modules.indices as indices
+import modules.metrics as metrics
+import modules.stats as stats
+import csv
+import json
+import os
 import rasterio
-import matplotlib.pyplot as plt
+import rasterio.shutil
+import sys
 import numpy as np
 
 
-def write_clip(out_raster, out_image, out_transform, out_meta):
-    """Use metadata of masked raster file to write a new clipped raster file"""
-    out_meta.update(
-        {
-            "driver": "GTiff",
-            "height": out_image.shape[1],
-            "width": out_image.shape[2],
-            "transform": out_transform,
-            "dtype": "float64",
-            "nodata": np.nan,
-        }
-    )
-    # open a new raster file and write the information into it
-    with rasterio.open(out_raster, "w", **out_meta) as dest:
-        dest.write(out_image)
-
-
-def write_txt(index_name, result, want_txt_saved):
-    """Checks if the user wants to locally save the results as txt-file and does it"""
-    while want_txt_saved not in ["true", "false"]:
-        want_txt_saved = input("Do you want to save the results/ndarray as txt-file as well? Use y/n: ")
-        if want_txt_saved in ["y", "yes"] or want_txt_saved in ["n", "no"]:
-            break
-        print("ERROR: Please provide a valid input.")
+# Null value of indices stored as scaled int16
+INT16_NODATA = -32768
+
+
+# formats the results/ndarray can be saved as, zarr and parquet need the optional packages zarr and pyarrow
+ARRAY_FORMATS = {"npy": None, "zarr": "zarr", "parquet": "pyarrow", "txt": None}
+
+
+def is_headless():
+    """Check if there is no display to show plot windows on (like on servers and in batch jobs)"""
+    if sys.platform in ["win32", "darwin"]:
+        return False
+    return not (os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+
+
+def pyplot(show=False):
+    """
+    Import matplotlib.pyplot only once something is plotted, as its import takes longer than most short runs.
+    If no window is shown (show is false or there is no display), the non-GUI backend Agg is used,
+    which is faster to load than the interactive ones. A backend set with MPLBACKEND is kept
+    """
+    if "matplotlib.pyplot" not in sys.modules and not os.environ.get("MPLBACKEND"):
+        import matplotlib
+
+        if not show or is_headless():
+            matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
+def write_array(index_name, result, want_txt_saved, array_format="npy"):
+    """Checks if the user wants to locally save the results/ndarray as file and does it in the given format"""
     if want_txt_saved in ["y", "yes", "true"]:
-        print("...writing result to file...")
-        np.savetxt("./results/{}.txt".format(index_name), result)
+        print("...writing result to {}-file...".format(array_format))
+        with metrics.stage("write") as measured:
+            if array_format == "zarr":
+                write_zarr("./results/{}.zarr".format(index_name), result)
+            elif array_format == "parquet":
+                write_parquet("./results/{}.parquet".format(index_name), result)
+            elif array_format == "txt":
+                np.savetxt("./results/{}.txt".format(index_name), result)
+            else:
+                # binary and memory-mappable with np.load(..., mmap_mode="r")
+                np.save("./results/{}.npy".format(index_name), result)
+            measured["bytes"] += result.nbytes
+            measured["pixels"] += result.size
     else:
         pass
 
 
+def write_zarr(out_file, result, chunks=512):
+    """Save the results/ndarray as chunked and compressed Zarr array (needs the optional package zarr)"""
+    import zarr
+
+    array = zarr.open_array(
+        store=out_file,
+        mode="w",
+        shape=result.shape,
+        chunks=(min(chunks, result.shape[0]), min(chunks, result.shape[1])),
+        dtype=result.dtype,
+        fill_value=np.nan,
+    )
+    array[:] = result
+
+
+def write_parquet(out_file, result):
+    """
+    Save the valid pixels (not np.nan) of the results/ndarray as Parquet table with the columns row, col and value,
+    which is small for clipped results (needs the optional package pyarrow)
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    rows, cols = np.nonzero(~np.isnan(result))
+    table = pyarrow.table(
+        {
+            "row": rows.astype("int32"),
+            "col": cols.astype("int32"),
+            "value": result[rows, cols],
+        }
+    )
+    pyarrow.parquet.write_table(table, out_file, compression="zstd")
+
+
 def save_plot(want_plot_saved, index_name, calc_resolution):
     """Checks if the user wants to locally save the figure and does it"""
-    while want_plot_saved not in ["true", "false"]:
-        want_plot_saved = input("Do you want to save the plot as figure? Use y/n: ")
-        if want_plot_saved in ["y", "yes"] or want_plot_saved in ["n", "no"]:
-            break
-        print("ERROR: Please provide a valid input.")
     if want_plot_saved in ["y", "yes", "true"]:
         print("Plot saved to file.")
-        plt.savefig("./results/{}_{}.png".format(index_name.lower(), calc_resolution), bbox_inches="tight")
+        pyplot().savefig("./results/{}_{}.png".format(index_name.lower(), calc_resolution), bbox_inches="tight")
     else:
         pass
 
 
-def write_raster(index_name, calc_resolution, raster_path, clip_shape, want_raster_saved, result):
+def write_raster(index_name, profile, want_raster_saved, result):
     """Checks if the user wants to export the results as tif-file and does it"""
-    while want_raster_saved not in ["true", "false"]:
-        want_raster_saved = input("Do you want to export the results as tif-file? Use y/n: ")
-        if want_raster_saved in ["y", "yes"] or want_raster_saved in ["n", "no"]:
-            break
-        print("ERROR: Please provide a valid input.")
     if want_raster_saved in ["y", "yes", "true"]:
         print("...exporting raster to file...")
-        # search for reference raster
-        if clip_shape != "":
-            for item in glob.glob("./data/*.tif"):
-                in_raster = item
-        else:
-            for item in glob.glob(raster_path + "*/GRANULE/*/IMG_DATA/R" + calc_resolution + "m/*_B02*.jp2"):
-                in_raster = item
-
-        # read metadata of raster
-        with rasterio.open(in_raster, "r") as src:
-            res_meta = src.profile
-            res_meta.update(
-                {
-                    "dtype": "float64",
-                    "nodata": np.nan,
-                }
-            )
-
-        # open a new raster file and write the information into it
-        with rasterio.open("./results/{}.tif".format(index_name), "w", **res_meta) as dest:
-            dest.write(result, indexes=1)
+        # open a new raster file with the profile of the (clipped) input and write the information into it
+        out_scale = indices.output_scale(index_name)
+        out_raster = "./results/{}.tif".format(index_name)
+        with metrics.stage("write") as measured:
+            dest = open_raster(out_raster, profile, out_scale)
+            output = to_output(result, profile["dtype"], out_scale)
+            dest.write(output, indexes=1)
+            close_raster(dest, out_raster, profile)
+            measured["bytes"] += output.nbytes
+            measured["pixels"] += output.size
     else:
         pass
 
 
-def write_statistics(index_name, result, calc_resolution, want_statistics):
-    """Checks if the user wants to generate statistics and does it"""
-    while want_statistics not in ["true", "false"]:
-        want_statistics = input("Do you want to generate statistics? Use y/n: ")
-        if want_statistics in ["y", "yes"] or want_statistics in ["n", "no"]:
-            break
-        print("ERROR: Please provide a valid input.")
+def open_raster(out_raster, profile, out_scale=None):
+    """
+    Open a new GeoTIFF for an index with the given profile.
+    For int16 profiles, the scale and offset of the index (out_scale) are tagged to the band,
+    so GIS software reads the original values.
+    Cloud-Optimized GeoTIFFs (driver COG) are written block by block to a temporary tiled GeoTIFF first,
+    which close_raster() converts
+    """
+    if profile["driver"] == "COG":
+        out_raster = out_raster + ".tmp"
+        profile = {key: value for key, value in profile.items() if key != "compress"}
+        profile.update({"driver": "GTiff", "tiled": True})
+        profile.setdefault("blockxsize", 512)
+        profile.setdefault("blockysize", 512)
+    dest = rasterio.open(out_raster, "w", **profile)
+    if profile["dtype"] == "int16" and out_scale is not None:
+        dest.scales, dest.offsets = (out_scale[0],), (out_scale[1],)
+    return dest
+
+
+def close_raster(dest, out_raster, profile):
+    """
+    Close a GeoTIFF opened with open_raster(). For Cloud-Optimized GeoTIFFs the temporary GeoTIFF is copied
+    into 512x512 tiles compressed with a predictor by all CPUs, overviews are added and it is deleted afterwards
+    """
+    dest.close()
+    if profile["driver"] == "COG":
+        print("...building overviews and compressing {}...".format(out_raster))
+        rasterio.shutil.copy(
+            out_raster + ".tmp",
+            out_raster,
+            driver="COG",
+            compress=profile["compress"],
+            predictor="YES",
+            num_threads="ALL_CPUS",
+            blocksize=512,
+            overviews="AUTO",
+            resampling="average",
+        )
+        os.remove(out_raster + ".tmp")
+
+
+def to_output(result, dtype, out_scale=None):
+    """
+    Convert a calculated index into the data type of the GeoTIFF.
+    As int16 the values are stored as round((value - offset) / scale), np.nan becomes INT16_NODATA.
+    Raises ValueError for int16 without a scale (only normalized differences are stored as int16)
+    """
+    if dtype != "int16":
+        return result.astype(dtype, copy=False)
+    if out_scale is None:
+        raise ValueError("Only normalized differences can be stored as int16, use float32 instead")
+    scale, offset = out_scale
+    scaled = np.round((result - offset) / scale)
+    np.clip(scaled, INT16_NODATA + 1, np.iinfo("int16").max, out=scaled)
+    scaled[np.isnan(result)] = INT16_NODATA
+    return scaled.astype("int16")
+
+
+def write_statistics(index_name, result, calc_resolution, want_statistics, prefix=""):
+    """
+    Checks if the user wants to generate statistics and does it.
+    result is the calculated array or its statistics (dict of modules.stats, like when it was streamed),
+    the statistics are saved to ./results/{prefix}{index}_stats.json and plotted to {prefix}{index}_hist.png
+    """
     if want_statistics in ["y", "yes", "true"]:
-        warnings.filterwarnings(action="ignore", message="All-NaN slice encountered")
+        print("...deriving statistics...")
+        with metrics.stage("stats") as measured:
+            summary = stats.summary(result if isinstance(result, dict) else stats.of_array(index_name, result))
+            with open("./results/{}{}_stats.json".format(prefix, index_name.lower()), "w") as json_file:
+                json.dump(dict(summary, resolution=calc_resolution), json_file, indent=2)
+            measured["pixels"] += summary["pixels"]
         # generate histogram and save it as file
-        plt.figure()
-        plt.title(
-            "Calculated {} for region of interest with spatial resolution of {} m".format(
-                index_name.upper(), calc_resolution
-            )
-        )
-        plt.xlabel("X-Axis")
-        plt.ylabel("Y-Axis")
         print("...generating histogram...")
-        if index_name in ["gci", "reip", "savi", "sipi"]:
-            print("...cannot calculate yet. Check issues...")
-            return
-        else:
-            plt.hist(result, range=[-1, 1])
-        print("...deriving statistics...")
-        plt.figtext(
-            0.91,
-            0.7,
-            "Statistics of {} \n  Minimum: {:.2f}\n  Maximum: {:.2f}\n  Mean: {:.2f}\n  Std.dev: {:.2f}".format(
-                index_name.upper(), np.nanmin(result), np.nanmax(result), np.nanmean(result), np.nanstd(result)
-            ),
-        )
-        print("...saving statistical results...")
-        plt.savefig("./results/{}_hist.png".format(index_name.lower()), bbox_inches="tight")
+        with metrics.stage("plot"):
+            plt = pyplot()
+            plt.figure()
+            plt.title(
+                "Calculated {} for region of interest with spatial resolution of {} m".format(
+                    index_name.upper(), calc_resolution
+                )
+            )
+            plt.xlabel("{} value".format(index_name.upper()))
+            plt.ylabel("Number of pixels")
+            low, high = summary["histogram"]["range"]
+            counts = summary["histogram"]["counts"]
+            plt.stairs(counts, np.linspace(low, high, len(counts) + 1), fill=True)
+            if summary["count"] > 0:
+                plt.figtext(
+                    0.91,
+                    0.7,
+                    "Statistics of {} \n  Valid pixels: {}\n  Minimum: {:.2f}\n  Maximum: {:.2f}\n  Mean: {:.2f}\n  Std.dev: {:.2f}\n  Median: {:.2f}".format(
+                        index_name.upper(),
+                        summary["count"],
+                        summary["min"],
+                        summary["max"],
+                        summary["mean"],
+                        summary["std"],
+                        summary["percentiles"]["p50"],
+                    ),
+                )
+            print("...saving statistical results...")
+            plt.savefig("./results/{}{}_hist.png".format(prefix, index_name.lower()), bbox_inches="tight")
+            plt.close()
+
+
+def write_zonal(index_name, zones, ids):
+    """
+    Save the statistics of every feature of the shapefile (like calculated with modules.stats.zonal)
+    to ./results/{index}_zonal.csv, one row per feature keyed by its ID
+    """
+    print("...saving zonal statistics of {} features...".format(len(ids)))
+    columns = ["count", "mean", "std", "min", "max"]
+    with open("./results/{}_zonal.csv".format(index_name.lower()), "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["id"] + columns)
+        for i, feature_id in enumerate(ids):
+            writer.writerow([feature_id] + [zones[column][i] for column in columns])
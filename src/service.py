@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Local HTTP service calculating indices with modules.api, keeping the parsed scenes and shapes in memory"""
+
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from modules.api import compute_index
+import modules.indices as indices
+import modules.stats as stats
+import modules.writing as writing
+import argparse
+import json
+import os
+import time
+import traceback
+import numpy as np
+
+
+# The service runs as long-lived process, so the manifests of the scenes, the clip shapes, their windows and the
+# reference grids are only parsed by the first request and reused by all following ones. The options for reading
+# and calculating (threads, compute threads, cache, data type and resampling, like the options of main.py) are
+# given when the service is started and used by every request.
+#
+# GET /health answers {"status": "ok"}
+# POST /compute takes a JSON object like
+#     {"scene": "./data/raster/S2A_MSIL2A_....SAFE", "index": "ndvi" or ["ndvi", "ndmi"], "aoi": "aoi.shp",
+#      "resolution": "20", "optional_val": "", "clouds": false, "statistics": true, "raster": false}
+# and answers per index its resolution, shape, number of valid pixels, CRS and transform, the statistics (if "statistics") and the path to
+# the GeoTIFF written to ./results/{scene}_{index}.tif (if "raster").
+
+
+def compute(request, read_options=None):
+    """
+    Calculate the indices of a request (dict from the JSON body) and return the response (dict)
+    param read_options: options of the service for reading and calculating (see modules.reading.calc_indices())
+    """
+    index_names = [request["index"]] if isinstance(request["index"], str) else list(request["index"])
+    scene = request["scene"]
+    starttime = time.time()
+    results, profiles = compute_index(
+        scene,
+        index_names,
+        aoi=request.get("aoi", ""),
+        resolution=request.get("resolution", ""),
+        optional_val=request.get("optional_val", ""),
+        read_options=dict(read_options or {}, clouds=bool(request.get("clouds", False))),
+    )
+    response = {"scene": scene, "indices": {}}
+    for index_name, result, profile in zip(index_names, results, profiles):
+        entry = {
+            "resolution": abs(profile["transform"][0]),
+            "shape": list(result.shape),
+            "valid": int(np.count_nonzero(np.isfinite(result))),
+            "crs": profile["crs"].to_string() if profile["crs"] else None,
+            "transform": list(profile["transform"])[:6],
+        }
+        if request.get("statistics", False):
+            entry["statistics"] = stats.summary(stats.of_array(index_name, result))
+        if request.get("raster", False):
+            out_raster = "./results/{}_{}.tif".format(
+                os.path.basename(os.path.normpath(scene)).split(".")[0], index_name
+            )
+            out_scale = indices.output_scale(index_name)
+            dest = writing.open_raster(out_raster, profile, out_scale)
+            dest.write(writing.to_output(result, profile["dtype"], out_scale), indexes=1)
+            writing.close_raster(dest, out_raster, profile)
+            entry["raster"] = out_raster
+        response["indices"][index_name] = entry
+    response["seconds"] = round(time.time() - starttime, 3)
+    return response
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Answers the requests of the service with JSON"""
+
+    # options of the service for reading and calculating, set when it is started
+    read_options = {}
+
+    def do_GET(self):
+        """Answer GET /health"""
+        if self.path == "/health":
+            self.answer(200, {"status": "ok"})
+        else:
+            self.answer(404, {"error": "unknown path {}".format(self.path)})
+
+    def do_POST(self):
+        """Answer POST /compute with the indices of the request"""
+        if self.path != "/compute":
+            self.answer(404, {"error": "unknown path {}".format(self.path)})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            self.answer(200, compute(request, self.read_options))
+        except (KeyError, TypeError, ValueError) as err:
+            self.answer(400, {"error": "bad request: {}".format(err)})
+        except RuntimeError as err:
+            self.answer(500, {"error": str(err)})
+        except Exception as err:
+            # any other error is a bug: it is logged with its traceback and the service keeps running
+            self.log_error("...ERROR: %r", err)
+            traceback.print_exc()
+            self.answer(500, {"error": "internal error: {}".format(err)})
+
+    def answer(self, status, body):
+        """Send the body (dict) as JSON with the status"""
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Local service calculating indices, POST a JSON object to /compute (see the README)"
+    )
+    parser.add_argument(
+        "-host", dest="host", default="127.0.0.1", help="Address to listen on, default 127.0.0.1"
+    )
+    parser.add_argument("-p", dest="port", type=int, default=8750, help="Port to listen on, default 8750")
+    parser.add_argument(
+        "-t", dest="threads", type=int, default=1, help="Number of bands decoded at the same time, default 1"
+    )
+    parser.add_argument(
+        "-ct",
+        dest="compute_threads",
+        type=int,
+        default=1,
+        help="Number of threads calculating the indices of a request at the same time, default 1",
+    )
+    parser.add_argument(
+        "-cache",
+        dest="cache_size",
+        type=int,
+        default=0,
+        help="Size (MB) of the cache in ./data/cache/ keeping decoded bands, default 0 (no cache)",
+    )
+    parser.add_argument(
+        "-dtype",
+        dest="dtype",
+        choices=["float64", "float32"],
+        default="float64",
+        help="Data type of the calculation and the exported tif-files, default float64",
+    )
+    parser.add_argument(
+        "-rs",
+        dest="resampling",
+        choices=["nearest", "bilinear", "cubic", "average"],
+        default="bilinear",
+        help="Method to resample bands which are not available with the resolution, default bilinear",
+    )
+    args = parser.parse_args()
+    if min(args.threads, args.compute_threads) < 1 or args.cache_size < 0:
+        parser.error("-t and -ct need at least 1, -cache at least 0")
+
+    Handler.read_options = {
+        "threads": args.threads,
+        "compute_threads": args.compute_threads,
+        "cache": args.cache_size * 1024 * 1024,
+        "dtype": args.dtype,
+        "output": args.dtype,
+        "resampling": args.resampling,
+    }
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print("Serving on http://{}:{}/ (Ctrl+C to stop)...".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    print("...stopped.")
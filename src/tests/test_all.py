@@ -3,7 +3,34 @@
 """Testing the functions"""
 
 
-from modules.utils import resolution_handler
+from modules.api import compute_index
+from modules.chk_args import _check_input_arguments
+import benchmark
+from modules.utils import resolution_handler, scene_batch_calculator
+from modules.reading import calc_index, calc_indices, read_rasters
+import modules.reading as reading
+import modules.cache as cache
+import modules.indices_l8 as indices_l8
+import modules.indices_s2 as indices_s2
+import modules.manifest as manifest
+import modules.metrics as metrics
+import modules.series as series
+import modules.stats as stats
+from modules.engine import compile_formula, evaluate, kernel, reuse_buffers
+from modules.indices import INDICES, output_scale
+from modules.writing import to_output, write_array
+from rasterio.transform import from_origin
+import json
+import os
+import subprocess
+import sys
+import tracemalloc
+import warnings
+import numpy as np
+import fiona
+import pytest
+import rasterio
+import rasterio.warp
 
 
 def test_resolution_handler():
@@ -16,3 +43,703 @@ def test_resolution_handler():
 
     assert int(calc_resolution_ndmi) == test_resolution_ndmi
     assert int(calc_resolution_ndvi) == test_resolution_ndvi
+
+
+def _write_band(path, array, blocksize=32):
+    """Writes a synthetic tiled band to a GeoTIFF"""
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=array.shape[0],
+        width=array.shape[1],
+        count=1,
+        dtype=array.dtype,
+        crs="EPSG:32632",
+        transform=from_origin(399960, 5600040, 10, 10),
+        tiled=True,
+        blockxsize=blocksize,
+        blockysize=blocksize,
+    ) as dest:
+        dest.write(array, 1)
+    return str(path)
+
+
+def test_arguments_are_checked_into_a_namespace(monkeypatch):
+    """Tests if the arguments are returned by name and invalid or conflicting ones are asked for or changed"""
+    argv = ["main.py", "-i", "ndvi,gci", "-sat", "l8", "-dtype", "int16", "-stream", "true", "-sp", "true"]
+    monkeypatch.setattr(sys, "argv", argv + ["-t", "0", "-cache", "64"])
+    answers = iter(["2", "float32"])
+    monkeypatch.setattr("builtins.input", lambda prompt: next(answers))
+
+    args = _check_input_arguments()
+
+    assert args.index_names == ["ndvi", "gci"] and args.resolution == 30
+    # the GCI cannot be stored as int16, so float32 was asked for
+    assert args.threads == 2 and args.dtype == "float32"
+    assert args.cache_size == 64 * 1024 * 1024
+    assert args.want_stream == "true" and args.want_plot_saved == "false"
+
+    # unknown indices end the program before anything is calculated
+    monkeypatch.setattr(sys, "argv", ["main.py", "-i", "ndvi,unknown", "-series", "true"])
+    with pytest.raises(SystemExit):
+        _check_input_arguments()
+
+
+def test_streaming_matches_whole_array(tmp_path):
+    """Tests if the index streamed block by block equals the index calculated on whole arrays"""
+    rng = np.random.default_rng(0)
+    b4 = _write_band(tmp_path / "b4.tif", rng.integers(1, 10000, (100, 90)).astype("uint16"))
+    b8 = _write_band(tmp_path / "b8.tif", rng.integers(1, 10000, (100, 90)).astype("uint16"))
+    formula = lambda b4, b8: (b8 - b4) / (b8 + b4)  # noqa: E731
+
+    whole = calc_index([b4, b8], "", formula)
+    streamed = calc_index([b4, b8], "", formula, str(tmp_path / "ndvi.tif"))
+
+    assert streamed is None
+    with rasterio.open(tmp_path / "ndvi.tif") as src:
+        assert src.block_shapes[0] == (32, 32)
+        assert np.allclose(src.read(1), whole)
+
+
+def test_uncompressed_stripped_bands_are_memory_mapped(tmp_path, monkeypatch):
+    """Tests if uncompressed stripped bands are memory-mapped, read like with GDAL, and others decoded by GDAL"""
+    rng = np.random.default_rng(0)
+    array = rng.integers(0, 10000, (100, 90)).astype("uint16")
+    profile = {"driver": "GTiff", "height": 100, "width": 90, "count": 1, "dtype": "uint16", "blockysize": 8}
+    profile.update(crs="EPSG:32632", transform=from_origin(399960, 5600040, 10, 10))
+    with rasterio.open(tmp_path / "strips.tif", "w", **profile) as dest:
+        dest.write(array, 1)
+    with rasterio.open(tmp_path / "deflate.tif", "w", compress="deflate", **profile) as dest:
+        dest.write(array, 1)
+    tiled = _write_band(tmp_path / "tiled.tif", array)
+
+    with rasterio.open(tmp_path / "strips.tif") as src:
+        assert isinstance(reading.memory_map(src), np.memmap)
+    for path in [tmp_path / "deflate.tif", tiled]:
+        with rasterio.open(path) as src:
+            assert reading.memory_map(src) is None
+    # whole bands are converted by blocks of MAP_ROWS rows
+    monkeypatch.setattr(reading, "MAP_ROWS", 7)
+    mapped = reading.read_raster(str(tmp_path / "strips.tif"), "", cache_size=2**20, scale=(0.5, -1))
+    decoded = reading.read_raster(str(tmp_path / "deflate.tif"), "", scale=(0.5, -1))
+    assert np.array_equal(mapped, decoded, equal_nan=True)
+    streamed = calc_index([str(tmp_path / "strips.tif")], "", lambda b: b, str(tmp_path / "out.tif"))
+    assert streamed is None
+    with rasterio.open(tmp_path / "out.tif") as src:
+        assert np.allclose(src.read(1) * 0.5 - 1, decoded, equal_nan=True)
+
+    # a rewritten file is mapped again and its old map is dropped
+    with rasterio.open(tmp_path / "strips.tif", "w", **profile) as dest:
+        dest.write(array[::-1], 1)
+    os.utime(tmp_path / "strips.tif", ns=(1, 1))
+    with rasterio.open(tmp_path / "strips.tif") as src:
+        assert np.array_equal(reading.memory_map(src), array[::-1])
+    assert [key for key in reading._memory_maps if key[0] == str(tmp_path / "strips.tif")] == [
+        (str(tmp_path / "strips.tif"), 1)
+    ]
+
+
+def test_engine_matches_numpy():
+    """Tests if the compiled formulas give the same results as plain NumPy and reuse their buffers"""
+    rng = np.random.default_rng(1)
+    blue, red, nir = (rng.integers(1, 10000, (20, 30)).astype("float64") for _ in range(3))
+
+    program = compile_formula(INDICES["arvi"]["formula"], INDICES["arvi"]["bands"]["s2"], {"L": 2})
+    arvi = evaluate(program, {"blue": blue, "red": red, "nir": nir})
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = (nir - red - 2 * (red - blue)) / (nir + red - 2 * (red - blue))
+    # pixels divided by zero are np.nan instead of infinite
+    expected[~np.isfinite(expected)] = np.nan
+
+    assert program["bands"] == ["blue", "nir", "red"]
+    # (red - blue) is only calculated once and at most three intermediate results are alive at a time
+    assert len(program["steps"]) == 7
+    assert program["n_buffers"] == 3
+    assert np.allclose(arvi, expected, equal_nan=True)
+
+    # whole arrays release their buffers after every call, blocks keep them for the next block
+    calculate = kernel(program)
+    tracemalloc.start()
+    whole = calculate(blue, nir, red)
+    held = tracemalloc.get_traced_memory()[0]
+    with reuse_buffers():
+        calculate(blue, nir, red)
+    held_by_blocks = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert np.allclose(whole, expected, equal_nan=True)
+    assert held < 2 * whole.nbytes
+    assert held_by_blocks - held >= 3 * whole.nbytes
+
+
+def test_engine_skips_invalid_pixels():
+    """Tests if pixels without data, masked or divided by zero are np.nan and calculated without warnings"""
+    nir = np.array([[0.5, np.nan, 0.6, 0.0], [0.4, 0.3, 0.2, 0.7]])
+    red = np.array([[0.1, 0.2, np.nan, 0.0], [0.1, 0.1, 0.1, 0.1]])
+    valid = np.array([[True, True, True, True], [True, True, False, True]])
+    program = compile_formula(INDICES["ndvi"]["formula"], INDICES["ndvi"]["bands"]["s2"])
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        ndvi = evaluate(program, {"nir": nir, "red": red}, valid=valid)
+
+    expected = np.array([[0.4 / 0.6, np.nan, np.nan, np.nan], [0.3 / 0.5, 0.2 / 0.4, np.nan, 0.6 / 0.8]])
+    np.testing.assert_allclose(ndvi, expected)
+    summary = stats.summary(stats.of_array("ndvi", ndvi))
+    assert (summary["pixels"], summary["count"]) == (8, 4)
+
+
+def test_registry_formulas_compile():
+    """Tests if every index of the registry can be compiled for every satellite it declares"""
+    for index_name, index in INDICES.items():
+        for bands in index["bands"].values():
+            program = compile_formula(index["formula"], bands, index["optional"])
+            assert set(program["bands"]) == set(bands), index_name
+
+
+def test_batch_reads_every_band_once(tmp_path, monkeypatch):
+    """Tests if several indices sharing bands read every file only once"""
+    rng = np.random.default_rng(2)
+    green, red, nir = (
+        _write_band(tmp_path / "{}.tif".format(name), rng.integers(1, 10000, (40, 40)).astype("uint16"))
+        for name in ["green", "red", "nir"]
+    )
+    reads = []
+    read_raster = reading.read_raster
+    monkeypatch.setattr(
+        reading,
+        "read_raster",
+        lambda path, *args, **kwargs: reads.append(path) or read_raster(path, *args, **kwargs),
+    )
+
+    ndvi, ndwi = calc_indices(
+        [green, red, nir],
+        "",
+        [
+            (lambda red, nir: (nir - red) / (nir + red), [1, 2]),
+            (lambda green, nir: (green - nir) / (green + nir), [0, 2]),
+        ],
+    )
+
+    assert reads == [green, red, nir]
+    assert np.allclose(ndvi, calc_index([red, nir], "", lambda red, nir: (nir - red) / (nir + red)))
+    assert np.allclose(ndwi, calc_index([green, nir], "", lambda green, nir: (green - nir) / (green + nir)))
+
+
+def test_scene_batch_writes_every_scene(tmp_path, monkeypatch):
+    """Tests if the scene batch mode calculates every Landsat scene in the raster folder"""
+    rng = np.random.default_rng(3)
+    for scene in ["LC08_L2SP_195026_20220705_20220708_02_T1", "LC09_L2SP_195026_20220713_20220715_02_T1"]:
+        (tmp_path / "data" / "raster" / scene).mkdir(parents=True)
+        for band in ["B4", "B5"]:
+            array = rng.integers(1, 10000, (40, 40)).astype("uint16")
+            _write_band(tmp_path / "data" / "raster" / scene / "{}_SR_{}.tif".format(scene, band), array)
+    (tmp_path / "results").mkdir()
+    monkeypatch.chdir(tmp_path)
+
+    written = scene_batch_calculator("l8", ["ndvi"], 30, "./data/raster/", "", "", 2)
+
+    assert sorted(written) == [
+        "./results/LC08_L2SP_195026_20220705_20220708_02_T1_ndvi.tif",
+        "./results/LC09_L2SP_195026_20220713_20220715_02_T1_ndvi.tif",
+    ]
+    for out_raster in written:
+        with rasterio.open(tmp_path / out_raster) as src:
+            assert src.shape == (40, 40)
+
+
+def test_threaded_reading_keeps_order(tmp_path):
+    """Tests if bands decoded by the thread pool are returned in the order of their paths"""
+    rng = np.random.default_rng(4)
+    arrays = [rng.integers(1, 10000, (50, 60)).astype("uint16") for _ in range(4)]
+    paths = [_write_band(tmp_path / "b{}.tif".format(i), array) for i, array in enumerate(arrays)]
+
+    bands = read_rasters(paths, "", {"threads": 4})
+
+    for band, array in zip(bands, arrays):
+        assert band.dtype == np.float64
+        assert np.array_equal(band, array)
+
+
+def test_compute_threads_match_one_thread(tmp_path):
+    """Tests if indices calculated by several threads (chunks of rows, streamed blocks) equal one thread"""
+    rng = np.random.default_rng(5)
+    paths = [
+        _write_band(tmp_path / "b{}.tif".format(i), rng.integers(0, 10000, (300, 270)).astype("uint16"))
+        for i in range(2)
+    ]
+    program = compile_formula("(nir - red) / (nir + red)", ["red", "nir"])
+    formulas = [(kernel(program), [0, 1])]
+
+    whole = calc_indices(paths, "", formulas)[0]
+    chunked = calc_indices(paths, "", formulas, read_options={"compute_threads": 3})[0]
+    out_stats = [stats.new("ndvi")]
+    calc_indices(paths, "", formulas, [str(tmp_path / "ndvi.tif")], {"compute_threads": 3}, out_stats=out_stats)
+
+    assert np.array_equal(chunked, whole, equal_nan=True)
+    with rasterio.open(tmp_path / "ndvi.tif") as src:
+        assert np.array_equal(src.read(1), whole, equal_nan=True)
+    assert out_stats[0]["count"] == np.count_nonzero(np.isfinite(whole))
+    assert np.isclose(out_stats[0]["mean"], np.nanmean(whole))
+
+
+def test_cache_reuses_and_evicts_bands(tmp_path, monkeypatch):
+    """Tests if cached bands are read again without decoding and the least recently used ones are evicted"""
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache") + "/")
+    rng = np.random.default_rng(5)
+    arrays = [rng.integers(1, 10000, (50, 50)).astype("uint16") for _ in range(3)]
+    paths = [_write_band(tmp_path / "b{}.tif".format(i), array) for i, array in enumerate(arrays)]
+    # room for two of the three bands (5000 bytes each plus the npy header)
+    max_size = 2 * 5128
+
+    bands = read_rasters(paths[:2], "", {"cache": max_size})
+    assert cache.load(paths[0]) is not None and cache.load(paths[1]) is not None
+    assert np.array_equal(bands[0], arrays[0])
+
+    # b1 is used more recently than b0, so adding b2 evicts b0
+    os.utime(cache.cache_file(paths[0]), (0, 0))
+    read_rasters(paths[2:], "", {"cache": max_size})
+    assert cache.load(paths[0]) is None
+    assert np.array_equal(cache.load(paths[2]), arrays[2])
+
+    # a changed raster file is not served from the cache
+    _write_band(tmp_path / "b1.tif", arrays[0])
+    assert cache.load(paths[1]) is None
+
+
+def test_clip_reads_only_the_window_in_memory(tmp_path, monkeypatch):
+    """Tests if a clipped band is read as the window of the shapefile without writing temporary files"""
+    (tmp_path / "data" / "shapes").mkdir(parents=True)
+    monkeypatch.chdir(tmp_path)
+    array = np.arange(60 * 80, dtype="uint16").reshape(60, 80)
+    band_path = _write_band(tmp_path / "b4.tif", array)
+    # square from column 10 to 30 and row 20 to 45 (10 m pixels)
+    polygon = {
+        "type": "Polygon",
+        "coordinates": [
+            [(400060, 5599840), (400260, 5599840), (400260, 5599590), (400060, 5599590), (400060, 5599840)]
+        ],
+    }
+    schema = {"geometry": "Polygon", "properties": {"id": "int"}}
+    with fiona.open("./data/shapes/aoi.shp", "w", "ESRI Shapefile", schema, crs="EPSG:32632") as shapefile:
+        shapefile.write({"geometry": polygon, "properties": {"id": 1}})
+
+    band = reading.read_raster(band_path, "aoi.shp")
+    profile = reading.raster_profile(band_path, "aoi.shp")
+
+    assert band.shape == (25, 20) == (profile["height"], profile["width"])
+    assert np.array_equal(band, array[20:45, 10:30])
+    assert profile["transform"] == from_origin(400060, 5599840, 10, 10)
+    assert sorted(os.listdir(tmp_path / "data")) == ["shapes"]
+
+
+def test_clip_reprojects_shapes_to_the_raster(tmp_path, monkeypatch):
+    """Tests if a shapefile in another CRS is reprojected and only the window of its bounds is read"""
+    (tmp_path / "data" / "shapes").mkdir(parents=True)
+    monkeypatch.chdir(tmp_path)
+    array = np.arange(60 * 80, dtype="uint16").reshape(60, 80)
+    band_path = _write_band(tmp_path / "b4.tif", array)
+    # the same square as in the test above, stored in geographic coordinates
+    polygon = rasterio.warp.transform_geom(
+        "EPSG:32632",
+        "EPSG:4326",
+        {
+            "type": "Polygon",
+            "coordinates": [
+                [(400060, 5599840), (400260, 5599840), (400260, 5599590), (400060, 5599590), (400060, 5599840)]
+            ],
+        },
+    )
+    schema = {"geometry": "Polygon", "properties": {"id": "int"}}
+    with fiona.open("./data/shapes/aoi_wgs84.shp", "w", "ESRI Shapefile", schema, crs="EPSG:4326") as shapefile:
+        shapefile.write({"geometry": polygon, "properties": {"id": 1}})
+    windows = []
+    read_window = rasterio.DatasetReader.read
+    monkeypatch.setattr(
+        rasterio.DatasetReader,
+        "read",
+        lambda self, *args, **kwargs: windows.append(kwargs.get("window"))
+        or read_window(self, *args, **kwargs),
+    )
+
+    band = reading.read_raster(band_path, "aoi_wgs84.shp")
+
+    # rounding of the reprojected bounds may add one pixel to the window, which is masked
+    assert len(windows) == 1 and windows[0].col_off == 10 and windows[0].row_off == 20
+    assert windows[0].width <= 21 and windows[0].height <= 26
+    assert np.array_equal(band[:25, :20], array[20:45, 10:30])
+    assert np.isnan(band[25:, :]).all() and np.isnan(band[:, 20:]).all()
+
+
+def test_float32_and_scaled_int16_outputs(tmp_path):
+    """Tests if bands are calculated as float32 and streamed indices are stored as int16 with scale and offset"""
+    rng = np.random.default_rng(6)
+    red, nir = (
+        _write_band(tmp_path / "{}.tif".format(name), rng.integers(1, 10000, (64, 64)).astype("uint16"))
+        for name in ["red", "nir"]
+    )
+    ndvi = lambda red, nir: (nir - red) / (nir + red)  # noqa: E731
+    options = {"dtype": "float32", "output": "int16"}
+
+    bands = read_rasters([red, nir], "", options)
+    calc_indices(
+        [red, nir], "", [(ndvi, [0, 1])], [str(tmp_path / "ndvi.tif")], options, [output_scale("ndvi")]
+    )
+
+    assert all(band.dtype == np.float32 for band in bands)
+    expected = ndvi(*read_rasters([red, nir], ""))
+    with rasterio.open(tmp_path / "ndvi.tif") as src:
+        assert src.dtypes[0] == "int16"
+        assert src.scales == (0.0001,) and src.offsets == (0.0,)
+        assert np.allclose(src.read(1) * src.scales[0] + src.offsets[0], expected, atol=0.00005)
+    # indices which are not bound to their range (like the GCI up to about 4) are not clipped to int16
+    assert output_scale("gci") is None and output_scale("sipi") is None
+    with pytest.raises(ValueError):
+        to_output(expected, "int16", output_scale("gci"))
+
+
+def test_cog_output_is_tiled_compressed_with_overviews(tmp_path):
+    """Tests if a streamed index is exported as Cloud-Optimized GeoTIFF without leaving temporary files"""
+    rng = np.random.default_rng(7)
+    red, nir = (
+        _write_band(tmp_path / "{}.tif".format(name), rng.integers(1, 10000, (1024, 1024)).astype("uint16"))
+        for name in ["red", "nir"]
+    )
+    ndvi = lambda red, nir: (nir - red) / (nir + red)  # noqa: E731
+
+    calc_indices([red, nir], "", [(ndvi, [0, 1])], [str(tmp_path / "ndvi.tif")], {"compress": "zstd"})
+
+    with rasterio.open(tmp_path / "ndvi.tif") as src:
+        assert src.tags(ns="IMAGE_STRUCTURE")["LAYOUT"] == "COG"
+        assert src.compression.value == "ZSTD"
+        assert src.block_shapes[0] == (512, 512)
+        assert src.overviews(1) == [2]
+        assert np.allclose(src.read(1), ndvi(*read_rasters([red, nir], "")))
+    assert not os.path.exists(tmp_path / "ndvi.tif.tmp")
+
+
+def test_array_export_is_binary(tmp_path, monkeypatch):
+    """Tests if the results/ndarray is saved as memory-mappable npy-file instead of text"""
+    (tmp_path / "results").mkdir()
+    monkeypatch.chdir(tmp_path)
+    result = np.random.default_rng(8).random((30, 40))
+    result[:5] = np.nan
+
+    write_array("ndvi", result, "true")
+
+    saved = np.load(tmp_path / "results" / "ndvi.npy", mmap_mode="r")
+    assert isinstance(saved, np.memmap)
+    assert np.array_equal(saved, result, equal_nan=True)
+
+
+def test_streaming_statistics_merge_blocks():
+    """Tests if statistics added block by block equal the statistics of the whole array"""
+    rng = np.random.default_rng(9)
+    result = rng.normal(0.3, 0.4, (300, 200))
+    result[:10] = np.nan
+
+    merged = stats.new("ndvi")
+    for block in np.array_split(result, 7):
+        stats.update(merged, block)
+    summary = stats.summary(merged)
+
+    valid = result[~np.isnan(result)]
+    assert (
+        summary["count"]
+        == valid.size
+        == sum(summary["histogram"]["counts"]) + merged["below"] + merged["above"]
+    )
+    assert np.isclose(summary["mean"], valid.mean()) and np.isclose(summary["std"], valid.std())
+    assert summary["min"] == valid.min() and summary["max"] == valid.max()
+    # percentiles are exact up to the width of a bin (0.01)
+    for q in stats.PERCENTILES:
+        assert abs(summary["percentiles"]["p{}".format(q)] - np.percentile(valid, q)) < 0.01
+    whole = stats.summary(stats.of_array("ndvi", result))
+    assert whole["histogram"] == summary["histogram"] and np.isclose(whole["std"], summary["std"])
+
+
+def test_zonal_statistics_per_feature():
+    """Tests if the statistics of every zone of a label raster equal the statistics of its pixels"""
+    rng = np.random.default_rng(10)
+    labels = rng.integers(0, 5, (80, 60)).astype("int32")
+    result = rng.normal(0.3, 0.4, (80, 60))
+    result[:4] = np.nan
+    # zone 5 has no pixels
+    zones = stats.zonal(labels, result, 5)
+
+    for zone in range(1, 5):
+        values = result[(labels == zone) & ~np.isnan(result)]
+        assert zones["count"][zone - 1] == values.size
+        assert np.isclose(zones["mean"][zone - 1], values.mean())
+        assert np.isclose(zones["std"][zone - 1], values.std())
+        assert zones["min"][zone - 1] == values.min() and zones["max"][zone - 1] == values.max()
+    assert zones["count"][4] == 0 and np.isnan(zones["min"][4])
+
+
+def test_time_series_aggregates_are_incremental(tmp_path, monkeypatch):
+    """Tests if scenes appended one by one give the aggregates of the whole datacube, also if appended again"""
+    monkeypatch.setattr(series, "SERIES_DIR", str(tmp_path / "series") + "/")
+    rng = np.random.default_rng(11)
+    steps = rng.normal(0.4, 0.2, (4, 30, 20))
+    steps[1, :5] = np.nan
+    name = series.cube_name("ndvi", "s2", "10", "./data/shapes/aoi.shp")
+
+    cube = series.load("ndvi", name)
+    for i, step in enumerate(steps):
+        cube = series.append(cube, "scene{}".format(i), "2022070{}".format(i + 1), step)
+    # a run which stopped before saving series.json appends the last scene again
+    cube["scenes"].pop()
+    cube = series.append(cube, "scene3", "20220704", steps[3])
+    series.save_median(cube, rows=7)
+
+    assert name == "ndvi_s2_10m_aoi"
+    assert series.missing_scenes(series.load("ndvi", name), ["scene0", "scene4"]) == ["scene4"]
+    folder = series.series_dir(name)
+    dates, stacked = series.load_cube("ndvi", name)
+    assert dates == ["20220701", "20220702", "20220703", "20220704"]
+    assert np.array_equal(stacked, steps, equal_nan=True)
+    aggregates, included = series.load_aggregates(folder, (30, 20))
+    assert included == ["scene0", "scene1", "scene2", "scene3"]
+    assert np.array_equal(aggregates["count"], np.isfinite(steps).sum(axis=0))
+    assert np.allclose(aggregates["max"], np.nanmax(steps, axis=0))
+    assert np.allclose(aggregates["mean"], np.nanmean(steps, axis=0))
+    assert np.allclose(np.load(folder + "median.npy"), np.nanmedian(steps, axis=0))
+    # the last scene compared with the baseline of the three scenes before
+    baseline = steps[:3]
+    expected = (steps[3] - np.nanmean(baseline, axis=0)) / np.nanstd(baseline, axis=0)
+    assert np.allclose(np.load(folder + "anomaly_20220704.npy"), expected)
+    assert not [path for path in os.listdir(folder) if path.endswith(".tmp")]
+
+
+def test_coarser_bands_are_resampled_to_the_grid(tmp_path):
+    """Tests if a 20 m band is aligned to the 10 m grid of another band, whole and block by block"""
+    rng = np.random.default_rng(12)
+    fine = _write_band(tmp_path / "b04.tif", rng.integers(1, 10000, (64, 64)).astype("uint16"))
+    coarse_array = rng.integers(1, 10000, (32, 32)).astype("uint16")
+    with rasterio.open(
+        tmp_path / "b11.tif",
+        "w",
+        driver="GTiff",
+        height=32,
+        width=32,
+        count=1,
+        dtype="uint16",
+        crs="EPSG:32632",
+        transform=from_origin(399960, 5600040, 20, 20),
+    ) as dest:
+        dest.write(coarse_array, 1)
+    coarse = str(tmp_path / "b11.tif")
+    options = {"grid": fine, "resampling": "nearest"}
+
+    red, swir = read_rasters([fine, coarse], "", options)
+    calc_indices(
+        [fine, coarse], "", [(lambda red, swir: swir - red, [0, 1])], [str(tmp_path / "d.tif")], options
+    )
+
+    assert swir.shape == red.shape == (64, 64)
+    assert np.array_equal(swir, np.repeat(np.repeat(coarse_array, 2, axis=0), 2, axis=1))
+    with rasterio.open(tmp_path / "d.tif") as src:
+        assert src.res == (10, 10)
+        assert np.array_equal(src.read(1), swir - red)
+
+
+@pytest.fixture
+def l8_scene(tmp_path, monkeypatch):
+    """Synthetic Landsat 8 scene with its own manifest folder, called with its red (SR_B4) and NIR (SR_B5) band"""
+    monkeypatch.setattr(manifest, "MANIFEST_DIR", str(tmp_path / "manifests") + "/")
+    scene = tmp_path / "LC08_L2SP_195026_20220705_20220708_02_T1"
+    scene.mkdir()
+
+    def write(red, nir):
+        _write_band(scene / "{}_SR_B4.tif".format(scene.name), red)
+        _write_band(scene / "{}_SR_B5.tif".format(scene.name), nir)
+        return scene
+
+    return write
+
+
+def test_manifest_is_parsed_once_and_invalidated(tmp_path, l8_scene):
+    """Tests if the bands of a scene are looked up in its saved manifest until a file is added to the scene"""
+    scene = l8_scene(np.ones((8, 8), "uint16"), np.ones((8, 8), "uint16"))
+    scans = []
+    scan = lambda scene: scans.append(scene) or indices_l8.scan(scene)  # noqa: E731
+
+    first = manifest.load(str(scene), scan, "20220705")
+    # a new process only reads the saved manifest
+    manifest._manifests.clear()
+    second = manifest.load(str(scene), scan, "20220705")
+    assert len(scans) == 1 and first == second
+    assert sorted(second["bands"]["30"]) == ["SR_B4", "SR_B5"]
+    assert second["bands"]["30"]["SR_B4"]["width"] == 8
+
+    _write_band(scene / "{}_SR_B6.tif".format(scene.name), np.ones((8, 8), "uint16"))
+    os.utime(scene, ns=(0, 0))
+    third = manifest.load(str(scene), scan, "20220705")
+    assert len(scans) == 2 and "SR_B6" in third["bands"]["30"]
+    # a band rewritten in place (the folder keeps its modification time) is parsed again as well
+    folder_mtime = os.stat(scene).st_mtime_ns
+    _write_band(scene / "{}_SR_B4.tif".format(scene.name), np.ones((16, 16), "uint16"))
+    os.utime(scene, ns=(folder_mtime, folder_mtime))
+    fourth = manifest.load(str(scene), scan, "20220705")
+    assert len(scans) == 3 and fourth["bands"]["30"]["SR_B4"]["width"] == 16
+    # a scene with the same name in another folder has its own manifest
+    assert manifest.manifest_file(str(scene)) != manifest.manifest_file(str(tmp_path / "copy" / scene.name))
+
+
+def test_compute_index_raises_instead_of_exiting(l8_scene):
+    """Tests if the library interface returns the index of a scene and raises errors instead of exiting"""
+    rng = np.random.default_rng(7)
+    red, nir = rng.integers(1, 10000, (2, 24, 24)).astype("uint16")
+    scene = l8_scene(red, nir)
+
+    result, profile = compute_index(str(scene), "ndvi")
+    expected = (nir.astype("float64") - red) / (nir.astype("float64") + red)
+    np.testing.assert_allclose(result, expected)
+    assert (profile["width"], profile["height"]) == (24, 24)
+
+    with pytest.raises(ValueError):
+        compute_index(str(scene), "unknown")
+    with pytest.raises(RuntimeError):
+        # the scene has no band 6 for the NDMI
+        compute_index(str(scene), "ndmi")
+    # the reading functions raise their errors instead of exiting
+    with pytest.raises(RuntimeError, match="shapefile"):
+        reading.read_shapes(str(scene / "missing.shp"))
+
+
+def test_bands_are_converted_to_reflectance(tmp_path, l8_scene):
+    """Tests if the scales and offsets of the metadata convert the bands to reflectance, whole and streamed"""
+    rng = np.random.default_rng(3)
+    red, nir = rng.integers(7500, 40000, (2, 64, 64)).astype("uint16")
+    scene = l8_scene(red, nir)
+    lines = ["GROUP = LEVEL2_SURFACE_REFLECTANCE_PARAMETERS"]
+    lines += ["REFLECTANCE_MULT_BAND_{} = 2.75E-05".format(i) for i in [4, 5]]
+    lines += ["REFLECTANCE_ADD_BAND_{} = -0.2".format(i) for i in [4, 5]]
+    lines += ["END_GROUP = LEVEL2_SURFACE_REFLECTANCE_PARAMETERS", "GROUP = LEVEL1_RADIOMETRIC_RESCALING"]
+    lines += ["REFLECTANCE_MULT_BAND_4 = 2.0E-05", "REFLECTANCE_ADD_BAND_4 = -0.1"]
+    lines += ["END_GROUP = LEVEL1_RADIOMETRIC_RESCALING"]
+    (scene / "{}_MTL.txt".format(scene.name)).write_text("\n".join(lines))
+
+    result, _ = compute_index(str(scene), "savi")
+    red, nir = red * 2.75e-05 - 0.2, nir * 2.75e-05 - 0.2
+    expected = (nir - red) / (nir + red + 0.5) * 1.5
+    np.testing.assert_allclose(result, expected)
+    indices_l8.index_calc(["savi"], str(scene), "", "", [str(tmp_path / "savi.tif")])
+    with rasterio.open(tmp_path / "savi.tif") as src:
+        np.testing.assert_allclose(src.read(1), expected)
+
+    # Sentinel-2 L2A since processing baseline 04.00: (value - 1000) / 10000
+    s2_scene = tmp_path / "S2A_MSIL2A_20220701T102031_N0400_R065_T32UNV_20220701T164310.SAFE"
+    s2_scene.mkdir()
+    (s2_scene / "MTD_MSIL2A.xml").write_text(
+        "<Product><BOA_QUANTIFICATION_VALUE>10000</BOA_QUANTIFICATION_VALUE>"
+        + "".join('<BOA_ADD_OFFSET band_id="{}">-1000</BOA_ADD_OFFSET>'.format(i) for i in range(13))
+        + "</Product>"
+    )
+    scales = indices_s2.reflectance(str(s2_scene))
+    assert len(scales) == 13 and scales["B8A"] == [0.0001, -0.1]
+
+
+def test_startup_imports_no_plotting():
+    """Tests if the modules of main.py load without matplotlib"""
+    # the time of the imports depends on the machine, it is tracked across commits by benchmark.import_seconds()
+    src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = "import sys, main, modules.api; print('matplotlib' in sys.modules)"
+    run = subprocess.run([sys.executable, "-c", code], cwd=src, capture_output=True, text=True, check=True)
+    assert run.stdout.strip() == "False"
+
+
+def test_cloud_mask_skips_clouded_blocks(tmp_path, monkeypatch, l8_scene):
+    """Tests if clouded pixels of the QA_PIXEL band are np.nan and blocks without clear pixels are not read"""
+    rng = np.random.default_rng(11)
+    scene = l8_scene(*rng.integers(1, 10000, (2, 64, 64)).astype("uint16"))
+    # the upper half is clouded (bit 3), one pixel in the lower half has a cloud shadow (bit 4)
+    qa = np.full((64, 64), 0b1000000, "uint16")
+    qa[:32] = 0b1000
+    qa[40, 5] = 0b10000
+    _write_band(scene / "{}_QA_PIXEL.tif".format(scene.name), qa)
+
+    (result,), _ = indices_l8.index_calc(["ndvi"], str(scene), "", "", None, {"clouds": True})
+    assert np.isnan(result[:32]).all() and np.isnan(result[40, 5])
+    assert np.isfinite(result[32:]).sum() == 32 * 64 - 1
+
+    reads = []
+    read_window = reading.read_window
+    monkeypatch.setattr(reading, "read_window", lambda *args: reads.append(args[1]) or read_window(*args))
+    out_raster = str(tmp_path / "ndvi.tif")
+    indices_l8.index_calc(["ndvi"], str(scene), "", "", [out_raster], {"clouds": True})
+    # the two clouded blocks only read the QA_PIXEL band, the two others all three bands
+    assert len(reads) == 2 + 2 * 3
+    with rasterio.open(out_raster) as src:
+        np.testing.assert_array_equal(src.read(1), result.astype("float64"))
+
+
+def test_benchmark_measures_stages_and_regressions(tmp_path, monkeypatch):
+    """Tests if the benchmark measures every stage on synthetic scenes and reports stages which got slower"""
+    monkeypatch.chdir(tmp_path)
+    root = str(tmp_path)
+    os.makedirs(root + "/results")
+    rng = np.random.default_rng(5)
+    case = {
+        "root": root,
+        "satellite": "s2",
+        "scene": benchmark.make_s2_scene(root, 120, rng),
+        "clip": benchmark.make_shape(root, 120),
+        "index_names": ["ndvi", "ndmi"],
+        "resolution": "",
+        "dtype": "float32",
+        "repeat": 1,
+    }
+    measured = benchmark.run_case(case)
+    assert sorted(measured["indices"]) == ["ndmi", "ndvi"]
+    assert sorted(measured["indices"]["ndvi"]) == ["clip", "compute", "read", "stats", "stream", "write"]
+    assert all(values["mpix_s"] > 0 for values in measured["indices"]["ndmi"].values())
+
+    record = {"commit": "b", "satellite": "s2", "size": 120, "clip": True, "dtype": "float32", "resolution": ""}
+    record.update(measured)
+    before = json.loads(json.dumps(dict(record, commit="a")))
+    before["indices"]["ndvi"]["compute"]["mpix_s"] = measured["indices"]["ndvi"]["compute"]["mpix_s"] * 2
+    before["rss_mb"] = measured["rss_mb"] / 2
+    slower = benchmark.regressions([before], [record], 0.2)
+    assert len(slower) == 2 and "peak RSS" in slower[0] and "ndvi compute" in slower[1]
+
+    # the import time of the startup is a case of its own
+    startup = {"commit": "b", "startup": True, "import_s": round(benchmark.import_seconds(1), 3)}
+    assert startup["import_s"] > 0
+    assert benchmark.regressions([dict(startup, commit="a", import_s=startup["import_s"] / 2)], [startup], 0.2)
+    assert not benchmark.regressions([dict(startup, commit="a")], [startup], 0.2)
+
+    # the stripped Landsat bands are memory-mapped instead of decoded
+    scene = benchmark.make_l8_scene(root, 120, rng, stripped=True)
+    with rasterio.open(indices_l8.band_path(scene, "SR_B4")) as dataset:
+        assert reading.memory_map(dataset) is not None
+
+
+def test_metrics_sum_stages_and_merge_workers(tmp_path, monkeypatch):
+    """Tests if the metrics of streamed stages and of worker processes add up per stage and are saved"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "results").mkdir()
+    red = tmp_path / "red.tif"
+    nir = tmp_path / "nir.tif"
+    _write_band(red, np.full((64, 64), 100, "uint16"))
+    _write_band(nir, np.full((64, 64), 300, "uint16"))
+    ndvi = compile_formula("(nir - red) / (nir + red)", ["red", "nir"])
+
+    metrics.start()
+    calc_indices([str(red), str(nir)], "", [(kernel(ndvi), [0, 1])], [str(tmp_path / "ndvi.tif")])
+    measured = metrics.collect()
+    # four blocks of 32 x 32 pixels, each read once per band, calculated and written once
+    assert (measured["read"]["calls"], measured["read"]["bytes"]) == (8, 2 * 64 * 64 * 2)
+    assert (measured["compute"]["calls"], measured["compute"]["pixels"]) == (4, 64 * 64)
+    assert measured["write"]["pixels"] == 64 * 64
+
+    metrics.merge(measured)
+    assert metrics.collect()["read"]["calls"] == 16
+    metrics.finish("prom")
+    prom = (tmp_path / "results" / "metrics.prom").read_text()
+    assert 'index_calculator_stage_calls{stage="read"} 16' in prom
+
+    # without the module resource (Windows) and psutil the peak RSS is not measured
+    monkeypatch.setattr(metrics, "resource", None)
+    monkeypatch.setitem(sys.modules, "psutil", None)
+    assert metrics.peak_rss() == 0.0